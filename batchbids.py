@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Batch entry point for postbids.py
+
+Runs the BIDS conversion stages of postbids.run_subject for many subject
+folders on a process pool, so mne/pandas are imported and the pipeline inputs
+are read once per worker instead of once per subject.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import traceback
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import postbids
+from epsallocator import EpsAllocator
+from metrics import StageMetrics, STAGES
+from placement import PLACEMENT_MODES
+from dedupe import DUPLICATE_MODES
+from scratch import open_budget
+
+# Inputs shared by every subject a worker processes, filled by init_worker
+worker_state = {}
+
+
+def parse_arguments():
+    """ Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Run postbids.py on many subject folders in parallel.")
+
+    parser.add_argument('subjects', type=str, nargs='*', help="Subject folders or glob patterns (ex. '/data/HUP*_phaseII')")
+    parser.add_argument('--subject-list', type=str, help="Text file with one subject folder or glob pattern per line")
+    parser.add_argument('--pipeline', type=str, required=True, help="Path to the pipeline creation folder")
+    parser.add_argument('--type', type=str, choices=['ieeg', 'scalp'], required=True, help="Flag indicating data type: 'ieeg' or 'scalp'")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument('--placement', type=str, choices=PLACEMENT_MODES, default='auto', help="How imaging is placed into the BIDS tree (default: auto)")
+    parser.add_argument('--stream-imaging', action='store_true', help="Extract imaging straight from the zip archives in objects/")
+    parser.add_argument('--edf-workers', type=int, default=1, help="Threads per subject for its EDF runs (default: 1)")
+    parser.add_argument('--eps-block', type=int, default=8, help="EPS numbers each worker leases at a time (default: 8)")
+    parser.add_argument('--split-events', action='store_true', help="Write one events.tsv per EDF run")
+    parser.add_argument('--merge-runs', action='store_true', help="Merge consecutive EDF runs into as few files as possible")
+    parser.add_argument('--max-run-mb', type=int, default=0, help="With --merge-runs, MiB per merged file (default: 0, no limit)")
+    parser.add_argument('--scratch-mb', type=int, default=0,
+                        help="Keep every subject folder under this many MiB, deleting intermediates as they are used (default: 0, no limit)")
+    parser.add_argument('--imaging-duplicates', type=str, choices=DUPLICATE_MODES, default='collapse',
+                        help="Imaging volumes with the same content as an earlier one (default: collapse)")
+    parser.add_argument('--mne-channels', action='store_true', help="Classify channels with MNE instead of from the EDF header")
+    parser.add_argument('--metrics', type=str, help="Append one JSON line per subject stage to this file, '-' for stderr")
+    parser.add_argument('--profile-stage', type=str, choices=STAGES, help="Run this stage of every subject under cProfile")
+    parser.add_argument('--profile-dir', type=str, default='.', help="Folder for cProfile output (default: current folder)")
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.pipeline):
+        parser.error(f"{args.pipeline} is not a valid pipeline directory.")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    return args
+
+
+def expand_subjects(patterns):
+    """ Expand subject folders and glob patterns into a sorted list of unique directories """
+    subject_folders = []
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            # Absolute paths, so a folder given twice in different forms (ex. 'HUP1' and './HUP1/') is processed once
+            folder = os.path.abspath(match.rstrip('/'))
+            if os.path.isdir(folder) and folder not in subject_folders:
+                subject_folders.append(folder)
+
+    return sorted(subject_folders)
+
+
+def init_worker(pipeline_folder, eps_block):
+    """ Load the inputs shared by every subject once per worker process """
+    worker_state['deiddata'] = postbids.load_deidentified_data(pipeline_folder, use_snapshot=True)
+    allocator = EpsAllocator(pipeline_folder, block_size=eps_block)
+    worker_state['allocator'] = allocator
+    # Give the unused rest of the worker's EPS lease back when the pool shuts down
+    Finalize(allocator, allocator.close, exitpriority=10)
+
+
+def process_subject(subject_folder, pipeline_folder, data_type, placement='auto', stream_imaging=False, edf_workers=1,
+                    metrics_options=None, mne_channels=False, split_events=False, duplicate_mode='collapse',
+                    merge_runs=False, max_run_bytes=0, scratch_bytes=0):
+    """ Run one subject in a worker and report the result instead of raising """
+    start = time.time()
+    result = {'subject': subject_folder}
+    report = {}
+    # metrics_options are the (destination, profile stage, profile folder) of StageMetrics
+    metrics = StageMetrics(os.path.basename(subject_folder), *(metrics_options or ()))
+    scratch = open_budget(subject_folder, scratch_bytes)
+    try:
+        result['new_path'] = postbids.run_subject(subject_folder, pipeline_folder, data_type,
+                                                  deiddata=worker_state.get('deiddata'),
+                                                  allocator=worker_state.get('allocator'),
+                                                  placement=placement, stream_imaging=stream_imaging,
+                                                  edf_workers=edf_workers, report=report, metrics=metrics,
+                                                  mne_channels=mne_channels, split_events=split_events,
+                                                  duplicate_mode=duplicate_mode, merge_runs=merge_runs,
+                                                  max_run_bytes=max_run_bytes, scratch=scratch)
+        result['status'] = 'ok'
+        result.update(report)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+    finally:
+        if scratch is not None:
+            scratch.close()
+    result['stages'] = metrics.summary()
+    result['seconds'] = round(time.time() - start, 3)
+
+    return result
+
+
+def run_batch(subject_folders, pipeline_folder, data_type, workers=None, eps_block=8, placement='auto',
+              stream_imaging=False, edf_workers=1, on_result=None, metrics_options=None, mne_channels=False,
+              split_events=False, duplicate_mode='collapse', merge_runs=False, max_run_bytes=0, scratch_bytes=0):
+    """ Process subject folders on a process pool and return one result per subject """
+    pipeline_folder = os.path.abspath(pipeline_folder.rstrip('/'))
+    results = []
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(pipeline_folder, eps_block)) as executor:
+        futures = [executor.submit(process_subject, folder, pipeline_folder, data_type, placement,
+                                   stream_imaging, edf_workers, metrics_options, mne_channels, split_events, duplicate_mode,
+                                   merge_runs, max_run_bytes, scratch_bytes)
+                   for folder in subject_folders]
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if on_result is not None:
+                on_result(result)
+
+    order = {folder: idx for idx, folder in enumerate(subject_folders)}
+    results.sort(key=lambda r: order[r['subject']])
+    return results
+
+
+def main():
+    args = parse_arguments()
+
+    patterns = list(args.subjects)
+    if args.subject_list:
+        with open(args.subject_list) as f:
+            patterns.extend(line.strip() for line in f if line.strip())
+
+    subject_folders = expand_subjects(patterns)
+    if not subject_folders:
+        sys.stderr.write("No subject folders found\n")
+        sys.exit(1)
+
+    def write_result(result):
+        # One JSON line per subject on stdout, tracebacks only go to stderr
+        if result['status'] == 'failed':
+            sys.stderr.write(result['traceback'])
+        line = {k: v for k, v in result.items() if k != 'traceback'}
+        sys.stdout.write(json.dumps(line) + '\n')
+        sys.stdout.flush()
+
+    results = run_batch(subject_folders, args.pipeline, args.type, args.workers, args.eps_block,
+                        args.placement, args.stream_imaging, args.edf_workers, on_result=write_result,
+                        metrics_options=(args.metrics, args.profile_stage, args.profile_dir),
+                        mne_channels=args.mne_channels, split_events=args.split_events,
+                        duplicate_mode=args.imaging_duplicates, merge_runs=args.merge_runs,
+                        max_run_bytes=args.max_run_mb * 1024 * 1024, scratch_bytes=args.scratch_mb * 1024 * 1024)
+
+    failed = [r for r in results if r['status'] == 'failed']
+    sys.stderr.write(f"{len(results) - len(failed)} of {len(results)} subjects converted, {len(failed)} failed\n")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the BIDS conversion
+
+Times importing postbids in a fresh interpreter (against a startup budget),
+postbids.py end to end (a fresh interpreter per run, so imports count) and
+every stage of it, from the --metrics JSON lines, across a matrix of
+synthetic subject sizes built by synthetic.py. Results are stored as JSON and
+can be compared with an earlier result file to catch regressions. Subject
+generation is not timed, and everything runs offline.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+from synthetic import make_subject, make_pipeline
+
+# Size matrix: (name, runs, channels, sampling rate, seconds per run)
+CASES = {
+    'tiny': (1, 8, 256, 10),
+    'small': (3, 64, 512, 60),
+    'medium': (6, 128, 1024, 300),
+    'large': (12, 256, 1024, 600),
+}
+
+POSTBIDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'postbids.py')
+
+
+def run_case(work_folder, name, repeat=3, extra_args=(), zip_imaging=False):
+    """ Convert a fresh synthetic subject of a case repeat times, return one {'total_seconds', 'stages'} per repeat """
+    runs, channels, sfreq, duration = CASES[name]
+    results = []
+    for idx in range(repeat):
+        root = os.path.join(work_folder, f"{name}{idx}")
+        shutil.rmtree(root, ignore_errors=True)
+        pipeline_folder = os.path.join(root, 'pipeline')
+        make_pipeline(pipeline_folder, [100])
+        subject_folder = make_subject(root, 100, runs, channels, sfreq, duration, zip_imaging=zip_imaging)
+        metrics_file = os.path.join(root, 'metrics.jsonl')
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, POSTBIDS, subject_folder, pipeline_folder, 'ieeg', '--metrics', metrics_file,
+                        *extra_args], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        total = time.perf_counter() - start
+
+        stages = {}
+        with open(metrics_file) as f:
+            for line in f:
+                record = json.loads(line)
+                stages[record['stage']] = {key: record.get(key) for key in
+                                           ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'read_bytes', 'write_bytes')}
+        results.append({'total_seconds': round(total, 6), 'stages': stages})
+        shutil.rmtree(root, ignore_errors=True)
+
+    return results
+
+
+def measure_import(module='postbids', repeat=5):
+    """ Median seconds a fresh interpreter needs to import module, on top of starting up, and the slowest imports """
+    def run(code, *options):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, *options, '-c', code], check=True, cwd=os.path.dirname(POSTBIDS),
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        return time.perf_counter() - start, completed.stderr
+
+    bare = statistics.median(run('pass')[0] for _ in range(repeat))
+    seconds = statistics.median(run(f'import {module}')[0] for _ in range(repeat)) - bare
+
+    # -X importtime lines are 'import time: self | cumulative | module', indented by depth, children before their parent;
+    # the direct imports of module are the depth 1 lines right before its own top level line
+    slowest = []
+    for line in run(f'import {module}', '-X', 'importtime')[1].splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+        if depth == 0:
+            if parts[2].strip() == module:
+                break
+            slowest = []
+        elif depth == 1:
+            slowest.append((parts[2].strip(), int(parts[1]) / 1e6))
+    slowest.sort(key=lambda item: item[1], reverse=True)
+
+    return {'module': module, 'seconds': round(max(seconds, 0.0), 6), 'slowest': dict(slowest[:10])}
+
+
+def summarize_case(results):
+    """ Median total and per-stage wall seconds of the repeats of a case """
+    summary = {'total_seconds': statistics.median(r['total_seconds'] for r in results), 'stages': {}}
+    for stage in results[0]['stages']:
+        values = [r['stages'][stage]['wall_seconds'] for r in results if stage in r['stages']]
+        summary['stages'][stage] = statistics.median(values)
+
+    return summary
+
+
+def compare(current, baseline, threshold=1.2, min_seconds=0.01):
+    """ (case, measure, baseline, current) of every median that got slower than threshold times the baseline """
+    regressions = []
+    if 'import' in current and 'import' in baseline:
+        before, after = baseline['import']['seconds'], current['import']['seconds']
+        if after > min_seconds and after > before * threshold:
+            regressions.append(('import', current['import']['module'], before, after))
+    for name, case in current['cases'].items():
+        if name not in baseline['cases']:
+            continue
+        old = baseline['cases'][name]['median']
+        new = case['median']
+        pairs = [('total', old['total_seconds'], new['total_seconds'])]
+        pairs += [(stage, old['stages'][stage], seconds) for stage, seconds in new['stages'].items() if stage in old['stages']]
+        for measure, before, after in pairs:
+            # Stages that take a few milliseconds are all noise
+            if after > min_seconds and after > before * threshold:
+                regressions.append((name, measure, before, after))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark postbids.py on synthetic subjects of several sizes.")
+    parser.add_argument('--cases', type=str, default='tiny,small', help=f"Comma separated cases out of {', '.join(CASES)}, or none (default: tiny,small)")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs per case, the median is reported (default: 3)")
+    parser.add_argument('--work-dir', type=str, help="Scratch folder for the synthetic subjects (default: a temporary folder)")
+    parser.add_argument('--output', type=str, help="Write the results as JSON to this file")
+    parser.add_argument('--compare', type=str, help="Earlier result file to compare the medians with")
+    parser.add_argument('--threshold', type=float, default=1.2, help="Slowdown ratio reported as a regression (default: 1.2)")
+    parser.add_argument('--import-budget', type=float,
+                        help="Fail if importing postbids takes longer than this many seconds (default: no budget)")
+    parser.add_argument('--zip-imaging', action='store_true', help="Zip the imaging and convert with --stream-imaging")
+    parser.add_argument('postbids_args', nargs=argparse.REMAINDER, help="Extra postbids.py arguments after --")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.cases.split(',') if name.strip() and name.strip() != 'none']
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f"Unknown case(s) {', '.join(unknown)}, expected some of {', '.join(CASES)}")
+    extra_args = [arg for arg in args.postbids_args if arg != '--']
+    if args.zip_imaging:
+        extra_args.append('--stream-imaging')
+
+    work_folder = args.work_dir or tempfile.mkdtemp(prefix='postbidsbench')
+    current = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'postbids_args': extra_args,
+        'import': measure_import('postbids', args.repeat),
+        'cases': {},
+    }
+    sys.stderr.write(f"import postbids: {current['import']['seconds']:.3f}s\n")
+    try:
+        for name in names:
+            results = run_case(work_folder, name, args.repeat, extra_args, args.zip_imaging)
+            current['cases'][name] = {'size': dict(zip(('runs', 'channels', 'sfreq', 'duration'), CASES[name])),
+                                      'runs': results, 'median': summarize_case(results)}
+            median = current['cases'][name]['median']
+            stages = ' '.join(f"{stage}={seconds:.3f}" for stage, seconds in median['stages'].items())
+            sys.stderr.write(f"{name}: total={median['total_seconds']:.3f}s {stages}\n")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=4)
+
+    over_budget = args.import_budget is not None and current['import']['seconds'] > args.import_budget
+    if over_budget:
+        sys.stderr.write(f"Import budget exceeded: {current['import']['seconds']:.3f}s > {args.import_budget:.3f}s, "
+                         f"slowest imports {current['import']['slowest']}\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, measure, before, after in regressions:
+            sys.stderr.write(f"REGRESSION {name} {measure}: {before:.3f}s -> {after:.3f}s\n")
+        if regressions:
+            sys.exit(1)
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plan of the final EPS-based layout of a subject folder
+
+Holds every source -> destination of a subject (EDF moves, written sidecars,
+placed imaging, montages, renamed leftovers of the subject folder and the
+final rename of the folder itself) before any I/O happens, checks it for
+collisions, prints it for a dry run and applies the renames of the files that
+already existed in the subject folder. Stages write straight to their final
+sub-<EPS> names, so nothing is renamed after the fact.
+"""
+
+import os
+import re
+
+PLAN_KINDS = ('move', 'write', 'place', 'copy', 'rename', 'root')
+
+
+def final_name(name, eps_string, subject_id):
+    """ EPS-based name of one file or directory name, the name itself if nothing identifies the subject """
+    # sub-<anything> becomes sub-<EPS>
+    if "sub-" in name:
+        before_underscore = name.split("-")[1].split("_")[0]
+        return name.replace(f"sub-{before_underscore}", f"sub-{eps_string}")
+
+    # <prefix><subject id> becomes the EPS number, unless the rest of the name has more digits (ex. a date)
+    if subject_id and subject_id in name:
+        if len(re.findall(r'\d', name.replace(subject_id, ""))) <= 1:
+            before_subject_id = name.split(subject_id)[0]
+            return name.replace(before_subject_id + subject_id, eps_string)
+        return name
+
+    # RID and the 3 characters after it become the EPS number
+    if "RID" in name:
+        rid_index = name.find("RID")
+        return name[:rid_index] + eps_string + name[rid_index + 6:]
+
+    return name
+
+
+class SubjectPlan:
+    """ Every source -> destination of one subject folder, destinations under the final EPS folder """
+
+    def __init__(self, subject_folder, eps_string):
+        self.subject_folder = subject_folder
+        self.final_folder = os.path.join(os.path.dirname(subject_folder), eps_string)
+        self.entries = []
+
+    def final_path(self, path):
+        """ Where a path inside the subject folder ends up once the folder is renamed """
+        return os.path.join(self.final_folder, os.path.relpath(path, self.subject_folder))
+
+    def add(self, kind, source, destination):
+        """ Add one entry; destination is the path inside the subject folder the stage writes to """
+        if kind not in PLAN_KINDS:
+            raise ValueError(f"Unknown plan entry kind '{kind}', expected one of {', '.join(PLAN_KINDS)}")
+        if kind != 'root':
+            destination = self.final_path(destination)
+        self.entries.append({'kind': kind, 'source': source, 'destination': destination})
+
+    def entries_of(self, kind):
+        """ Entries of one kind, in plan order """
+        return [entry for entry in self.entries if entry['kind'] == kind]
+
+    def collisions(self):
+        """ Destinations claimed by more than one entry, or already taken by something the plan does not move away """
+        sources = {self.final_path(entry['source']) for entry in self.entries
+                   if entry['kind'] in ('move', 'rename') and entry['source'].startswith(self.subject_folder)}
+        seen = {}
+        collisions = []
+        for entry in self.entries:
+            destination = entry['destination']
+            if destination in seen:
+                collisions.append(destination)
+            seen[destination] = entry
+        for entry in self.entries_of('rename'):
+            # Renames are applied in place, the final name must not already be used next to the source
+            in_place = os.path.join(os.path.dirname(entry['source']), os.path.basename(entry['destination']))
+            if os.path.lexists(in_place) and self.final_path(in_place) not in sources:
+                collisions.append(entry['destination'])
+        for entry in self.entries_of('root'):
+            if os.path.lexists(entry['destination']):
+                collisions.append(entry['destination'])
+
+        return collisions
+
+    def check(self):
+        """ Raise if two entries would end up at the same path """
+        collisions = self.collisions()
+        if collisions:
+            raise ValueError(f"Plan for {self.subject_folder} has colliding destinations: {', '.join(sorted(set(collisions)))}")
+
+    def apply_renames(self):
+        """ Rename the files and directories that already existed in the subject folder, deepest first """
+        renamed = 0
+        for entry in sorted(self.entries_of('rename'), key=lambda entry: entry['source'].count(os.sep), reverse=True):
+            source = entry['source']
+            # Gone if an earlier stage already moved it (ex. imaging placed with --placement rename)
+            if not os.path.lexists(source):
+                continue
+            os.rename(source, os.path.join(os.path.dirname(source), os.path.basename(entry['destination'])))
+            renamed += 1
+
+        return renamed
+
+    def format(self):
+        """ One 'kind  source -> destination' line per entry, for the dry run """
+        lines = []
+        for entry in self.entries:
+            source = entry['source'] or '-'
+            lines.append(f"{entry['kind']:<7}{source} -> {entry['destination']}")
+        return lines
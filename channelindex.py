@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index of the channel layouts of a subject's EDF runs
+
+Reads the header of every run on a thread pool (header only, a few KiB per
+file) and groups the runs by a hash of their channel names, sampling rates
+and units, so a montage or rate change in the middle of an admission shows
+up as a second signature instead of every run being described by the first
+one. The signature shared by most runs describes the session; the runs with
+another one get sidecars of their own.
+"""
+
+import json
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from edfheader import read_edf_header
+
+# Hex digits of the SHA-256 kept as the signature
+SIGNATURE_LENGTH = 16
+
+HEADER_WORKERS = 8
+
+
+def channel_signature(header):
+    """ Short hash of the names, sampling rates and units of a header's data channels, in order """
+    layout = [[channel['name'], channel['sampling_frequency'], channel['units']] for channel in header['channels']]
+    return hashlib.sha256(json.dumps(layout).encode('utf-8')).hexdigest()[:SIGNATURE_LENGTH]
+
+
+def read_headers(paths, workers=HEADER_WORKERS):
+    """ {path: parsed header} of every file, read concurrently """
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths) or 1))) as executor:
+        return dict(zip(paths, executor.map(read_edf_header, paths)))
+
+
+def index_runs(paths, workers=HEADER_WORKERS):
+    """ Signature of every run and the layout behind every signature, with the signature that describes the session
+
+    paths are in run order; returns ({'default', 'runs': {file name: signature}, 'signatures': {signature:
+    {'run_count', 'channels', 'sampling_frequency', 'units'}}}, {path: header}).
+    """
+    headers = read_headers(paths, workers)
+    runs = {}
+    signatures = {}
+    for path in paths:
+        header = headers[path]
+        signature = channel_signature(header)
+        runs[os.path.basename(path)] = signature
+        if signature not in signatures:
+            signatures[signature] = {'run_count': 0, 'channels': len(header['channels']),
+                                     'sampling_frequency': header['sampling_frequency'],
+                                     'units': sorted({channel['units'] for channel in header['channels']})}
+        signatures[signature]['run_count'] += 1
+
+    # Most runs win, a tie goes to the signature seen first
+    default = max(signatures, key=lambda signature: signatures[signature]['run_count']) if signatures else None
+
+    return {'default': default, 'runs': runs, 'signatures': signatures}, headers
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Channel names and kinds without MNE
+
+Gives the channel names and kinds mne.io.read_raw_edf would report for an
+EDF with its default arguments, from the header dict of edfheader alone:
+duplicate labels get MNE's running numbers, 'status' / 'trigger' channels are
+stimulus channels and every other channel is EEG. MNE is only imported when
+the classification is explicitly asked to come from MNE.
+"""
+
+import string
+
+# Channel kinds as used by postbids.process_edf_files
+KINDS = ('eeg', 'eog', 'ecg', 'emg', 'stim', 'misc')
+
+# Names mne.io.read_raw_edf(stim_channel='auto') treats as stimulus channels
+STIM_NAMES = ('status', 'trigger')
+
+
+def unique_channel_names(names):
+    """ Channel names made unique the way MNE does it: duplicates get '-0', '-1', ... (or '-a', '-b', ... if taken) """
+    names = list(names)
+    counts = {}
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+
+    for stem in [name for name, count in counts.items() if count > 1]:
+        overlaps = [idx for idx, name in enumerate(names) if name == stem]
+        for number, idx in enumerate(overlaps):
+            for suffix in (number,) + tuple(string.ascii_lowercase):
+                candidate = f"{stem}-{suffix}"
+                if candidate not in names:
+                    break
+            names[idx] = candidate
+
+    return names
+
+
+def channel_kinds(header):
+    """ [(name, kind)] of the data channels of an EDF header, as MNE reads them """
+    names = unique_channel_names(channel['name'] for channel in header['channels'])
+    return [(name, 'stim' if name.lower() in STIM_NAMES else 'eeg') for name in names]
+
+
+def mne_channel_kinds(file):
+    """ [(name, kind)] of an EDF read with mne.io.read_raw_edf, for checking the header based kinds """
+    import mne
+    from mne.io.constants import FIFF
+
+    names = {
+        FIFF.FIFFV_EEG_CH: 'eeg',
+        FIFF.FIFFV_EOG_CH: 'eog',
+        FIFF.FIFFV_ECG_CH: 'ecg',
+        FIFF.FIFFV_EMG_CH: 'emg',
+        FIFF.FIFFV_STIM_CH: 'stim',
+    }
+    edffile = mne.io.read_raw_edf(file, verbose='CRITICAL')
+    try:
+        return [(channel['ch_name'], names.get(channel['kind'], 'misc')) for channel in edffile.info['chs']]
+    finally:
+        edffile.close()
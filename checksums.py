@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Inline checksums of the files a subject produces
+
+Every file is hashed with SHA-256 plus a fast non-cryptographic hash
+(xxh3_64 if the xxhash package is installed, zlib's CRC-32 otherwise) once,
+as it is written where the pipeline streams the bytes itself, or right after
+the pipeline is done with it. Hashes are cached by inode, keyed on size and
+modification time, so a file that is moved, renamed or hardlinked is never
+hashed again. The cache is kept in <subject folder>/checksum_cache.json and
+the manifest of every output path, checksums.json, is built from it.
+"""
+
+import io
+import os
+import json
+import zlib
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+MANIFEST_NAME = 'checksums.json'
+CACHE_NAME = 'checksum_cache.json'
+
+# Folders and files of the subject folder that are not outputs
+NOT_OUTPUTS = ('objects', MANIFEST_NAME, CACHE_NAME)
+
+FAST_HASH = 'xxh3_64' if xxhash is not None else 'crc32'
+
+CHUNK_BYTES = 1024 * 1024
+
+
+class StreamHasher:
+    """ SHA-256 and the fast hash of a stream of bytes """
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.fast = xxhash.xxh3_64() if xxhash is not None else None
+        self.crc = 0
+
+    def update(self, data):
+        self.sha256.update(data)
+        if self.fast is not None:
+            self.fast.update(data)
+        else:
+            self.crc = zlib.crc32(data, self.crc)
+
+    def digests(self):
+        """ {'sha256': hex, FAST_HASH: hex} """
+        fast = self.fast.hexdigest() if self.fast is not None else f"{self.crc:08x}"
+        return {'sha256': self.sha256.hexdigest(), FAST_HASH: fast}
+
+
+def hash_file(path):
+    """ Digests of a file, read once """
+    hasher = StreamHasher()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_BYTES), b''):
+            hasher.update(chunk)
+
+    return hasher.digests()
+
+
+class HashingWriter(io.RawIOBase):
+    """ Binary file that hashes everything written through it """
+
+    def __init__(self, raw, hasher=None):
+        self.raw = raw
+        self.hasher = hasher if hasher is not None else StreamHasher()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        written = self.raw.write(data)
+        self.hasher.update(memoryview(data)[:written])
+        return written
+
+    def close(self):
+        if not self.closed:
+            self.raw.close()
+        super().close()
+
+
+class ChecksumCache:
+    """ Digests of files by inode, valid while the size and modification time are unchanged; thread safe """
+
+    def __init__(self, subject_folder):
+        self.path = os.path.join(subject_folder, CACHE_NAME)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    @staticmethod
+    def key(stat):
+        return f"{stat.st_dev}:{stat.st_ino}"
+
+    def lookup(self, path):
+        """ Cached digests of a file as it is now, None if it changed or was never hashed """
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(self.key(stat))
+        if not entry or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns or FAST_HASH not in entry:
+            return None
+
+        return {'sha256': entry['sha256'], FAST_HASH: entry[FAST_HASH]}
+
+    def record(self, path, digests):
+        """ Remember the digests of a file that was just written """
+        stat = os.stat(path)
+        with self.lock:
+            self.entries[self.key(stat)] = dict(digests, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+    def same_content(self, source, destination):
+        """ Give a copy or clone the digests of its source, if they are known """
+        digests = self.lookup(source)
+        if digests is not None:
+            self.record(destination, digests)
+
+    def hash(self, path):
+        """ Digests of a file, from the cache or read once and remembered """
+        digests = self.lookup(path)
+        if digests is None:
+            digests = hash_file(path)
+            self.record(path, digests)
+
+        return digests
+
+    def save(self):
+        """ Atomically rewrite the cache file """
+        with self.lock:
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, self.path)
+
+
+@contextmanager
+def open_hashed(path, cache, mode='w', **kwargs):
+    """ open() for writing that hashes the bytes on their way to disk and records them in cache (if not None) """
+    if cache is None:
+        with open(path, mode, **kwargs) as f:
+            yield f
+        return
+
+    binary = 'b' in mode
+    writer = HashingWriter(open(path, mode.replace('t', '') + ('' if binary else 'b'), buffering=0))
+    buffered = io.BufferedWriter(writer, CHUNK_BYTES)
+    f = buffered if binary else io.TextIOWrapper(buffered, **kwargs)
+    try:
+        yield f
+    finally:
+        f.close()
+    cache.record(path, writer.hasher.digests())
+
+
+def output_files(subject_folder):
+    """ Paths, relative to the subject folder, of every file the subject hands on """
+    files = []
+    for folder, dirs, names in os.walk(subject_folder):
+        if folder == subject_folder:
+            dirs[:] = [name for name in dirs if name not in NOT_OUTPUTS]
+            names = [name for name in names if name not in NOT_OUTPUTS and not name.startswith(CACHE_NAME)]
+        dirs.sort()
+        files += [os.path.relpath(os.path.join(folder, name), subject_folder) for name in sorted(names)]
+
+    return files
+
+
+def manifest_entry(path, digests):
+    """ Manifest entry of a file: its digests and what tells whether it changed since """
+    stat = os.stat(path)
+    return dict(digests, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def read_manifest(subject_folder):
+    """ {relative path: {'size', 'mtime_ns', 'sha256', FAST_HASH}} of checksums.json, empty if there is none """
+    try:
+        with open(os.path.join(subject_folder, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(subject_folder, manifest):
+    """ Atomically rewrite checksums.json """
+    path = os.path.join(subject_folder, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def build_manifest(subject_folder, cache, workers=4):
+    """ Write checksums.json for every output file and return (files, files that had to be read) """
+    files = output_files(subject_folder)
+    missing = [relative for relative in files if cache.lookup(os.path.join(subject_folder, relative)) is None]
+
+    # Only files no stage hashed are read here
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        list(executor.map(lambda relative: cache.hash(os.path.join(subject_folder, relative)), missing))
+
+    manifest = {}
+    for relative in files:
+        path = os.path.join(subject_folder, relative)
+        manifest[relative] = manifest_entry(path, cache.lookup(path))
+    write_manifest(subject_folder, manifest)
+    cache.save()
+
+    return len(files), len(missing)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+MEF -> EDF conversion overlapped with the BIDS stages
+
+Runs the converter (mefstreamer.jar) on a subject folder as a subprocess and
+hands every EDF to postbids.run_subject as soon as the converter has finished
+it, so header de-identification, duration accounting and the move into the
+BIDS tree happen while the next runs are still being converted, and imaging,
+montages and annotations are placed alongside. An EDF counts as finished once
+no process of the converter has it open (read from /proc where available),
+its size has not changed for a few polls and its header record count, if the
+converter wrote one, matches the file size. Prints the new subject path like
+postbids.py does.
+"""
+
+import os
+import sys
+import glob
+import time
+import shlex
+import argparse
+import subprocess
+from contextlib import closing, nullcontext
+
+import postbids
+from edfheader import FIXED_HEADER_BYTES, HEADER_SPANS, parse_number, read_edf_header
+from journal import SubjectJournal
+from metrics import StageMetrics, STAGES
+from placement import PLACEMENT_MODES
+from dedupe import DUPLICATE_MODES
+from scratch import open_budget
+
+# {input} is the subject folder and {module} the module folder, as in edfandbid_creation.sh
+CONVERTER = 'java -jar {module}/mefstreamer.jar {input}'
+
+# Files the converter reads and edfandbid_creation.sh used to delete once it was done
+CONVERTER_INPUTS = ('*.mef', '*.xml')
+
+
+def parse_arguments():
+    """ Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Convert a subject folder from MEF to EDF and into BIDS, overlapping both.")
+
+    parser.add_argument('folder1', type=str, help="Path to the subject folder with the MEF files")
+    parser.add_argument('folder2', type=str, help="Path to the module folder (pipeline creation folder)")
+    parser.add_argument('type', type=str, choices=['ieeg', 'scalp'], help="Flag indicating data type: 'ieeg' or 'scalp'")
+    parser.add_argument('--converter', type=str, default=CONVERTER,
+                        help=f"Converter command, {{input}} and {{module}} are filled in (default: '{CONVERTER}')")
+    parser.add_argument('--poll', type=float, default=1.0, help="Seconds between looks at the subject folder (default: 1)")
+    parser.add_argument('--stable-polls', type=int, default=2,
+                        help="Polls an EDF size must stay the same before it counts as finished (default: 2)")
+    parser.add_argument('--placement', type=str, choices=PLACEMENT_MODES, default='auto', help="How imaging is placed into the BIDS tree (default: auto)")
+    parser.add_argument('--stream-imaging', action='store_true', help="Extract imaging straight from the zip archives in objects/")
+    parser.add_argument('--edf-workers', type=int, default=1, help="Threads for the finished EDF runs (default: 1)")
+    parser.add_argument('--split-events', action='store_true', help="Write one events.tsv per EDF run")
+    parser.add_argument('--merge-runs', action='store_true', help="Merge consecutive EDF runs into as few files as possible")
+    parser.add_argument('--max-run-mb', type=int, default=0, help="With --merge-runs, MiB per merged file (default: 0, no limit)")
+    parser.add_argument('--scratch-mb', type=int, default=0,
+                        help="Keep the subject folder under this many MiB, deleting intermediates as they are used (default: 0, no limit)")
+    parser.add_argument('--imaging-duplicates', type=str, choices=DUPLICATE_MODES, default='collapse',
+                        help="Imaging volumes with the same content as an earlier one (default: collapse)")
+    parser.add_argument('--mne-channels', action='store_true', help="Classify channels with MNE instead of from the EDF header")
+    parser.add_argument('--metrics', type=str, help="Append one JSON line per subject stage to this file, '-' for stderr")
+    parser.add_argument('--profile-stage', type=str, choices=STAGES, help="Run this stage under cProfile")
+    parser.add_argument('--profile-dir', type=str, default='.', help="Folder for cProfile output (default: current folder)")
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder2):
+        parser.error(f"{args.folder2} is not a valid pipeline directory.")
+    if args.stable_polls < 1:
+        parser.error("--stable-polls must be at least 1")
+
+    return args
+
+
+def converter_command(template, subject_folder, module_folder):
+    """ Argument list of the converter for a subject folder """
+    return [part.format(input=subject_folder, module=module_folder) for part in shlex.split(template)]
+
+
+def process_tree(pid):
+    """ pid and the pids of all its descendants, from /proc """
+    children = {}
+    for stat in glob.glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat) as f:
+                # The command name in parentheses may contain spaces, the parent pid is the second field after it
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.split('/')[2]))
+
+    tree = []
+    pending = [pid]
+    while pending:
+        tree.append(pending.pop())
+        pending += children.get(tree[-1], [])
+
+    return tree
+
+
+def open_files(pid):
+    """ Real paths of the files pid and its descendants have open, None where /proc does not tell """
+    if not os.path.isdir(f'/proc/{pid}/fd'):
+        return None
+
+    paths = set()
+    for tree_pid in process_tree(pid):
+        try:
+            fds = os.listdir(f'/proc/{tree_pid}/fd')
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                paths.add(os.readlink(f'/proc/{tree_pid}/fd/{fd}'))
+            except OSError:
+                continue
+
+    return paths
+
+
+def edf_size_matches(path):
+    """ False if the header record count says more data is to come, True if it matches the size, None if it is -1 """
+    try:
+        with open(path, 'rb') as f:
+            fixed = f.read(FIXED_HEADER_BYTES)
+        header = read_edf_header(path)
+    except (OSError, ValueError):
+        # No complete header yet
+        return False
+
+    offset, width = HEADER_SPANS['n_records']
+    n_records = parse_number(fixed[offset:offset + width].decode('latin-1'), int)
+    if n_records is None or n_records < 0:
+        return None
+
+    return os.path.getsize(path) == header['header_bytes'] + n_records * header['record_bytes']
+
+
+def finished_edfs(process, subject_folder, poll=1.0, stable_polls=2):
+    """ Yield every EDF the converter writes into the subject folder once it is finished, in run order per poll """
+    sizes = {}
+    finished = set()
+    while True:
+        running = process.poll() is None
+        in_use = open_files(process.pid) if running else set()
+        for path in sorted(postbids.find_files_by_type(subject_folder + '/', '.edf'), key=postbids.run_sort_key):
+            if path in finished:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except FileNotFoundError:
+                continue
+            last_size, polls = sizes.get(path, (None, 0))
+            polls = polls + 1 if size == last_size else 0
+            sizes[path] = (size, polls)
+            if running:
+                if in_use is not None and os.path.realpath(path) in in_use:
+                    continue
+                if polls < stable_polls or edf_size_matches(path) is False:
+                    continue
+            elif process.returncode != 0:
+                break
+            finished.add(path)
+            yield path
+
+        if not running:
+            break
+        time.sleep(poll)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"Converter exited with code {process.returncode}, {len(finished)} EDF runs were finished")
+
+
+def converted_edfs(command, subject_folder, poll=1.0, stable_polls=2, scratch=None):
+    """ Run the converter on the subject folder and yield its EDFs as they are finished
+
+    The converter reads every MEF input until it exits, with a scratch budget it holds the room they take until then.
+    """
+    with scratch.holding() if scratch is not None else nullcontext():
+        # stdout of this process only carries the new subject path, the converter's output goes to stderr
+        process = subprocess.Popen(command, stdout=sys.stderr)
+        try:
+            yield from finished_edfs(process, subject_folder, poll, stable_polls)
+            # The MEF inputs would otherwise end up in the EPS folder
+            for pattern in CONVERTER_INPUTS:
+                for path in glob.glob(os.path.join(subject_folder, pattern)):
+                    if scratch is not None:
+                        scratch.remove(path)
+                    else:
+                        os.remove(path)
+        finally:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+
+def needs_conversion(journal, subject_folder):
+    """ False if an earlier invocation already de-identified and moved every EDF of the subject """
+    if not os.path.isdir(subject_folder):
+        return False
+    # A finished subject that was downloaded again is processed from scratch
+    return not journal.done('edf') or journal.done('final_rename')
+
+
+def convert_subject(subject_folder, module_folder, data_type, converter=CONVERTER, poll=1.0, stable_polls=2, **options):
+    """ Convert a subject folder and run the BIDS stages on the EDFs as they come, return the renamed EPS path
+
+    options are passed on to postbids.run_subject.
+    """
+    subject_folder = subject_folder.rstrip('/')
+    module_folder = module_folder.rstrip('/')
+    if not needs_conversion(SubjectJournal(module_folder, subject_folder), subject_folder):
+        return postbids.run_subject(subject_folder, module_folder, data_type, **options)
+
+    command = converter_command(converter, subject_folder, module_folder)
+    with closing(converted_edfs(command, subject_folder, poll, stable_polls, options.get('scratch'))) as edf_source:
+        return postbids.run_subject(subject_folder, module_folder, data_type, edf_source=edf_source, **options)
+
+
+def main():
+    args = parse_arguments()
+
+    report = {}
+    metrics = StageMetrics(os.path.basename(args.folder1.rstrip('/')), args.metrics, args.profile_stage, args.profile_dir)
+    scratch = open_budget(args.folder1.rstrip('/'), args.scratch_mb * 1024 * 1024)
+    try:
+        new_path = convert_subject(args.folder1, args.folder2, args.type, args.converter, args.poll, args.stable_polls,
+                                   placement=args.placement, stream_imaging=args.stream_imaging,
+                                   edf_workers=args.edf_workers, report=report, metrics=metrics,
+                                   mne_channels=args.mne_channels, split_events=args.split_events,
+                                   duplicate_mode=args.imaging_duplicates, merge_runs=args.merge_runs,
+                                   max_run_bytes=args.max_run_mb * 1024 * 1024, scratch=scratch)
+    finally:
+        if scratch is not None:
+            scratch.close()
+
+    # stdout only carries the new path, which edfandbid_creation.sh captures
+    sys.stderr.write(postbids.format_imaging_report(report['imaging']) + '\n')
+    if 'scratch' in report:
+        sys.stderr.write(postbids.format_scratch_report(report['scratch']) + '\n')
+    sys.stdout.write(new_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Content-addressed de-duplication of candidate files
+
+Finds which candidates have the same content as an earlier one in three
+rounds of increasing cost, each applied only to the candidates the previous
+rounds could not tell apart: the size, a hash of the first and last
+PREFILTER_BYTES, and the full SHA-256. A candidate with a unique size is
+never read, and only real duplicates (and the rare prefilter collisions)
+are hashed in full.
+"""
+
+import os
+import hashlib
+
+from checksums import hash_file
+
+# 'collapse' places a duplicate once, 'link' keeps its run as a link to the first copy, 'off' does not look
+DUPLICATE_MODES = ('collapse', 'link', 'off')
+
+PREFILTER_BYTES = 64 * 1024
+
+
+def partial_digest(path):
+    """ SHA-256 of the first and last PREFILTER_BYTES of a file """
+    size = os.path.getsize(path)
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        digest.update(f.read(PREFILTER_BYTES))
+        if size > PREFILTER_BYTES:
+            f.seek(max(size - PREFILTER_BYTES, PREFILTER_BYTES))
+            digest.update(f.read(PREFILTER_BYTES))
+
+    return digest.hexdigest()
+
+
+def split_groups(groups, key):
+    """ Split every group of candidates by key, dropping the candidates left alone """
+    split = []
+    for group in groups:
+        by_key = {}
+        for candidate in group:
+            by_key.setdefault(key(candidate), []).append(candidate)
+        split += [members for members in by_key.values() if len(members) > 1]
+
+    return split
+
+
+def find_duplicates(candidates, keys):
+    """ {candidate: first candidate with the same content} for every candidate that repeats an earlier one
+
+    keys go from the cheapest to the full hash, the last one decides.
+    """
+    groups = [list(candidates)]
+    for key in keys:
+        groups = split_groups(groups, key)
+
+    duplicates = {}
+    for group in groups:
+        for candidate in group[1:]:
+            duplicates[candidate] = group[0]
+
+    return duplicates
+
+
+def file_duplicates(paths, full_hash=None):
+    """ Duplicates among files on disk, see find_duplicates; full_hash(path) defaults to the SHA-256 of the file """
+    if full_hash is None:
+        full_hash = lambda path: hash_file(path)['sha256']
+    return find_duplicates(paths, (os.path.getsize, partial_digest, full_hash))
+
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+In-place EDF header de-identification
+
+Patches the patient ID, recording ID and start date/time fields of EDF files
+through a memory map of the 256 byte fixed header, verifies every patch by
+re-reading the header bytes, and returns one audit record per file. Data
+records are never read, and re-running on already de-identified files is a
+no-op.
+"""
+
+import os
+import mmap
+from datetime import datetime
+
+from edfheader import HEADER_SPANS, FIXED_HEADER_BYTES, read_edf_header
+
+# Every subject's recordings are shifted so that the first day becomes 01.01.2000 (the ses-01012000 session)
+ANCHOR_DATE = datetime(2000, 1, 1)
+
+
+def encode_field(name, value):
+    """ Encode a header value as space padded ASCII of the field width """
+    width = HEADER_SPANS[name][1]
+    encoded = value.encode('ascii')
+    if len(encoded) > width:
+        raise ValueError(f"'{value}' does not fit in the {width} byte EDF {name} field")
+
+    return encoded + b' ' * (width - len(encoded))
+
+
+def is_deidentified(header, eps_string):
+    """ True if the header already carries the patched patient field, its dates are shifted already """
+    return header['patient_id'] in (eps_string, f"{eps_string} X X X")
+
+
+def day_anchor(starts):
+    """ Midnight of the earliest of some recording starts, None if there is none """
+    starts = [start for start in starts if start is not None]
+    if not starts:
+        return None
+
+    return datetime.combine(min(starts).date(), datetime.min.time())
+
+
+def subject_anchor(headers, eps_string=None):
+    """ Midnight of the earliest recording day of a subject, None if no header has a valid start """
+    return day_anchor(header['start'] for header in headers if not (eps_string and is_deidentified(header, eps_string)))
+
+
+def shifted_start(header, eps_string, anchor=None):
+    """ Start a header gets once de-identified, every run shifted by the same offset from anchor """
+    if header['start'] is not None and is_deidentified(header, eps_string):
+        return header['start']
+    if header['start'] is not None and anchor is not None:
+        return ANCHOR_DATE + (header['start'] - anchor)
+
+    return ANCHOR_DATE
+
+
+def deidentified_fields(header, eps_string, anchor=None, shift_dates=True):
+    """ New values for the identifying header fields of one file """
+    # EDF+ requires 'code sex birthdate name' and 'Startdate ...' subfields, X marks them unknown
+    if header['edf_plus']:
+        fields = {'patient_id': f"{eps_string} X X X", 'recording_id': "Startdate X X X X"}
+    else:
+        fields = {'patient_id': eps_string, 'recording_id': "Startdate X X X X"}
+
+    if shift_dates:
+        # Shift every run by the same offset so time of day and gaps between runs are preserved
+        start = shifted_start(header, eps_string, anchor)
+        fields['startdate'] = start.strftime('%d.%m.%y')
+        fields['starttime'] = start.strftime('%H.%M.%S')
+
+    return fields
+
+
+def patch_header(file, fields):
+    """ Write header fields in place through a memory map, return the names of the fields that changed """
+    changed = []
+    with open(file, 'r+b') as f:
+        with mmap.mmap(f.fileno(), FIXED_HEADER_BYTES, access=mmap.ACCESS_WRITE) as mm:
+            for name, value in fields.items():
+                offset, width = HEADER_SPANS[name]
+                new_bytes = encode_field(name, value)
+                if mm[offset:offset + width] != new_bytes:
+                    mm[offset:offset + width] = new_bytes
+                    changed.append(name)
+            if changed:
+                mm.flush()
+
+    return changed
+
+
+def verify_header(file, fields):
+    """ Re-read only the fixed header and return the names of fields that do not hold the expected value """
+    with open(file, 'rb') as f:
+        raw = f.read(FIXED_HEADER_BYTES)
+
+    mismatched = []
+    for name, value in fields.items():
+        offset, width = HEADER_SPANS[name]
+        if raw[offset:offset + width] != encode_field(name, value):
+            mismatched.append(name)
+
+    return mismatched
+
+
+def deidentify_edf_file(file, header, eps_string, anchor=None, shift_dates=True):
+    """ Patch and verify the header of one EDF file and return its audit record """
+    fields = deidentified_fields(header, eps_string, anchor, shift_dates)
+    changed = patch_header(file, fields)
+    mismatched = verify_header(file, fields)
+
+    return {
+        'file': os.path.basename(file),
+        'changed': changed,
+        'unchanged': [name for name in fields if name not in changed],
+        'verified': not mismatched,
+        'mismatched': mismatched,
+        'values': fields,
+    }
+
+
+def reshift_edf_file(file, start):
+    """ Patch and verify the start of an already de-identified EDF again, to the shifted start it has from a new anchor """
+    fields = {'startdate': start.strftime('%d.%m.%y'), 'starttime': start.strftime('%H.%M.%S')}
+    changed = patch_header(file, fields)
+
+    return fields, changed, verify_header(file, fields)
+
+
+def deidentify_edf_files(files, eps_string, shift_dates=True, headers=None):
+    """ De-identify the headers of all EDF files of a subject and return one audit record per file """
+    if headers is None:
+        headers = [read_edf_header(file) for file in files]
+    anchor = subject_anchor(headers, eps_string)
+
+    return [deidentify_edf_file(file, header, eps_string, anchor, shift_dates)
+            for file, header in zip(files, headers)]
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keyed lookup for deidentified_data.csv
+
+Parses the pipeline folder's deidentified_data.csv once into a dict keyed by
+normalized HUP number (digits only, no leading zeros), so finding a subject's
+participant rows and MRI date is a dict access instead of a pandas parse and a
+full column scan per subject. Optionally a pickled snapshot of the parsed
+index is kept next to the CSV and reused while the CSV's sha256 is unchanged.
+"""
+
+import os
+import re
+import csv
+import pickle
+import hashlib
+
+CSV_NAME = 'deidentified_data.csv'
+SNAPSHOT_NAME = 'deidentified_data.pickle'
+SNAPSHOT_VERSION = 1
+MRI_DATE_COLUMN = 'MRI Date:'
+
+
+def normalize_hup_number(value):
+    """ Digits of a HUP number without leading zeros: 'HUP0199', '199' and '0199' are all '199' """
+    digits = re.sub(r"[^0-9]", "", str(value))
+    return re.sub(r"^0+(?!$)", "", digits)
+
+
+def file_sha256(path):
+    """ sha256 of a file, read in 1 MiB blocks """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def parse_deidentified_csv(path):
+    """ Parse the CSV into {'header': [...], 'rows': {hup number: [row, ...]}} """
+    rows = {}
+    with open(path, newline='', encoding='latin1') as csvfile:
+        reader = csv.reader(csvfile)
+        header = next(reader, [])
+        for row in reader:
+            if not row:
+                continue
+            key = normalize_hup_number(row[0])
+            if key:
+                rows.setdefault(key, []).append(row)
+
+    return {'header': header, 'rows': rows}
+
+
+def load_deidentified_index(pipeline_folder, use_snapshot=False):
+    """ Load the keyed index of deidentified_data.csv, reusing the pickled snapshot if asked and still valid """
+    path = os.path.join(pipeline_folder, CSV_NAME)
+    if not use_snapshot:
+        return parse_deidentified_csv(path)
+
+    sha256 = file_sha256(path)
+    snapshot_path = os.path.join(pipeline_folder, SNAPSHOT_NAME)
+    try:
+        with open(snapshot_path, 'rb') as f:
+            snapshot = pickle.load(f)
+        if snapshot.get('version') == SNAPSHOT_VERSION and snapshot.get('sha256') == sha256:
+            return snapshot['index']
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, KeyError):
+        pass
+
+    index = parse_deidentified_csv(path)
+    tmp = f"{snapshot_path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        pickle.dump({'version': SNAPSHOT_VERSION, 'sha256': sha256, 'index': index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, snapshot_path)
+
+    return index
+
+
+def lookup_participant(index, hup_number):
+    """ (rows, mri_date) for a HUP number; no rows and an empty date if the subject is not listed """
+    rows = index['rows'].get(normalize_hup_number(hup_number), [])
+    mri_date = ''
+    if rows and MRI_DATE_COLUMN in index['header']:
+        column = index['header'].index(MRI_DATE_COLUMN)
+        if column < len(rows[0]):
+            mri_date = rows[0][column]
+
+    return rows, mri_date
@@ -16,10 +16,6 @@ type="$3"
 objectstr="/objects/"
 objectsfolder="${inputfolder}${objectstr}"
 
-############  Run jar file that converts mef to edf ######################################################
-java -jar ${modulefolder}/mefstreamer.jar ${inputfolder}
-
-
 ############ Delete reconstruction directory ###############################################################
 reconstring="recon"
 find "$objectsfolder" -type f -iname "*$reconstring*.zip" -print |
@@ -30,50 +26,23 @@ while IFS= read -r zipfile; do
   rm "$zipfile" && echo "Deleted: $zipfile" || echo "Failed to delete: $zipfile"
 done
 
-############### Remove mef and any other files ###########################################
-rm -f ${inputfolder}/*.mef
-rm -f ${inputfolder}/*.xml
-
-############  Unzip any folders within the input folder ##################################################
-# Debugging: List the zip files found in the input folder
-imagstring="/imaging/"
-mkdir ${objectsfolder}/imaging
-echo "Looking for zip files in $objectsfolder"
-
-find "$objectsfolder" -type f -name "*.zip" -print
-find "$objectsfolder" -type f -name "*.zip" | while IFS= read -r file; do
-  echo "Unzipping: $file"
-  
-  # Unzip each zip file into its own directory
-  #unzip -o -q "$file" -d "$(dirname "$file")" && echo "Successfully unzipped: $file" || echo "Failed to unzip: $file"
-  unzip -o -q "$file" -d "$(dirname "$file")/$imagstring" && echo "Successfully unzipped: $file" || echo "Failed to unzip: $file"
-
-done
-
-find "$objectsfolder" -type d -name "*MACOSX*" -print0 | xargs -0 rm -rf
-
-########### If imaging folder exists, unzip any files ####################################################
-imagingfolder=$(find "$objectsfolder" -type d -iname "*imag*")
-echo "Imaging folder found: $imagingfolder"  # Debugging line
-if [ -z "$imagingfolder" ]; then
-   echo "No imaging folder found"
-else
-  cd "$imagingfolder"
-  find . -mindepth 2 -type f -exec mv {} "${objectsfolder}/imaging/" \;
-  for file in *.nii.gz; do
-     gunzip "$file"
-  done
-  cd ..
-  rm -f ${imagingfolder}.zip
-fi
+############  Imaging zips are extracted by postbids.py (--stream-imaging) #################################
+# Each volume is streamed out of its archive, gunzipped on the fly and written once, straight to its BIDS path
 
-########### Run python script that puts everything into BIDs #############################################
+########### Convert mef to edf and put everything into BIDs ###############################################
+# convertbids.py runs mefstreamer.jar and puts every EDF into BIDs as soon as the jar has finished it,
+# imaging, montages and annotations are placed while the conversion runs; .mef and .xml files are removed after it
 # Install dependencies
 pip3 install --no-cache-dir -r /home/ec2-user/migrationtools/requirements.txt
-new_path=$(python3 "${modulefolder}/postbids.py" "$inputfolder" "$modulefolder" "$type" | xargs)
+new_path=$(python3 "${modulefolder}/convertbids.py" "$inputfolder" "$modulefolder" "$type" --stream-imaging | xargs)
   
 echo "$new_path"
 ############# Remove object folder and move everything else to derivative  ####
 rm -r ${new_path}/objects
 
+############# Upload Primary and Derivative when a destination bucket is set (UPLOAD_BUCKET, UPLOAD_PREFIX) ####
+if [ -n "$UPLOAD_BUCKET" ]; then
+  python3 "${modulefolder}/upload.py" "$new_path" --bucket "$UPLOAD_BUCKET" --prefix "${UPLOAD_PREFIX:-}"
+fi
+
 echo "Finished edf conversion and bids creation"
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Header-only EDF/EDF+ reader
+
+Reads the fixed 256 byte EDF header plus the 256 bytes per signal that follow
+it and returns the recording metadata as a plain dict, without touching any
+data records.
+"""
+
+import os
+import re
+from datetime import datetime
+
+# (field, width) of the fixed part of the header, in file order
+HEADER_FIELDS = [
+    ('version', 8),
+    ('patient_id', 80),
+    ('recording_id', 80),
+    ('startdate', 8),
+    ('starttime', 8),
+    ('header_bytes', 8),
+    ('reserved', 44),
+    ('n_records', 8),
+    ('record_duration', 8),
+    ('n_signals', 4),
+]
+
+# (field, width) of each per-signal block; every block stores all signals back to back
+SIGNAL_FIELDS = [
+    ('label', 16),
+    ('transducer', 80),
+    ('units', 8),
+    ('physical_min', 8),
+    ('physical_max', 8),
+    ('digital_min', 8),
+    ('digital_max', 8),
+    ('prefilter', 80),
+    ('samples_per_record', 8),
+    ('signal_reserved', 32),
+]
+
+FIXED_HEADER_BYTES = 256
+SIGNAL_HEADER_BYTES = 256
+ANNOTATION_LABELS = ('EDF Annotations', 'BDF Annotations')
+
+FILTER_PATTERN = re.compile(r'(HP|LP)\s*:\s*([0-9]*\.?[0-9]+)\s*(k?Hz)?', re.IGNORECASE)
+
+
+def field_spans(fields):
+    """ Map each (field, width) to its (offset, width) when the fields are stored back to back """
+    spans = {}
+    offset = 0
+    for name, width in fields:
+        spans[name] = (offset, width)
+        offset += width
+
+    return spans
+
+
+# (offset, width) of every field in the fixed header
+HEADER_SPANS = field_spans(HEADER_FIELDS)
+
+
+def parse_number(text, cast=float):
+    """ Parse an ASCII header number, returning None for blank or malformed fields """
+    try:
+        return cast(text.strip())
+    except ValueError:
+        return None
+
+
+def parse_prefilter(prefilter, sampling_frequency):
+    """ Return (lowpass, highpass) in Hz from an EDF prefiltering string such as 'HP:0.1Hz LP:75Hz' """
+    lowpass = None
+    highpass = None
+    for kind, value, unit in FILTER_PATTERN.findall(prefilter):
+        value = float(value)
+        if unit and unit.lower() == 'khz':
+            value *= 1000
+        if kind.upper() == 'LP':
+            lowpass = value
+        else:
+            highpass = value
+
+    # Same defaults MNE uses when the header does not say
+    if lowpass is None and sampling_frequency:
+        lowpass = sampling_frequency / 2
+    if highpass is None:
+        highpass = 0.0
+
+    return lowpass, highpass
+
+
+def parse_start(startdate, starttime):
+    """ Start of the recording from the dd.mm.yy and hh.mm.ss fields, None if unparseable """
+    try:
+        day, month, year = (int(x) for x in startdate.split('.'))
+        hour, minute, second = (int(x) for x in starttime.split('.'))
+    except ValueError:
+        return None
+    # EDF spec: 85-99 are 1985-1999, 00-84 are 2000-2084
+    year += 1900 if year >= 85 else 2000
+    try:
+        return datetime(year, month, day, hour, minute, second)
+    except ValueError:
+        return None
+
+
+def parse_edf_header(raw, file_size=None):
+    """ Parse EDF header bytes (fixed header plus signal headers) into a metadata dict """
+    header = {}
+    offset = 0
+    for name, width in HEADER_FIELDS:
+        header[name] = raw[offset:offset + width].decode('latin-1')
+        offset += width
+
+    bdf = raw[:1] == b'\xff'
+    n_signals = parse_number(header['n_signals'], int) or 0
+    signals = {}
+    for name, width in SIGNAL_FIELDS:
+        signals[name] = [raw[offset + i * width:offset + (i + 1) * width].decode('latin-1').strip()
+                         for i in range(n_signals)]
+        offset += width * n_signals
+
+    if len(raw) < offset:
+        raise ValueError(f"EDF header is truncated: expected {offset} bytes, got {len(raw)}")
+
+    header_bytes = parse_number(header['header_bytes'], int) or offset
+    record_duration = parse_number(header['record_duration']) or 0.0
+    n_records = parse_number(header['n_records'], int)
+    samples_per_record = [parse_number(n, int) or 0 for n in signals['samples_per_record']]
+    bytes_per_sample = 3 if bdf else 2
+    record_bytes = sum(samples_per_record) * bytes_per_sample
+
+    # n_records is -1 while a recording is still being written, fall back to the file size
+    if (n_records is None or n_records < 0) and file_size is not None and record_bytes:
+        n_records = (file_size - header_bytes) // record_bytes
+
+    channels = []
+    for idx in range(n_signals):
+        label = signals['label'][idx]
+        rate = samples_per_record[idx] / record_duration if record_duration else None
+        lowpass, highpass = parse_prefilter(signals['prefilter'][idx], rate)
+        channels.append({
+            'name': label,
+            'transducer': signals['transducer'][idx],
+            'units': signals['units'][idx],
+            'physical_min': parse_number(signals['physical_min'][idx]),
+            'physical_max': parse_number(signals['physical_max'][idx]),
+            'digital_min': parse_number(signals['digital_min'][idx], int),
+            'digital_max': parse_number(signals['digital_max'][idx], int),
+            'prefilter': signals['prefilter'][idx],
+            'samples_per_record': samples_per_record[idx],
+            'sampling_frequency': rate,
+            'lowpass': lowpass,
+            'highpass': highpass,
+            'annotation': label in ANNOTATION_LABELS,
+        })
+
+    data_channels = [ch for ch in channels if not ch['annotation']]
+    rates = [ch['sampling_frequency'] for ch in data_channels if ch['sampling_frequency']]
+    reserved = header['reserved'].strip()
+
+    return {
+        'version': header['version'].strip(),
+        'patient_id': header['patient_id'].strip(),
+        'recording_id': header['recording_id'].strip(),
+        'startdate': header['startdate'],
+        'starttime': header['starttime'],
+        'start': parse_start(header['startdate'], header['starttime']),
+        'header_bytes': header_bytes,
+        'reserved': reserved,
+        'edf_plus': reserved[:5] if reserved.startswith(('EDF+', 'BDF+')) else None,
+        'bdf': bdf,
+        'n_records': n_records,
+        'record_duration': record_duration,
+        'record_bytes': record_bytes,
+        'n_signals': n_signals,
+        'channels': data_channels,
+        'annotation_channels': [ch for ch in channels if ch['annotation']],
+        'sampling_frequency': max(rates) if rates else None,
+        'duration': n_records * record_duration if n_records is not None else None,
+    }
+
+
+def read_edf_header(file):
+    """ Read only the header of an EDF/EDF+/BDF file and return its metadata dict """
+    with open(file, 'rb') as f:
+        fixed = f.read(FIXED_HEADER_BYTES)
+        if len(fixed) < FIXED_HEADER_BYTES:
+            raise ValueError(f"{file} is too short to be an EDF file")
+        n_signals = parse_number(fixed[252:256].decode('latin-1'), int)
+        if n_signals is None or n_signals < 0:
+            raise ValueError(f"{file} has an invalid number of signals in its header")
+        raw = fixed + f.read(n_signals * SIGNAL_HEADER_BYTES)
+        file_size = os.fstat(f.fileno()).st_size
+
+    header = parse_edf_header(raw, file_size)
+    header['path'] = file
+    header['file_size'] = file_size
+
+    return header
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Record-level merge and re-split of EDF runs
+
+Groups consecutive runs whose signal headers are byte for byte identical and
+writes them out again as fewer, larger files, or as files of at most a
+target size, by copying their data records as raw bytes: samples are never
+decoded and only the header is rewritten (number of records, start). Runs
+that follow each other without a gap give a plain continuous file; a file
+whose records have gaps becomes EDF+D (BDF+D) with an annotation signal whose
+time-keeping TAL gives the onset of every record. The original segments are
+returned with the file and onset they ended up at.
+"""
+
+import math
+from fractions import Fraction
+from datetime import timedelta
+
+from edfheader import HEADER_SPANS, SIGNAL_FIELDS, FIXED_HEADER_BYTES, SIGNAL_HEADER_BYTES, read_edf_header
+
+# Start times in the header have a resolution of one second, a run starting within it of the end of the
+# previous one continues it
+CONTIGUOUS_SECONDS = 1
+
+# Bytes of the annotation signal per record, enough for the time-keeping TAL of a record of any onset
+TAL_BYTES = 32
+
+COPY_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def read_segment(path, run):
+    """ One EDF run as a merge segment: its parsed header, raw header bytes and record layout """
+    header = read_edf_header(path)
+    with open(path, 'rb') as f:
+        raw = f.read(header['header_bytes'])
+    offset, width = HEADER_SPANS['record_duration']
+    duration = Fraction(raw[offset:offset + width].decode('latin-1').strip())
+
+    return {'path': path, 'run': run, 'header': header, 'raw': raw, 'start': header['start'],
+            'n_records': header['n_records'] or 0, 'record_bytes': header['record_bytes'], 'record_duration': duration}
+
+
+def signal_signature(segment):
+    """ Header bytes that have to be identical for two runs to share a file: format, record duration, signals """
+    raw = segment['raw']
+    version, reserved, duration = (raw[offset:offset + width] for offset, width in
+                                   (HEADER_SPANS['version'], HEADER_SPANS['reserved'], HEADER_SPANS['record_duration']))
+    return version + reserved + duration + raw[FIXED_HEADER_BYTES - 4:]
+
+
+def mergeable(segment):
+    """ Only plain EDF/BDF runs with a start and whole records are merged, EDF+ runs keep their own annotations """
+    header = segment['header']
+    return (segment['start'] is not None and not header['edf_plus'] and not header['annotation_channels']
+            and segment['record_bytes'] > 0 and segment['record_duration'] > 0)
+
+
+def group_segments(segments):
+    """ Split run ordered segments into groups that can share files, each segment with its onset in the group
+
+    Onsets are seconds from the start of the first segment of the group; a segment that starts before the previous
+    one ended, has other signals, or cannot be merged starts a new group.
+    """
+    groups = []
+    previous = None
+    for segment in segments:
+        offset = None
+        if previous is not None and mergeable(segment) and mergeable(previous[-1]['segment']) \
+                and signal_signature(segment) == signal_signature(previous[-1]['segment']):
+            last = previous[-1]
+            end = last['onset'] + last['segment']['n_records'] * last['segment']['record_duration']
+            actual = Fraction((segment['start'] - previous[0]['segment']['start']).total_seconds())
+            if abs(actual - end) < CONTIGUOUS_SECONDS:
+                offset = end
+            elif actual > end:
+                offset = actual
+        if offset is None:
+            previous = [{'segment': segment, 'onset': Fraction(0)}]
+            groups.append(previous)
+        else:
+            previous.append({'segment': segment, 'onset': offset})
+
+    return groups
+
+
+def records_per_file(segment, max_bytes):
+    """ Records in a file of at most max_bytes, a multiple of the records that span whole seconds """
+    if not max_bytes:
+        return None
+    # Files are cut where a record starts on a whole second, so their start fits the header
+    step = segment['record_duration'].denominator
+    records = (max_bytes - segment['header']['header_bytes'] - SIGNAL_HEADER_BYTES) // (segment['record_bytes'] + TAL_BYTES)
+
+    return max(step, records - records % step)
+
+
+def plan_files(segments, max_bytes=0):
+    """ Files the segments are written to, in order, as {'pieces', 'start', 'onset', 'annotated'}
+
+    Every piece is (segment, first record, records, onset of its first record in seconds from the file start). A
+    file that is a whole segment and needs no rewrite has 'unchanged' set.
+    """
+    files = []
+    for group in group_segments(segments):
+        first = group[0]['segment']
+        limit = records_per_file(first, max_bytes)
+        current = None
+        for member in group:
+            segment = member['segment']
+            record = 0
+            while True:
+                if current is None or (limit and current['records'] >= limit):
+                    onset = member['onset'] + record * segment['record_duration']
+                    current = {'pieces': [], 'records': 0, 'onset': onset, 'first': first}
+                    files.append(current)
+                count = segment['n_records'] - record
+                if limit:
+                    count = min(count, limit - current['records'])
+                onset = member['onset'] + record * segment['record_duration'] - current['onset']
+                current['pieces'].append((segment, record, count, onset))
+                current['records'] += count
+                record += count
+                if record >= segment['n_records']:
+                    break
+
+    for planned in files:
+        # The header start has whole seconds, a file starting in between or with gaps gets time-keeping TALs
+        whole = math.floor(planned['onset'])
+        planned['start'] = planned['first']['start'] + timedelta(seconds=whole)
+        shift = planned['onset'] - whole
+        pieces = []
+        expected = Fraction(0)
+        gaps = False
+        for segment, record, count, onset in planned['pieces']:
+            gaps = gaps or onset != expected
+            expected = onset + count * segment['record_duration']
+            pieces.append((segment, record, count, onset + shift))
+        planned['pieces'] = pieces
+        planned['gaps'] = gaps
+        planned['annotated'] = gaps or shift != 0
+        segment, record, count, onset = pieces[0]
+        planned['unchanged'] = (len(pieces) == 1 and record == 0 and count == segment['n_records']
+                                and not planned['annotated'])
+        del planned['first'], planned['onset']
+
+    return files
+
+
+def encode(value, width):
+    """ Space padded ASCII of a header field """
+    encoded = value.encode('latin-1')
+    if len(encoded) > width:
+        raise ValueError(f"'{value}' does not fit in a {width} byte EDF header field")
+
+    return encoded + b' ' * (width - len(encoded))
+
+
+def edf_plus_patient(patient_id):
+    """ Patient field in the EDF+ 'code sex birthdate name' form """
+    return patient_id if len(patient_id.split()) >= 4 else f"{patient_id} X X X"
+
+
+def annotation_samples(bdf):
+    """ Samples per record of the annotation signal """
+    return -(-TAL_BYTES // (3 if bdf else 2))
+
+
+def file_header(planned):
+    """ Header bytes of a planned file, from the header of its first segment """
+    segment = planned['pieces'][0][0]
+    raw = bytearray(segment['raw'])
+    header = segment['header']
+    n_records = sum(count for _, _, count, _ in planned['pieces'])
+
+    fields = {'n_records': str(n_records), 'startdate': planned['start'].strftime('%d.%m.%y'),
+              'starttime': planned['start'].strftime('%H.%M.%S')}
+    if not planned['annotated']:
+        for name, value in fields.items():
+            offset, width = HEADER_SPANS[name]
+            raw[offset:offset + width] = encode(value, width)
+        return bytes(raw)
+
+    # An annotation signal is added after the data signals, every per-signal field gets one more entry
+    bdf = header['bdf']
+    n_signals = header['n_signals']
+    annotation = {
+        'label': 'BDF Annotations' if bdf else 'EDF Annotations',
+        'physical_min': '-1',
+        'physical_max': '1',
+        'digital_min': '-8388608' if bdf else '-32768',
+        'digital_max': '8388607' if bdf else '32767',
+        'samples_per_record': str(annotation_samples(bdf)),
+    }
+    signals = b''
+    offset = FIXED_HEADER_BYTES
+    for name, width in SIGNAL_FIELDS:
+        signals += raw[offset:offset + width * n_signals] + encode(annotation.get(name, ''), width)
+        offset += width * n_signals
+
+    recording_id = header['recording_id'] if header['recording_id'].startswith('Startdate') else "Startdate X X X X"
+    fields.update({
+        'patient_id': edf_plus_patient(header['patient_id']),
+        'recording_id': recording_id,
+        'header_bytes': str(FIXED_HEADER_BYTES + SIGNAL_HEADER_BYTES * (n_signals + 1)),
+        'reserved': ('BDF+D' if bdf else 'EDF+D') if planned['gaps'] else ('BDF+C' if bdf else 'EDF+C'),
+        'n_signals': str(n_signals + 1),
+    })
+    for name, value in fields.items():
+        offset, width = HEADER_SPANS[name]
+        raw[offset:offset + width] = encode(value, width)
+
+    return bytes(raw[:FIXED_HEADER_BYTES]) + signals
+
+
+def file_bytes(planned):
+    """ Size of a planned file on disk """
+    bdf = planned['pieces'][0][0]['header']['bdf']
+    tal_size = annotation_samples(bdf) * (3 if bdf else 2) if planned['annotated'] else 0
+
+    return len(file_header(planned)) + sum(count * (segment['record_bytes'] + tal_size)
+                                           for segment, record, count, onset in planned['pieces'])
+
+
+def tal(onset, size):
+    """ Annotation signal bytes of one record: its time-keeping TAL, zero padded """
+    text = f"{float(onset):.6f}".rstrip('0').rstrip('.')
+    encoded = f"+{text}\x14\x14\x00".encode('ascii')
+    if len(encoded) > size:
+        raise ValueError(f"Record onset {text} does not fit in the annotation signal")
+
+    return encoded + b'\x00' * (size - len(encoded))
+
+
+def write_file(planned, out):
+    """ Write a planned file to the binary file out, copying the data records of its pieces as raw bytes """
+    out.write(file_header(planned))
+    bdf = planned['pieces'][0][0]['header']['bdf']
+    tal_size = annotation_samples(bdf) * (3 if bdf else 2)
+    for segment, record, count, onset in planned['pieces']:
+        record_bytes = segment['record_bytes']
+        chunk_records = max(1, COPY_CHUNK_BYTES // record_bytes)
+        with open(segment['path'], 'rb') as f:
+            f.seek(segment['header']['header_bytes'] + record * record_bytes)
+            done = 0
+            while done < count:
+                n = min(chunk_records, count - done)
+                data = f.read(n * record_bytes)
+                if len(data) != n * record_bytes:
+                    raise IOError(f"{segment['path']} ends before its record {record + done + n}")
+                if not planned['annotated']:
+                    out.write(data)
+                else:
+                    view = memoryview(data)
+                    for idx in range(n):
+                        out.write(view[idx * record_bytes:(idx + 1) * record_bytes])
+                        out.write(tal(onset + (done + idx) * segment['record_duration'], tal_size))
+                done += n
+
+
+def segment_listing(files, names):
+    """ Where every original segment went: one row per piece with its file, onset in the file, duration and start """
+    rows = []
+    for planned, name in zip(files, names):
+        for segment, record, count, onset in planned['pieces']:
+            start = segment['start'] + timedelta(seconds=float(record * segment['record_duration']))
+            rows.append({'filename': name, 'onset': float(onset), 'duration': float(count * segment['record_duration']),
+                         'segment': segment['run'], 'first_record': record, 'acq_time': start.isoformat()})
+
+    return rows
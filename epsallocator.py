@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrency-safe EPS identifier allocator
+
+EPS numbers are handed out from a SQLite file in the pipeline folder instead
+of the read-increment-write of epsnumber.csv. Every allocation runs in an
+immediate (write locked) transaction, so any number of worker processes can
+share the store. Workers lease blocks of numbers to keep the shared counter
+cold, unused numbers of released or expired leases are handed out again, and
+every subject -> EPS assignment is recorded so re-running a subject returns
+the number it already has.
+
+epsnumber.csv is only read to seed a new store and is then kept up to date as
+the high-water mark of numbers taken from the counter.
+"""
+
+import os
+import csv
+import time
+import socket
+import sqlite3
+from contextlib import contextmanager
+from urllib.parse import quote
+
+STORE_NAME = 'epsnumber.sqlite'
+CSV_NAME = 'epsnumber.csv'
+
+# Unreleased leases of crashed workers become reclaimable after this many seconds
+LEASE_SECONDS = 24 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS counter (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    last INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    lease_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    owner TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    next INTEGER NOT NULL,
+    expires REAL NOT NULL,
+    released INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    subject TEXT PRIMARY KEY,
+    number INTEGER NOT NULL UNIQUE,
+    lease_id INTEGER,
+    assigned REAL NOT NULL
+);
+'''
+
+
+def format_eps(number):
+    """ EPS identifier for a number, zero padded to 7 digits """
+    return f"EPS{str(number).zfill(7)}"
+
+
+def read_eps_csv(pipeline_folder):
+    """ Last EPS number used according to epsnumber.csv """
+    with open(os.path.join(pipeline_folder, CSV_NAME), newline='', encoding='utf-8-sig') as csvfile:
+        row = next(csv.reader(csvfile))
+    return int(row[0])
+
+
+def write_eps_csv(pipeline_folder, number):
+    """ Atomically replace epsnumber.csv with a new high-water mark """
+    epscsv = os.path.join(pipeline_folder, CSV_NAME)
+    tmp = f"{epscsv}.{os.getpid()}.tmp"
+    with open(tmp, mode='w', newline='') as csvfile:
+        csv.writer(csvfile).writerow([number])
+    os.replace(tmp, epscsv)
+
+
+def lookup_assignment(pipeline_folder, subject):
+    """ EPS identifier already assigned to a subject, read without a lock or a write; None if there is none """
+    path = os.path.join(pipeline_folder, STORE_NAME)
+    if not os.path.isfile(path):
+        return None
+    db = sqlite3.connect(f"file:{quote(path)}?mode=ro", uri=True, timeout=120)
+    try:
+        row = db.execute('SELECT number FROM assignments WHERE subject = ?', (subject,)).fetchone()
+    except sqlite3.OperationalError:
+        # A store that was created but never initialized
+        return None
+    finally:
+        db.close()
+
+    return format_eps(row[0]) if row else None
+
+
+class EpsAllocator:
+    """ Hands out EPS identifiers from the pipeline folder's SQLite store """
+
+    def __init__(self, pipeline_folder, block_size=1, owner=None, lease_seconds=LEASE_SECONDS):
+        self.pipeline_folder = pipeline_folder
+        self.block_size = max(1, block_size)
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.lease_seconds = lease_seconds
+        self.lease_id = None
+
+        self.db = sqlite3.connect(os.path.join(pipeline_folder, STORE_NAME), timeout=120, isolation_level=None)
+        self.db.executescript(SCHEMA)
+        with self.transaction():
+            if self.db.execute('SELECT last FROM counter').fetchone() is None:
+                self.db.execute('INSERT INTO counter (id, last) VALUES (0, ?)', (read_eps_csv(pipeline_folder),))
+
+    @contextmanager
+    def transaction(self):
+        """ Immediate transaction: takes the write lock up front so concurrent allocators queue up """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def lookup(self, subject):
+        """ EPS identifier already assigned to a subject, or None """
+        row = self.db.execute('SELECT number FROM assignments WHERE subject = ?', (subject,)).fetchone()
+        return format_eps(row[0]) if row else None
+
+    def allocate(self, subject=None):
+        """ Return the subject's EPS identifier, assigning the next free number on first use """
+        with self.transaction():
+            if subject is not None:
+                row = self.db.execute('SELECT number FROM assignments WHERE subject = ?', (subject,)).fetchone()
+                if row:
+                    return format_eps(row[0])
+
+            number = self._take_number()
+            if subject is not None:
+                self.db.execute('INSERT INTO assignments (subject, number, lease_id, assigned) VALUES (?, ?, ?, ?)',
+                                (subject, number, self.lease_id, time.time()))
+
+        return format_eps(number)
+
+    def _take_number(self):
+        """ Next number from this allocator's lease, leasing a new block when it runs out """
+        now = time.time()
+        row = None
+        if self.lease_id is not None:
+            row = self.db.execute('SELECT next, last FROM leases WHERE lease_id = ? AND owner = ? AND released = 0',
+                                  (self.lease_id, self.owner)).fetchone()
+        if row is None or row[0] > row[1]:
+            self._lease_block(now)
+            row = self.db.execute('SELECT next, last FROM leases WHERE lease_id = ?', (self.lease_id,)).fetchone()
+
+        number = row[0]
+        self.db.execute('UPDATE leases SET next = ?, expires = ? WHERE lease_id = ?',
+                        (number + 1, now + self.lease_seconds, self.lease_id))
+        return number
+
+    def _lease_block(self, now):
+        """ Take over the lowest reclaimable lease, or extend the counter by a new block """
+        reclaim = self.db.execute('SELECT lease_id FROM leases WHERE next <= last AND (released = 1 OR expires < ?) '
+                                  'ORDER BY next LIMIT 1', (now,)).fetchone()
+        if reclaim:
+            self.lease_id = reclaim[0]
+            self.db.execute('UPDATE leases SET owner = ?, released = 0, expires = ? WHERE lease_id = ?',
+                            (self.owner, now + self.lease_seconds, self.lease_id))
+            return
+
+        last = self.db.execute('SELECT last FROM counter').fetchone()[0]
+        first, last = last + 1, last + self.block_size
+        self.db.execute('UPDATE counter SET last = ?', (last,))
+        cursor = self.db.execute('INSERT INTO leases (owner, first, last, next, expires) VALUES (?, ?, ?, ?, ?)',
+                                 (self.owner, first, last, first, now + self.lease_seconds))
+        self.lease_id = cursor.lastrowid
+        # Still under the write lock, so the csv high-water mark cannot go backwards
+        write_eps_csv(self.pipeline_folder, last)
+
+    def release(self):
+        """ Return the unused rest of this allocator's lease so other workers can use it """
+        if self.lease_id is not None:
+            with self.transaction():
+                self.db.execute('UPDATE leases SET released = 1 WHERE lease_id = ? AND owner = ?',
+                                (self.lease_id, self.owner))
+            self.lease_id = None
+
+    def close(self):
+        """ Release the lease and close the store """
+        self.release()
+        self.db.close()
+
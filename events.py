@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming annotations -> BIDS events.tsv
+
+Turns the annotation exports of a subject into its _events.tsv without
+loading them: rows flow through generators one at a time, columns are mapped
+by name (description -> trial_type, parent -> channel; columns BIDS does not
+know are dropped), several annotation files are merged in onset order, and
+the events can be split into one file per EDF run with onsets relative to
+the start of that run.
+"""
+
+import csv
+import heapq
+import bisect
+from contextlib import ExitStack
+
+from checksums import open_hashed
+
+# Annotation export columns that are renamed for BIDS
+RENAMED_COLUMNS = {'description': 'trial_type', 'parent': 'channel'}
+
+# Columns of a BIDS events.tsv, in the order they are written; onset and duration always come first
+EVENT_COLUMNS = ('onset', 'duration', 'sample', 'trial_type', 'response_time', 'value', 'HED', 'stim_file', 'channel')
+
+MISSING = 'n/a'
+
+EVENTS_SIDECAR = {
+    "trial_type": {
+        "LongName": "Event",
+        "Description": "Any annotated event by neurologist",
+    },
+    "channel": {
+        "Description": "Channel(s) associated with the event",
+        "Delimiter": ""
+    }
+}
+
+
+def read_header(path):
+    """ Column names of an annotation file """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f, delimiter='\t'), [])
+
+
+def event_columns(paths):
+    """ Events columns present in any of the annotation files, in BIDS order """
+    present = set()
+    for path in paths:
+        present.update(RENAMED_COLUMNS.get(name, name) for name in read_header(path))
+
+    return ['onset', 'duration'] + [name for name in EVENT_COLUMNS[2:] if name in present]
+
+
+def parse_onset(value):
+    """ Onset in seconds for sorting, events without a valid onset sort last """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('inf')
+
+
+def read_events(path, columns):
+    """ (onset, fields) of every row of one annotation file, fields in the order of columns, one row at a time """
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = [RENAMED_COLUMNS.get(name, name) for name in next(reader, [])]
+        # Columns are looked up by name once per file, missing ones are n/a
+        indexes = [header.index(name) if name in header else None for name in columns]
+        for row in reader:
+            if not row:
+                continue
+            fields = [row[idx] if idx is not None and idx < len(row) and row[idx] != '' else MISSING for idx in indexes]
+            yield parse_onset(fields[0]), fields
+
+
+def merged_events(paths, columns):
+    """ Events of all annotation files merged in onset order; each file is expected to be in onset order already """
+    if len(paths) == 1:
+        return read_events(paths[0], columns)
+    return heapq.merge(*[read_events(path, columns) for path in paths], key=lambda event: event[0])
+
+
+def write_events(paths, destination, checksums=None):
+    """ Merge the annotation files into one events.tsv and return the number of events """
+    columns = event_columns(paths)
+    count = 0
+    with open_hashed(destination, checksums, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(columns)
+        for onset, fields in merged_events(paths, columns):
+            writer.writerow(fields)
+            count += 1
+
+    return count
+
+
+def run_of(onset, offsets):
+    """ Index of the run an onset falls in: the last run starting at or before it, the first run for earlier events """
+    return max(bisect.bisect_right(offsets, onset) - 1, 0)
+
+
+def write_events_per_run(paths, runs, destination_of, checksums=None):
+    """ Split the merged events into one events.tsv per run, onsets made relative to the start of their run
+
+    runs is a list of (run number, seconds from the start of the first run), destination_of(run number) the
+    events.tsv of a run; returns the number of events per run number. The events come in onset order, so only the
+    file of the current run is open; an event out of order (an unsorted annotation file) stays in the current run,
+    its onset relative to that run.
+    """
+    columns = event_columns(paths)
+    runs = sorted(runs, key=lambda run: run[1])
+    offsets = [offset for run_number, offset in runs]
+    counts = {run_number: 0 for run_number, offset in runs}
+    current = -1
+    with ExitStack() as stack:
+        def open_run(idx):
+            # The previous run is complete, every run gets its file even without events
+            stack.close()
+            f = stack.enter_context(open_hashed(destination_of(runs[idx][0]), checksums, 'w', newline=''))
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(columns)
+            return writer
+
+        for onset, fields in merged_events(paths, columns):
+            idx = run_of(onset, offsets)
+            while current < idx:
+                current += 1
+                writer = open_run(current)
+            run_number, offset = runs[current]
+            if onset != float('inf'):
+                fields[0] = f"{onset - offset:.6f}".rstrip('0').rstrip('.')
+            writer.writerow(fields)
+            counts[run_number] += 1
+        while current < len(runs) - 1:
+            current += 1
+            open_run(current)
+
+    return counts
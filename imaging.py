@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Imaging placement for the BIDS tree
+
+Classifies CT and T1/T2/FLAIR volumes, decides their session and run, writes
+their sidecar JSON, and either places already unzipped volumes from
+objects/imaging or streams them straight out of the imaging zip archives to
+their final BIDS filenames (decompressing .nii.gz on the fly), so every
+volume is written once. Sidecars are filled in from the NIfTI header of the
+volume as it is placed. A volume with the same content as an earlier one
+(dedupe.py) is collapsed into it, or kept as a hardlink of it.
+"""
+
+import os
+import re
+import json
+import gzip
+import shutil
+import hashlib
+import zipfile
+from datetime import datetime
+from contextlib import nullcontext
+
+from placement import place_file
+from checksums import HashingWriter, open_hashed
+from dedupe import find_duplicates, file_duplicates
+from niftiheader import read_nifti_header
+
+MRI_KEYWORDS = ("t1", "t2", "flair", "mprage")
+DATE_PATTERN = re.compile(r'(\d{8})')
+
+# Archive entries that are never imaging volumes (macOS resource forks, reconstructions)
+SKIPPED_ENTRY_PARTS = ('__macosx', 'recon')
+
+STREAM_CHUNK_BYTES = 1 << 20
+
+# Expected size of a gunzipped volume per byte of .nii.gz, when the archive does not give it away
+GZIP_EXPANSION = 3
+
+# Upper bound of the gzip header and trailer, with a stored file name
+GZIP_HEADER_BYTES = 1024
+
+# Fixed part of a zip local file header, before the file name and extra field
+ZIP_LOCAL_HEADER_BYTES = 30
+
+
+def volume_name(path):
+    """ File name of a volume without directories or a trailing .gz """
+    name = os.path.basename(path)
+    return name[:-3] if name.lower().endswith('.gz') else name
+
+
+def classify_volume(path):
+    """ BIDS suffixes a volume is placed under, from its file name: 'ct' and/or 'T2' / 'T1w' """
+    name = volume_name(path).lower()
+    suffixes = []
+    if "ct" in name:
+        suffixes.append('ct')
+    if any(x in name for x in MRI_KEYWORDS):
+        suffixes.append('T2' if "t2" in name else 'T1w')
+
+    return suffixes
+
+
+def mri_session(path, mri_date):
+    """ MRI session from the YYYYMMDD date in the file name, or from the participant's MRI date (mm/dd/yy) """
+    match = DATE_PATTERN.search(volume_name(path))
+    if match:
+        date_obj = datetime.strptime(match.group(1), "%Y%m%d")
+    else:
+        date_obj = datetime.strptime(mri_date, "%m/%d/%y")
+
+    return 'ses-' + date_obj.strftime("%m%d%Y")
+
+
+def plan_imaging(volumes, primary_dir, subject_label, ct_session, mri_date, duplicates=None, duplicate_mode='collapse'):
+    """ Destination of every volume as a list of {'source', 'suffix', 'content', 'stem'}, stem being the path without extension
+
+    duplicates maps a volume to the earlier volume with the same content ('content'). In 'collapse' mode a duplicate
+    that would get a run of the same session and suffix gets none, its item has 'collapsed' (the stem of that run)
+    instead of 'stem'.
+    """
+    duplicates = duplicates or {}
+    runs = {}
+    stems = {}
+    plan = []
+    for volume in volumes:
+        content = duplicates.get(volume, volume)
+        for suffix in classify_volume(volume):
+            if suffix == 'ct':
+                session, folder = ct_session, 'ct'
+            else:
+                session, folder = mri_session(volume, mri_date), 'anat'
+            if content != volume and duplicate_mode == 'collapse' and (content, session, suffix) in stems:
+                plan.append({'source': volume, 'suffix': suffix, 'content': content,
+                             'collapsed': stems[(content, session, suffix)]})
+                continue
+            # Runs are numbered per session and suffix
+            run = runs[(session, suffix)] = runs.get((session, suffix), 0) + 1
+            stem = os.path.join(primary_dir, subject_label, session, folder,
+                                f'{subject_label}_{session}_run-{run:02d}_{suffix}')
+            stems.setdefault((content, session, suffix), stem)
+            plan.append({'source': volume, 'suffix': suffix, 'content': content, 'stem': stem})
+
+    return plan
+
+
+def collapsed_placement(item):
+    """ Placement record of a duplicate that was not placed, pointing at the volume it duplicates """
+    destination = item['collapsed'] + '.nii'
+    return {'source': item['source'], 'destination': destination, 'mode': 'collapsed', 'bytes_written': 0,
+            'duplicate_of': destination, 'bytes_saved': os.path.getsize(destination)}
+
+
+def duplicate_placement(placement, first):
+    """ Mark the placement of a duplicate kept as its own run """
+    placement['duplicate_of'] = first
+    placement['bytes_saved'] = os.path.getsize(placement['destination']) - placement['bytes_written']
+    return placement
+
+
+def ct_sidecar():
+    """ CT sidecar JSON template """
+    return {
+        "Modality": "CT",
+        "ImagingFrequency": 0,
+        "Manufacturer": "",
+        "ManufacturersModelName": "",
+        "InstitutionName": "",
+        "InstitutionAddress": "",
+        "DeviceSerialNumber": "",
+        "StationName": "",
+        "BodyPartExamined": "",
+        "PatientPosition": "",
+        "SoftwareVersions": "",
+        "SeriesDescription": "",
+        "ProtocolName": "",
+        "ImageType": "",
+        "SeriesNumber": "",
+        "AcquisitionTime": "",
+        "AcquisitionNumber": "",
+        "ImageComments": "",
+        "ConvolutionKernel": "",
+        "ExposureTime": "",
+        "XRayTubeCurrent": "",
+        "XRayExposure": "",
+        "ImageOrientationPatientDICOM": "",
+        "ConversionSoftware": "",
+        "ConversionSoftwareVersion": ""
+    }
+
+
+def mri_sidecar():
+    """ MR sidecar JSON template """
+    return {
+        "Modality": "MR",
+        "MagneticFieldStrength": "",
+        "ImagingFrequency": "",
+        "Manufacturer": "",
+        "ManufacturersModelName": "",
+        "InstitutionName": "",
+        "InstitutionalDepartmentName": "",
+        "InstitutionAddress": "",
+        "DeviceSerialNumber": "",
+        "StationName": "",
+        "BodyPartExamined": "",
+        "PatientPosition": "",
+        "ProcedureStepDescription": "",
+        "SoftwareVersions": "",
+        "MRAcquisitionType": "",
+        "SeriesDescription": "",
+        "ProtocolName": "",
+        "ScanningSequence": "",
+        "SequenceVariant": "",
+        "ScanOptions": "",
+        "SequenceName": "",
+        "ImageType": [""],
+        "NonlinearGradientCorrection": "",
+        "SeriesNumber": "",
+        "AcquisitionTime": "",
+        "AcquisitionNumber": "",
+        "SliceThickness": "",
+        "SAR": "",
+        "EchoTime": "",
+        "RepetitionTime": "",
+        "InversionTime": "",
+        "FlipAngle": "",
+        "PartialFourier": "",
+        "BaseResolution": "",
+        "ShimSetting": [""],
+        "TxRefAmp": "",
+        "PhaseResolution": "",
+        "ReceiveCoilName": "",
+        "CoilString": "",
+        "PulseSequenceDetails": "",
+        "CoilCombinationMethod": "",
+        "MatrixCoilMode": "",
+        "PercentPhaseFOV": "",
+        "PercentSampling": "",
+        "PhaseEncodingSteps": "",
+        "AcquisitionMatrixPE": "",
+        "ReconMatrixPE": "",
+        "PixelBandwidth": "",
+        "DwellTime": "",
+        "ImageOrientationPatientDICOM": [""],
+        "ImageOrientationText": "",
+        "InPlanePhaseEncodingDirectionDICOM": "",
+        "ConversionSoftware": "",
+        "ConversionSoftwareVersion": ""
+    }
+
+
+def header_sidecar(sidecar, header):
+    """ Fill a sidecar template from the NIfTI header of its volume """
+    # An embedded JSON sidecar (dcm2niix and the like) fills the fields of the template, other keys are left out
+    for key, value in header['json'].items():
+        if key in sidecar:
+            sidecar[key] = value
+
+    sidecar.update({
+        'NiftiVersion': header['version'],
+        'ImageDimensions': header['dims'],
+        'VoxelSize': header['voxel_size'],
+        'VoxelSizeUnits': header['space_units'] or 'unknown',
+        'DataType': header['datatype_name'],
+        'QformCode': header['qform_code'],
+        'SformCode': header['sform_code'],
+    })
+    if header['qform_code'] > 0:
+        sidecar['Qform'] = {'Quaternion': header['quatern'], 'Offset': header['qoffset'], 'Qfac': header['qfac']}
+    if header['sform_code'] > 0:
+        sidecar['Sform'] = header['srow']
+    if header['description']:
+        sidecar['NiftiDescription'] = header['description']
+
+    return sidecar
+
+
+def write_sidecar(item, checksums=None):
+    """ Write the sidecar JSON of a placed volume next to it, filled in from the volume's header """
+    sidecar = ct_sidecar() if item['suffix'] == 'ct' else mri_sidecar()
+    # The volume was just placed, its header is a few cached bytes; a file that is not NIfTI keeps the template
+    try:
+        header_sidecar(sidecar, read_nifti_header(item['stem'] + '.nii'))
+    except (OSError, ValueError):
+        pass
+    with open_hashed(item['stem'] + '.json', checksums, "w") as outfile:
+        outfile.write(json.dumps(sidecar, indent=4))
+
+
+def volume_duplicates(volumes, checksums=None):
+    """ Duplicates among unzipped volumes (see dedupe.find_duplicates), hashed through checksums if given """
+    full_hash = None
+    if checksums is not None:
+        full_hash = lambda path: checksums.hash(path)['sha256']
+
+    # Volumes that are not placed are not compared, a duplicate always comes after a volume that is placed
+    return file_duplicates([volume for volume in volumes if classify_volume(volume)], full_hash)
+
+
+def place_imaging_volumes(volumes, primary_dir, subject_label, ct_session, mri_date, placement='auto', checksums=None,
+                          duplicate_mode='collapse', scratch=None):
+    """ Place unzipped volumes at their BIDS paths and write their sidecars, return the placement records
+
+    checksums (a ChecksumCache) gives every placed volume the digests of its source, if they are known; with a scratch
+    budget a volume that is copied claims its size first.
+    """
+    duplicates = volume_duplicates(volumes, checksums) if duplicate_mode != 'off' else {}
+    placements = []
+    placed = {}
+    for item in plan_imaging(volumes, primary_dir, subject_label, ct_session, mri_date, duplicates, duplicate_mode):
+        if 'collapsed' in item:
+            placements.append(collapsed_placement(item))
+            continue
+        destination = item['stem'] + '.nii'
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        # A volume placed a second time comes from its first destination, which must not be moved away
+        if item['content'] != item['source']:
+            # A duplicate kept as its own run is linked to the first copy whatever the placement
+            first = placed[item['content']]
+            placements.append(duplicate_placement(place_file(first, destination, 'auto'), first))
+        elif item['source'] in placed:
+            mode = 'auto' if placement == 'rename' else placement
+            placements.append(place_file(placed[item['source']], destination, mode))
+        else:
+            # Renames and hardlinks take no room, a copy does
+            needed = os.path.getsize(item['source']) if scratch is not None and placement in ('reflink', 'copy') else 0
+            with scratch.claim(needed) if needed else nullcontext():
+                placements.append(place_file(item['source'], destination, placement))
+            placed[item['source']] = destination
+        # Renames and hardlinks keep the inode, copies and clones have the same content as their source
+        if checksums is not None and placements[-1]['mode'] in ('reflink', 'copy'):
+            checksums.same_content(placements[-1]['source'], destination)
+        write_sidecar(item, checksums)
+
+    return placements
+
+
+def find_imaging_volumes(object_dir):
+    """ Unzipped .nii volumes in the *imag* folders of objects/, in a stable order """
+    volumes = []
+    for filename in sorted(os.listdir(object_dir)):
+        folder_path = os.path.join(object_dir, filename)
+        # change the name when unzipped so annoying
+        if "imag" in filename and os.path.isdir(folder_path):
+            volumes += sorted(os.path.join(folder_path, name) for name in os.listdir(folder_path) if name.endswith('.nii'))
+
+    return volumes
+
+
+def find_imaging_archives(object_dir):
+    """ Zip archives under objects/, except reconstruction archives """
+    archives = []
+    for root, dirs, files in os.walk(object_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.lower().endswith('.zip') and 'recon' not in filename.lower():
+                archives.append(os.path.join(root, filename))
+
+    return archives
+
+
+def archive_volumes(archive):
+    """ NIfTI entries of an archive as (source, ZipInfo); source is '<archive>/<entry>' """
+    volumes = []
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            lower = info.filename.lower()
+            if info.is_dir() or any(part in lower for part in SKIPPED_ENTRY_PARTS):
+                continue
+            if os.path.basename(lower).startswith('._'):
+                continue
+            if lower.endswith('.nii') or lower.endswith('.nii.gz'):
+                volumes.append((os.path.join(archive, info.filename), info))
+
+    return volumes
+
+
+def entry_bytes(zf, info):
+    """ Bytes an archive entry takes once streamed out, gunzipped for a .nii.gz """
+    if not info.filename.lower().endswith('.gz'):
+        return info.file_size
+    if info.compress_type != zipfile.ZIP_STORED or info.file_size < 4:
+        return info.file_size * GZIP_EXPANSION
+
+    # A stored .nii.gz ends with its gunzipped size modulo 2**32 (ISIZE), read from the archive without inflating
+    zf.fp.seek(info.header_offset)
+    local = zf.fp.read(ZIP_LOCAL_HEADER_BYTES)
+    name_length, extra_length = int.from_bytes(local[26:28], 'little'), int.from_bytes(local[28:30], 'little')
+    zf.fp.seek(info.header_offset + ZIP_LOCAL_HEADER_BYTES + name_length + extra_length + info.compress_size - 4)
+    size = int.from_bytes(zf.fp.read(4), 'little')
+    # Data that does not compress only grows by its gzip header and a few bytes per block, a smaller ISIZE wrapped
+    while size + GZIP_HEADER_BYTES + info.file_size // 1024 < info.file_size:
+        size += 1 << 32
+
+    return size
+
+
+def stream_volume(zf, info, destination, checksums=None):
+    """ Stream one archive entry to destination, gunzipping .nii.gz, and return the bytes written """
+    tmp = destination + '.part'
+    with zf.open(info) as entry:
+        source = gzip.GzipFile(fileobj=entry) if info.filename.lower().endswith('.gz') else entry
+        # The volume is hashed on its way to disk
+        with source, open(tmp, 'wb') as raw:
+            outfile = HashingWriter(raw)
+            shutil.copyfileobj(source, outfile, STREAM_CHUNK_BYTES)
+            written = raw.tell()
+    os.replace(tmp, destination)
+    if checksums is not None:
+        checksums.record(destination, outfile.hasher.digests())
+
+    return written
+
+
+def archive_entries(object_dir):
+    """ ({source: ZipInfo}, {source: archive}) of the volumes of every imaging archive, in a stable order """
+    entries = {}
+    archive_of = {}
+    for archive in find_imaging_archives(object_dir):
+        for source, info in archive_volumes(archive):
+            entries[source] = info
+            archive_of[source] = archive
+
+    return entries, archive_of
+
+
+def archive_duplicates(entries, archive_of):
+    """ Duplicates among archive entries: same size and CRC-32 in the zip directory, confirmed by their SHA-256 """
+    def directory_key(source):
+        return entries[source].file_size, entries[source].CRC
+
+    def entry_sha256(source):
+        digest = hashlib.sha256()
+        with zipfile.ZipFile(archive_of[source]) as zf, zf.open(entries[source]) as entry:
+            for chunk in iter(lambda: entry.read(STREAM_CHUNK_BYTES), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    return find_duplicates([source for source in entries if classify_volume(source)], (directory_key, entry_sha256))
+
+
+def extract_imaging_archives(object_dir, primary_dir, subject_label, ct_session, mri_date, checksums=None,
+                             duplicate_mode='collapse', scratch=None):
+    """ Stream every volume of the imaging archives straight to its BIDS path, return the placement records
+
+    With a scratch budget every volume claims the size it takes once extracted before it is streamed out.
+    """
+    entries, archive_of = archive_entries(object_dir)
+    duplicates = archive_duplicates(entries, archive_of) if duplicate_mode != 'off' else {}
+
+    placements = []
+    placed = {}
+    open_archives = {}
+    try:
+        for item in plan_imaging(list(entries), primary_dir, subject_label, ct_session, mri_date, duplicates,
+                                 duplicate_mode):
+            if 'collapsed' in item:
+                placements.append(collapsed_placement(item))
+                continue
+            destination = item['stem'] + '.nii'
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            source = item['source']
+            content = item['content']
+            if content in placed:
+                # Classified twice (ex. CT and T1) or a duplicate, the second copy comes from the first destination
+                placements.append(place_file(placed[content], destination, 'auto'))
+                if content != source:
+                    duplicate_placement(placements[-1], placed[content])
+                if checksums is not None and placements[-1]['mode'] in ('reflink', 'copy'):
+                    checksums.same_content(placed[content], destination)
+            else:
+                archive = archive_of[source]
+                if archive not in open_archives:
+                    open_archives[archive] = zipfile.ZipFile(archive)
+                zf = open_archives[archive]
+                with scratch.claim(entry_bytes(zf, entries[source])) if scratch is not None else nullcontext():
+                    written = stream_volume(zf, entries[source], destination, checksums)
+                placements.append({'source': source, 'destination': destination, 'mode': 'extract',
+                                   'bytes_written': written})
+                placed[content] = destination
+            write_sidecar(item, checksums)
+    finally:
+        for zf in open_archives.values():
+            zf.close()
+
+    return placements
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Concurrent, resumable subject ingest from S3
+
+Replaces the serial `aws s3 cp --recursive` of s3Copy.sh: every object under
+a subject prefix is split into parts that are fetched with ranged GETs on a
+bounded thread pool sharing one pooled client, and written in place into a
+preallocated <file>.part. The parts of a multi-part object that are on disk
+are recorded in <file>.part.json after every part, so an interrupted ingest
+only fetches what is missing (from scratch if the object changed). A file is renamed to its
+final name, and handed to the caller, as soon as its last part is in, while
+other files are still downloading.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from objectstore import BUCKET, LocalStore, S3Store
+
+# Bytes per ranged GET
+PART_BYTES = 8 * 1024 * 1024
+
+PARTIAL_SUFFIX = '.part'
+PROGRESS_SUFFIX = '.part.json'
+
+
+def plan_parts(size, part_bytes=PART_BYTES):
+    """ (start, end) byte ranges of the parts of an object """
+    return [(start, min(start + part_bytes, size)) for start in range(0, size, part_bytes)]
+
+
+def sync(fd):
+    """ Flush written data of a file to disk """
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+class Download:
+    """ One object being downloaded into <path>.part, with the parts already on disk """
+
+    def __init__(self, key, size, etag, path, part_bytes=PART_BYTES):
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.path = path
+        self.part_bytes = part_bytes
+        self.parts = plan_parts(size, part_bytes)
+        # Single part objects are fetched whole or not at all, they need no progress file
+        self.tracked = len(self.parts) > 1
+        self.lock = threading.Lock()
+        self.done = self.load_progress()
+        self.fd = None
+
+    def progress(self):
+        """ What has to match for the parts on disk to be reused """
+        return {'key': self.key, 'size': self.size, 'etag': self.etag, 'part_bytes': self.part_bytes}
+
+    def load_progress(self):
+        """ Parts an interrupted ingest already wrote, empty if the object or the part size changed since """
+        if not self.tracked:
+            return set()
+        try:
+            with open(self.path + PROGRESS_SUFFIX) as f:
+                progress = json.load(f)
+        except (OSError, ValueError):
+            return set()
+        if not os.path.isfile(self.path + PARTIAL_SUFFIX) or {key: progress.get(key) for key in self.progress()} != self.progress():
+            return set()
+
+        return set(progress.get('done', []))
+
+    def save_progress(self):
+        """ Atomically rewrite the progress file, called with the lock held """
+        if not self.tracked:
+            return
+        tmp = self.path + PROGRESS_SUFFIX + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(self.progress(), done=sorted(self.done)), f)
+        os.replace(tmp, self.path + PROGRESS_SUFFIX)
+
+    def open(self):
+        """ Open (and size) the partial file, keeping the parts already in it; called with the lock held """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if not self.done:
+            self.save_progress()
+        self.fd = os.open(self.path + PARTIAL_SUFFIX, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(self.fd, self.size)
+
+    def pending(self):
+        """ Indexes of the parts still to fetch """
+        return [idx for idx in range(len(self.parts)) if idx not in self.done]
+
+    def fetch(self, store, idx):
+        """ Fetch one part into its place in the partial file, return True if it was the last one """
+        # Files are opened by their first part, so only the files being fetched hold a descriptor
+        with self.lock:
+            if self.fd is None:
+                self.open()
+        start, end = self.parts[idx]
+        offset = start
+        for chunk in store.read_range(self.key, start, end, self.etag):
+            view = memoryview(chunk)
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                offset += written
+                view = view[written:]
+        if offset != end:
+            raise IOError(f"{self.key} part {idx} returned {offset - start} of {end - start} bytes")
+        # Only parts that are on disk are recorded, so a crash never leaves a recorded part unwritten
+        if self.tracked:
+            sync(self.fd)
+        with self.lock:
+            self.done.add(idx)
+            self.save_progress()
+            return len(self.done) == len(self.parts)
+
+    def finish(self):
+        """ Give the file its final name and drop the progress file """
+        if self.fd is None:
+            # Zero byte objects, or every part was fetched before an interruption
+            self.open()
+        sync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.path + PARTIAL_SUFFIX, self.path)
+        if self.tracked:
+            os.remove(self.path + PROGRESS_SUFFIX)
+
+    def close(self):
+        """ Close the partial file of an unfinished download, its progress is kept for the next ingest """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def local_path(destination, prefix, key):
+    """ Local path of an object, relative to the subject prefix """
+    return os.path.join(destination, *key[len(prefix):].split('/'))
+
+
+def ingest(store, prefix, destination, workers=8, part_bytes=PART_BYTES, stats=None):
+    """ Download every object under prefix into destination and yield each local path as soon as it is complete
+
+    stats, if given, is filled with files, skipped files and bytes fetched.
+    """
+    if stats is None:
+        stats = {}
+    stats.update({'files': 0, 'skipped': 0, 'bytes': 0})
+    prefix = prefix.strip('/') + '/'
+
+    downloads = []
+    for key, size, etag in store.list(prefix):
+        path = local_path(destination, prefix, key)
+        # Files a finished ingest already brought in are kept
+        if os.path.isfile(path) and os.path.getsize(path) == size and not os.path.exists(path + PROGRESS_SUFFIX):
+            stats['skipped'] += 1
+            yield path
+            continue
+        downloads.append(Download(key, size, etag, path, part_bytes))
+
+    executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+    futures = {}
+    try:
+        for download in downloads:
+            if not download.pending():
+                download.finish()
+                stats['files'] += 1
+                yield download.path
+            for idx in download.pending():
+                futures[executor.submit(download.fetch, store, idx)] = (download, idx)
+
+        for future in as_completed(futures):
+            download, idx = futures[future]
+            last = future.result()
+            stats['bytes'] += download.parts[idx][1] - download.parts[idx][0]
+            if last:
+                download.finish()
+                stats['files'] += 1
+                yield download.path
+    finally:
+        # A failed part or a caller that stops early leaves the rest for the next ingest to resume
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        for download in downloads:
+            download.close()
+
+
+def open_store(bucket=BUCKET, local_root=None, workers=8, endpoint_url=None):
+    """ Backend to ingest from: a local folder standing in for the bucket, or S3 """
+    if local_root is not None:
+        return LocalStore(local_root)
+
+    return S3Store(bucket, max_connections=workers, endpoint_url=endpoint_url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download a subject from S3 with concurrent ranged GETs, resuming partial downloads.")
+    parser.add_argument('subpath', type=str, help="Subject path in the bucket, the last folder name is the local folder name")
+    parser.add_argument('--dest', type=str, default='~/data', help="Folder the subject folder is created in (default: ~/data)")
+    parser.add_argument('--bucket', type=str, default=BUCKET, help=f"Bucket to read from (default: {BUCKET})")
+    parser.add_argument('--endpoint-url', type=str, help="S3 compatible endpoint, ex. a MinIO server")
+    parser.add_argument('--local-root', type=str, help="Read from this folder as if it were the bucket, no S3")
+    parser.add_argument('--workers', type=int, default=16, help="Concurrent ranged GETs (default: 16)")
+    parser.add_argument('--part-size', type=int, default=PART_BYTES // (1024 * 1024), help="MiB per ranged GET (default: 8)")
+    args = parser.parse_args()
+
+    if args.workers < 1 or args.part_size < 1:
+        parser.error("--workers and --part-size must be at least 1")
+
+    subpath = args.subpath.strip('/')
+    destination = os.path.join(os.path.expanduser(args.dest), os.path.basename(subpath))
+    store = open_store(args.bucket, args.local_root, args.workers, args.endpoint_url)
+    sys.stderr.write(f"Ingesting {store.describe(subpath)} into {destination}\n")
+
+    # Every finished file is printed as soon as it is complete, so a consumer can start on it
+    stats = {}
+    start = time.perf_counter()
+    for path in ingest(store, subpath, destination, args.workers, args.part_size * 1024 * 1024, stats):
+        sys.stdout.write(path + '\n')
+        sys.stdout.flush()
+    seconds = time.perf_counter() - start
+    sys.stderr.write(f"Ingested {stats['files']} files ({stats['skipped']} already there), {stats['bytes']} bytes "
+                     f"in {seconds:.1f}s\n")
+
+
+if __name__ == '__main__':
+    main()
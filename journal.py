@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-subject stage journal
+
+Records every completed stage of postbids.run_subject (and every EDF run that
+was de-identified and moved) in <pipeline>/journals/<subject folder>.json, so
+a re-invocation after a crash resumes from the first incomplete stage instead
+of redoing or corrupting finished work. The journal is rewritten atomically
+after every change and lives outside the subject folder, so it survives the
+final rename of the folder to its EPS name. Once the subject is finished the
+journal is reduced to its stage flags: the runs and the date shift it needed
+to resume are dropped, they say when the subject was recorded.
+"""
+
+import os
+import json
+import time
+import threading
+
+JOURNAL_FOLDER = 'journals'
+
+
+def journal_path(pipeline_folder, subject_folder):
+    """ Journal file of a subject folder """
+    return os.path.join(pipeline_folder, JOURNAL_FOLDER, os.path.basename(subject_folder.rstrip('/')) + '.json')
+
+
+def journal_exists(pipeline_folder, subject_folder):
+    """ True if the subject has been (partly) processed before """
+    return os.path.isfile(journal_path(pipeline_folder, subject_folder))
+
+
+class SubjectJournal:
+    """ Completed stages and EDF runs of one subject, persisted after every update """
+
+    def __init__(self, pipeline_folder, subject_folder):
+        self.path = journal_path(pipeline_folder, subject_folder)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except FileNotFoundError:
+            self.data = {'subject': os.path.basename(subject_folder.rstrip('/')), 'stages': {}, 'runs': {}}
+
+    def save(self):
+        """ Atomically rewrite the journal file """
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.data, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+    def reset(self):
+        """ Forget every stage and run """
+        with self.lock:
+            self.data = {'subject': self.data['subject'], 'stages': {}, 'runs': {}}
+            self.save()
+
+    def strip(self):
+        """ Keep only the completed stages of a finished subject, runs and set values are dropped """
+        with self.lock:
+            self.data = {'subject': self.data['subject'], 'stages': self.data['stages'], 'runs': {}}
+            self.save()
+
+    def done(self, stage):
+        """ True if the stage completed in an earlier invocation """
+        return stage in self.data['stages']
+
+    def get(self, stage, key, default=None):
+        """ Value a completed stage recorded """
+        return self.data['stages'].get(stage, {}).get(key, default)
+
+    def complete(self, stage, **values):
+        """ Mark a stage as completed, with the values a resumed run needs from it """
+        with self.lock:
+            self.data['stages'][stage] = dict(values, completed=time.time())
+            self.save()
+
+    def set(self, key, value):
+        """ Record a value that has to stay fixed across invocations (ex. the de-identification date shift) """
+        with self.lock:
+            self.data[key] = value
+            self.save()
+
+    def value(self, key, default=None):
+        """ Value recorded with set """
+        return self.data.get(key, default)
+
+    def runs(self):
+        """ EDF runs that were already de-identified and moved, keyed by run number """
+        return dict(self.data['runs'])
+
+    def record_run(self, run_number, record):
+        """ Mark one EDF run as de-identified and moved; safe to call from the EDF worker threads """
+        with self.lock:
+            self.data['runs'][run_number] = record
+            self.save()
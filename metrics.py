@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-stage metrics for postbids.run_subject
+
+Measures every stage of a subject (wall time, CPU time, peak RSS, files
+touched and bytes read/written according to /proc/self/io) and appends one
+JSON line per stage to a metrics file, or to stderr, so stdout keeps carrying
+only the new subject path. A single stage can also be run under cProfile,
+its stats are dumped to a .prof file per subject.
+
+CPU seconds, peak RSS and the I/O counters are read for the whole process:
+stages that run at the same time (the sidecars stage next to the EDFs of a
+converter) and the worker threads of a stage (--edf-workers) all count in
+them, so these fields of overlapping stages do not add up. Every line lists
+the stages that overlapped it in 'overlaps' and has the CPU seconds of the
+thread that ran the stage alone in 'thread_cpu_seconds'.
+"""
+
+import os
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+# Stages of postbids.run_subject, in the order they run
+STAGES = ('eps', 'plan', 'structure', 'edf', 'merge', 'sidecars', 'rename', 'participants_tsv', 'manifest', 'final_rename')
+
+# Counters of /proc/self/io: bytes that hit storage, and bytes passed through read/write calls
+IO_FIELDS = ('read_bytes', 'write_bytes', 'rchar', 'wchar')
+
+
+def read_io_counters():
+    """ I/O counters of this process, empty where /proc/self/io is not available """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':', 1) for line in f if ':' in line)
+    except OSError:
+        return {}
+
+    return {name: int(counters[name]) for name in IO_FIELDS if name in counters}
+
+
+def peak_rss_bytes():
+    """ Peak resident set size of this process so far """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def write_metrics_line(destination, record):
+    """ Append one JSON line to a metrics file, '-' is stderr; one write call so concurrent workers do not interleave """
+    line = json.dumps(record) + '\n'
+    if destination == '-':
+        sys.stderr.write(line)
+        sys.stderr.flush()
+        return
+    fd = os.open(destination, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+class StageMetrics:
+    """ Metrics of the stages of one subject; records are kept in memory and written to destination if given """
+
+    def __init__(self, subject, destination=None, profile_stage=None, profile_folder=None):
+        self.subject = subject
+        self.destination = destination
+        self.profile_stage = profile_stage
+        self.profile_folder = profile_folder
+        self.records = []
+        # Records of the stages running right now, to mark the ones that overlap
+        self.running = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """ Measure the enclosed stage; the body may set record['files'] and add its own counters to the record """
+        record = {'subject': self.subject, 'stage': name, 'files': None, 'overlaps': []}
+        with self.lock:
+            for other in self.running:
+                other['overlaps'].append(name)
+                record['overlaps'].append(other['stage'])
+            self.running.append(record)
+        io_before = read_io_counters()
+        profiler = cProfile.Profile() if name == self.profile_stage else None
+        wall, cpu, thread_cpu = time.perf_counter(), time.process_time(), time.thread_time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield record
+            record['status'] = 'ok'
+        except BaseException as e:
+            record['status'] = 'failed'
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['wall_seconds'] = round(time.perf_counter() - wall, 6)
+            record['cpu_seconds'] = round(time.process_time() - cpu, 6)
+            record['thread_cpu_seconds'] = round(time.thread_time() - thread_cpu, 6)
+            with self.lock:
+                self.running.remove(record)
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            io_after = read_io_counters()
+            for field in IO_FIELDS:
+                if field in io_before and field in io_after:
+                    record[field] = io_after[field] - io_before[field]
+            if profiler is not None:
+                record['profile'] = self.dump_profile(profiler, name)
+            self.records.append(record)
+            if self.destination is not None:
+                write_metrics_line(self.destination, record)
+
+    def dump_profile(self, profiler, name):
+        """ Write the cProfile stats of a stage to <profile folder>/<subject>_<stage>.prof and return the path """
+        folder = self.profile_folder or os.getcwd()
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{self.subject}_{name}.prof")
+        profiler.dump_stats(path)
+        return path
+
+    def summary(self):
+        """ Wall and CPU seconds per stage, for the batch result lines """
+        return {record['stage']: {'wall_seconds': record['wall_seconds'], 'cpu_seconds': record['cpu_seconds']}
+                for record in self.records}
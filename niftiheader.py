@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Header-only NIfTI-1/NIfTI-2 reader
+
+Memory-maps the 348 (NIfTI-1) or 540 (NIfTI-2) byte header of a .nii file,
+plus the header extensions between it and the voxel data when the file has
+any, and returns dimensions, voxel sizes, datatype, qform/sform and
+description as a plain dict, with the content of any JSON extension.
+Voxel data is never read.
+"""
+
+import os
+import math
+import mmap
+import json
+import struct
+
+NIFTI1_HEADER_BYTES = 348
+NIFTI2_HEADER_BYTES = 540
+# 4 byte extension flag after the header, the first byte is non-zero when extensions follow
+EXTENSION_FLAG_BYTES = 4
+
+# Extensions larger than this are not mapped, the voxel data has to start somewhere sensible
+MAX_EXTENSION_BYTES = 16 * 1024 * 1024
+
+DATATYPES = {
+    2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32', 32: 'complex64', 64: 'float64', 128: 'rgb24',
+    256: 'int8', 512: 'uint16', 768: 'uint32', 1024: 'int64', 1280: 'uint64', 1536: 'float128',
+    1792: 'complex128', 2048: 'complex256', 2304: 'rgba32',
+}
+
+SPACE_UNITS = {1: 'm', 2: 'mm', 3: 'um'}
+TIME_UNITS = {8: 's', 16: 'ms', 24: 'us'}
+
+# (field, struct format, offset) of the NIfTI-1 header fields that are read
+NIFTI1_FIELDS = [
+    ('dim', '8h', 40),
+    ('datatype', 'h', 70),
+    ('bitpix', 'h', 72),
+    ('pixdim', '8f', 76),
+    ('vox_offset', 'f', 108),
+    ('scl_slope', 'f', 112),
+    ('scl_inter', 'f', 116),
+    ('xyzt_units', 'B', 123),
+    ('descrip', '80s', 148),
+    ('aux_file', '24s', 228),
+    ('qform_code', 'h', 252),
+    ('sform_code', 'h', 254),
+    ('quatern', '3f', 256),
+    ('qoffset', '3f', 268),
+    ('srow', '12f', 280),
+    ('intent_name', '16s', 328),
+    ('magic', '4s', 344),
+]
+
+# The same fields in the NIfTI-2 header, 64 bit integers and doubles
+NIFTI2_FIELDS = [
+    ('magic', '8s', 4),
+    ('datatype', 'h', 12),
+    ('bitpix', 'h', 14),
+    ('dim', '8q', 16),
+    ('pixdim', '8d', 104),
+    ('vox_offset', 'q', 168),
+    ('scl_slope', 'd', 176),
+    ('scl_inter', 'd', 184),
+    ('descrip', '80s', 240),
+    ('aux_file', '24s', 320),
+    ('qform_code', 'i', 344),
+    ('sform_code', 'i', 348),
+    ('quatern', '3d', 352),
+    ('qoffset', '3d', 376),
+    ('srow', '12d', 400),
+    ('xyzt_units', 'i', 500),
+    ('intent_name', '16s', 508),
+]
+
+
+def header_layout(raw):
+    """ (version, byte order, header size) from the sizeof_hdr field, which also gives away the byte order """
+    for order in ('<', '>'):
+        size = struct.unpack_from(order + 'i', raw, 0)[0]
+        if size == NIFTI1_HEADER_BYTES:
+            return 1, order, NIFTI1_HEADER_BYTES
+        if size == NIFTI2_HEADER_BYTES:
+            return 2, order, NIFTI2_HEADER_BYTES
+
+    raise ValueError("Not a NIfTI-1 or NIfTI-2 header")
+
+
+def text(value):
+    """ NUL terminated header string """
+    return value.split(b'\x00', 1)[0].decode('latin-1').strip()
+
+
+def parse_nifti_header(raw):
+    """ Parse NIfTI-1/NIfTI-2 header bytes (at least the fixed header) into a metadata dict """
+    if len(raw) < 4:
+        raise ValueError("NIfTI header is truncated")
+    version, order, size = header_layout(raw)
+    if len(raw) < size:
+        raise ValueError(f"NIfTI header is truncated: expected {size} bytes, got {len(raw)}")
+
+    fields = {}
+    for name, fmt, offset in NIFTI1_FIELDS if version == 1 else NIFTI2_FIELDS:
+        values = struct.unpack_from(order + fmt, raw, offset)
+        fields[name] = values[0] if len(values) == 1 else list(values)
+
+    magic = text(fields['magic'])
+    if magic not in (f'n+{version}', f'ni{version}'):
+        raise ValueError(f"NIfTI-{version} header has an unknown magic '{magic}'")
+
+    # NIfTI-1 stores single precision floats, they are given with the 7 digits they carry
+    real = (lambda value: float(f'{value:.7g}')) if version == 1 else float
+
+    ndim = fields['dim'][0]
+    if not 1 <= ndim <= 7:
+        raise ValueError(f"NIfTI header has an invalid number of dimensions ({ndim})")
+
+    return {
+        'version': version,
+        'byteorder': 'little' if order == '<' else 'big',
+        'header_bytes': size,
+        'single_file': magic.startswith('n+'),
+        'dims': list(fields['dim'][1:ndim + 1]),
+        # pixdim[0] is qfac, the sign of the third axis of the qform
+        'voxel_size': [real(value) for value in fields['pixdim'][1:min(ndim, 3) + 1]],
+        'qfac': -1.0 if fields['pixdim'][0] < 0 else 1.0,
+        'time_step': real(fields['pixdim'][4]) if ndim >= 4 else None,
+        'datatype': fields['datatype'],
+        'datatype_name': DATATYPES.get(fields['datatype'], 'unknown'),
+        'bitpix': fields['bitpix'],
+        'vox_offset': int(fields['vox_offset']) if math.isfinite(fields['vox_offset']) else 0,
+        'scl_slope': real(fields['scl_slope']),
+        'scl_inter': real(fields['scl_inter']),
+        'space_units': SPACE_UNITS.get(fields['xyzt_units'] & 0x07),
+        'time_units': TIME_UNITS.get(fields['xyzt_units'] & 0x38),
+        'description': text(fields['descrip']),
+        'aux_file': text(fields['aux_file']),
+        'intent_name': text(fields['intent_name']),
+        'qform_code': fields['qform_code'],
+        'sform_code': fields['sform_code'],
+        'quatern': [real(value) for value in fields['quatern']],
+        'qoffset': [real(value) for value in fields['qoffset']],
+        'srow': [[real(value) for value in fields['srow'][row * 4:row * 4 + 4]] for row in range(3)],
+    }
+
+
+def parse_extensions(raw, order, start, end):
+    """ (code, payload) of every header extension in raw[start:end] """
+    extensions = []
+    offset = start
+    while offset + 8 <= end:
+        esize, ecode = struct.unpack_from(order + 'ii', raw, offset)
+        # esize counts its own 8 bytes and is a multiple of 16, anything else is not an extension
+        if esize < 8 or offset + esize > end:
+            break
+        extensions.append((ecode, bytes(raw[offset + 8:offset + esize])))
+        offset += esize
+
+    return extensions
+
+
+def extension_json(extensions):
+    """ Keys of every extension whose payload is a JSON object, later extensions win """
+    embedded = {}
+    for code, payload in extensions:
+        try:
+            value = json.loads(payload.rstrip(b'\x00').decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            continue
+        if isinstance(value, dict):
+            embedded.update(value)
+
+    return embedded
+
+
+def read_nifti_header(file):
+    """ Read only the header (and header extensions) of a .nii file and return its metadata dict """
+    with open(file, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < NIFTI1_HEADER_BYTES:
+            raise ValueError(f"{file} is too short to be a NIfTI file")
+        with mmap.mmap(f.fileno(), min(file_size, NIFTI2_HEADER_BYTES + EXTENSION_FLAG_BYTES),
+                       access=mmap.ACCESS_READ) as raw:
+            header = parse_nifti_header(raw)
+            flag_offset = header['header_bytes']
+            has_extensions = len(raw) > flag_offset and raw[flag_offset] != 0
+
+        extensions = []
+        # Extensions sit between the extension flag and the voxel data of a single file .nii
+        end = min(header['vox_offset'], file_size) if header['single_file'] else file_size
+        start = header['header_bytes'] + EXTENSION_FLAG_BYTES
+        if has_extensions and start < end <= start + MAX_EXTENSION_BYTES:
+            with mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ) as raw:
+                order = '<' if header['byteorder'] == 'little' else '>'
+                extensions = parse_extensions(raw, order, start, end)
+
+    header['extensions'] = [{'code': code, 'bytes': len(payload)} for code, payload in extensions]
+    header['json'] = extension_json(extensions)
+    header['path'] = file
+    header['file_size'] = file_size
+
+    return header
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Object store backends for ingest.py and upload.py
+
+A backend lists the objects under a prefix as (key, size, etag), reads a
+byte range of one object as a stream of chunks, tells the size and metadata
+of one object, and writes objects with a single PUT or as a multipart upload.
+S3Store talks to S3 (or a MinIO / moto endpoint) through one boto3 client
+whose connection pool is shared by every transfer thread; LocalStore serves a
+folder as if it were a bucket, so ingest and upload can be run and tested
+without network. boto3 is only imported when an S3Store is created.
+"""
+
+import os
+import json
+import uuid
+import shutil
+
+BUCKET = 'org-ieeg-data'
+
+# Bytes handed over per chunk of a ranged read
+CHUNK_BYTES = 1024 * 1024
+
+# Folder of a LocalStore that keeps object metadata and unfinished multipart uploads, it is not listed
+LOCAL_STATE = '.objectstore'
+
+
+class LocalStore:
+    """ A folder served as a bucket, keys are paths relative to it with '/' separators """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def describe(self, prefix=''):
+        """ Location of a prefix, for messages """
+        return os.path.join(self.root, prefix)
+
+    def path(self, key):
+        """ File of an object """
+        return os.path.join(self.root, *key.split('/'))
+
+    def metadata_path(self, key):
+        """ JSON file with the metadata of an object """
+        return os.path.join(self.root, LOCAL_STATE, 'metadata', *key.split('/')) + '.json'
+
+    def list(self, prefix=''):
+        """ (key, size, etag) of every object under prefix, in key order """
+        objects = []
+        for folder, dirs, files in os.walk(os.path.join(self.root, prefix)):
+            if folder == self.root:
+                dirs[:] = [name for name in dirs if name != LOCAL_STATE]
+            for name in files:
+                path = os.path.join(folder, name)
+                stat = os.stat(path)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                # Size and modification time stand in for the ETag, they change whenever the content does
+                objects.append((key, stat.st_size, f"{stat.st_size}-{stat.st_mtime_ns}"))
+
+        return sorted(objects)
+
+    def read_range(self, key, start, end, etag=None):
+        """ Chunks of bytes start to end (exclusive) of an object, which must still have etag if given """
+        with open(os.path.join(self.root, key), 'rb') as f:
+            stat = os.fstat(f.fileno())
+            if etag is not None and etag != f"{stat.st_size}-{stat.st_mtime_ns}":
+                raise IOError(f"{key} changed while it was being downloaded")
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_BYTES, remaining))
+                if not chunk:
+                    raise IOError(f"{key} ended {remaining} bytes early")
+                remaining -= len(chunk)
+                yield chunk
+
+    def stat(self, key):
+        """ {'size', 'metadata'} of an object, None if there is none """
+        try:
+            size = os.path.getsize(self.path(key))
+        except FileNotFoundError:
+            return None
+        try:
+            with open(self.metadata_path(key)) as f:
+                metadata = json.load(f)
+        except FileNotFoundError:
+            metadata = {}
+
+        return {'size': size, 'metadata': metadata}
+
+    def store(self, key, source, metadata):
+        """ Move a finished file into place as an object, with its metadata """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.makedirs(os.path.dirname(self.metadata_path(key)), exist_ok=True)
+        with open(self.metadata_path(key), 'w') as f:
+            json.dump(metadata, f)
+        os.replace(source, path)
+
+    def put_file(self, key, file, metadata=None):
+        """ Upload a whole file as one object """
+        tmp = os.path.join(self.root, LOCAL_STATE, 'uploads', uuid.uuid4().hex)
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        shutil.copyfile(file, tmp)
+        self.store(key, tmp, metadata or {})
+
+    def start_multipart(self, key, metadata=None):
+        """ Start a multipart upload and return its id """
+        upload_id = uuid.uuid4().hex
+        folder = os.path.join(self.root, LOCAL_STATE, 'uploads', upload_id)
+        os.makedirs(folder)
+        with open(os.path.join(folder, 'metadata.json'), 'w') as f:
+            json.dump(metadata or {}, f)
+
+        return upload_id
+
+    def put_part(self, key, upload_id, number, data):
+        """ Upload part number (from 1) of a multipart upload, return its tag """
+        with open(os.path.join(self.root, LOCAL_STATE, 'uploads', upload_id, str(number)), 'wb') as f:
+            f.write(data)
+
+        return str(number)
+
+    def complete_multipart(self, key, upload_id, tags):
+        """ Join the parts, in part number order, into the object """
+        folder = os.path.join(self.root, LOCAL_STATE, 'uploads', upload_id)
+        with open(os.path.join(folder, 'metadata.json')) as f:
+            metadata = json.load(f)
+        joined = folder + '.joined'
+        with open(joined, 'wb') as out:
+            for tag in tags:
+                with open(os.path.join(folder, tag), 'rb') as part:
+                    shutil.copyfileobj(part, out, CHUNK_BYTES)
+        self.store(key, joined, metadata)
+        shutil.rmtree(folder)
+
+    def abort_multipart(self, key, upload_id):
+        """ Drop the parts of an unfinished multipart upload """
+        shutil.rmtree(os.path.join(self.root, LOCAL_STATE, 'uploads', upload_id), ignore_errors=True)
+
+
+class S3Store:
+    """ An S3 bucket, read through one pooled client that is safe to share between threads """
+
+    def __init__(self, bucket=BUCKET, max_connections=10, endpoint_url=None):
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+
+        self.ClientError = ClientError
+        self.bucket = bucket
+        config = Config(max_pool_connections=max_connections, retries={'max_attempts': 10, 'mode': 'adaptive'})
+        self.client = boto3.session.Session().client('s3', endpoint_url=endpoint_url, config=config)
+
+    def describe(self, prefix=''):
+        """ Location of a prefix, for messages """
+        return f"s3://{self.bucket}/{prefix}"
+
+    def list(self, prefix=''):
+        """ (key, size, etag) of every object under prefix, in key order """
+        objects = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                # Folder placeholder objects have nothing to download
+                if not item['Key'].endswith('/'):
+                    objects.append((item['Key'], item['Size'], item['ETag'].strip('"')))
+
+        return sorted(objects)
+
+    def read_range(self, key, start, end, etag=None):
+        """ Chunks of bytes start to end (exclusive) of an object, one ranged GET; S3 refuses it if etag no longer matches """
+        if end <= start:
+            return
+        request = {'Bucket': self.bucket, 'Key': key, 'Range': f"bytes={start}-{end - 1}"}
+        if etag is not None:
+            request['IfMatch'] = f'"{etag}"'
+        response = self.client.get_object(**request)
+        body = response['Body']
+        try:
+            yield from body.iter_chunks(CHUNK_BYTES)
+        finally:
+            body.close()
+
+    def stat(self, key):
+        """ {'size', 'metadata'} of an object, None if there is none """
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+        return {'size': response['ContentLength'], 'metadata': response.get('Metadata', {})}
+
+    def put_file(self, key, file, metadata=None):
+        """ Upload a whole file as one object """
+        with open(file, 'rb') as f:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=f, Metadata=metadata or {})
+
+    def start_multipart(self, key, metadata=None):
+        """ Start a multipart upload and return its id """
+        response = self.client.create_multipart_upload(Bucket=self.bucket, Key=key, Metadata=metadata or {})
+        return response['UploadId']
+
+    def put_part(self, key, upload_id, number, data):
+        """ Upload part number (from 1) of a multipart upload, return its tag """
+        response = self.client.upload_part(Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+        return response['ETag']
+
+    def complete_multipart(self, key, upload_id, tags):
+        """ Join the parts, tags in part number order, into the object """
+        parts = [{'PartNumber': number, 'ETag': tag} for number, tag in enumerate(tags, 1)]
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id,
+                                              MultipartUpload={'Parts': parts})
+
+    def abort_multipart(self, key, upload_id):
+        """ Drop the parts of an unfinished multipart upload """
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
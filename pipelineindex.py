@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Index of the pipeline folder's montages and annotations by subject ID
+
+Maps each normalized subject ID (ex. HUP199, HUP0199 and hup199 are all
+HUP199) to the montage and annotation files that name it. The index is kept in
+pipeline_index.json in the pipeline folder and only the folders whose mtime
+changed are re-listed, so a subject lookup is a dict access plus one stat per
+indexed folder instead of a scan of every filename.
+"""
+
+import os
+import re
+import json
+
+INDEX_NAME = 'pipeline_index.json'
+INDEX_VERSION = 1
+INDEXED_FOLDERS = ('montages', 'annotations')
+
+# Letters followed by a number, not glued to other letters/digits: HUP199 in 'HUP199_montage.json' but not in 'HUP1990'
+SUBJECT_PATTERN = re.compile(r'(?<![A-Za-z0-9])([A-Za-z]+)[-_ ]?0*(\d+)(?!\d)')
+
+# Indexes already loaded by this process, keyed by pipeline folder
+loaded_indexes = {}
+
+
+def subject_keys(name):
+    """ All normalized subject IDs that appear in a file or folder name """
+    return sorted({prefix.upper() + number for prefix, number in SUBJECT_PATTERN.findall(name)})
+
+
+def normalize_subject_id(subjectid):
+    """ Normalized form of a subject ID such as HUP199, None if it has no letters+number part """
+    keys = subject_keys(subjectid)
+    return keys[0] if keys else None
+
+
+def folder_mtime(path):
+    """ Directory mtime in ns, None if the folder does not exist """
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def scan_folder(path, previous):
+    """ Re-list one folder, reusing the parsed keys of files that were already indexed """
+    files = {}
+    if os.path.isdir(path):
+        for filename in os.listdir(path):
+            if filename in previous:
+                files[filename] = previous[filename]
+            else:
+                files[filename] = subject_keys(filename)
+
+    return files
+
+
+def build_lookup(index):
+    """ subject ID -> {folder: [filenames]} from the persisted per-folder listing """
+    lookup = {}
+    for folder, entry in index['folders'].items():
+        for filename in sorted(entry['files']):
+            for key in entry['files'][filename]:
+                lookup.setdefault(key, {}).setdefault(folder, []).append(filename)
+
+    return lookup
+
+
+def read_index(pipeline_folder):
+    """ Persisted index, or an empty one if it is missing, unreadable or from another version """
+    try:
+        with open(os.path.join(pipeline_folder, INDEX_NAME)) as f:
+            index = json.load(f)
+        if index.get('version') == INDEX_VERSION:
+            return index
+    except (OSError, ValueError):
+        pass
+
+    return {'version': INDEX_VERSION, 'folders': {}}
+
+
+def write_index(pipeline_folder, index):
+    """ Atomically replace the persisted index """
+    path = os.path.join(pipeline_folder, INDEX_NAME)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, path)
+
+
+def load_pipeline_index(pipeline_folder, persist=True):
+    """ Load the index, re-listing only folders whose mtime changed, and return the subject lookup
+
+    With persist False (a dry run) the re-listed folders are only kept in memory, the index file is left as it is.
+    """
+    cached = loaded_indexes.get(pipeline_folder)
+    mtimes = {folder: folder_mtime(os.path.join(pipeline_folder, folder)) for folder in INDEXED_FOLDERS}
+    if cached is not None and cached['mtimes'] == mtimes:
+        return cached['lookup']
+
+    index = read_index(pipeline_folder)
+    changed = False
+    for folder in INDEXED_FOLDERS:
+        entry = index['folders'].get(folder)
+        if entry is None or entry['mtime_ns'] != mtimes[folder]:
+            previous = entry['files'] if entry else {}
+            index['folders'][folder] = {'mtime_ns': mtimes[folder],
+                                        'files': scan_folder(os.path.join(pipeline_folder, folder), previous)}
+            changed = True
+
+    if changed and persist:
+        write_index(pipeline_folder, index)
+
+    lookup = build_lookup(index)
+    loaded_indexes[pipeline_folder] = {'mtimes': mtimes, 'lookup': lookup}
+    return lookup
+
+
+def find_subject_files(pipeline_folder, subjectid, folder, persist=True):
+    """ Filenames in <pipeline>/<folder> that belong to a subject """
+    key = normalize_subject_id(subjectid)
+    if key is None:
+        return []
+
+    return load_pipeline_index(pipeline_folder, persist).get(key, {}).get(folder, [])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Zero-copy placement of files into the BIDS tree
+
+Places a source file at its BIDS destination with the cheapest strategy that
+works on the filesystem: rename, hardlink, reflink (FICLONE) or a kernel-side
+copy (copy_file_range) with a plain copy as the last resort. Every placement
+reports the strategy used and the bytes that were physically written.
+"""
+
+import os
+import errno
+import fcntl
+import shutil
+
+PLACEMENT_MODES = ('auto', 'rename', 'hardlink', 'reflink', 'copy')
+
+# 'auto' never consumes the source, so it is safe whether or not objects/ is deleted afterwards
+AUTO_ORDER = ('hardlink', 'reflink', 'copy')
+
+# ioctl request number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that mean "this strategy is not possible here", as opposed to a real I/O failure
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                      errno.ENOSYS, errno.EMLINK, errno.EBADF}
+
+
+def rename_file(src, dst):
+    """ Move within one filesystem, nothing is written """
+    os.rename(src, dst)
+    return 0
+
+
+def hardlink_file(src, dst):
+    """ Second directory entry for the same inode, nothing is written """
+    os.link(src, dst)
+    return 0
+
+
+def reflink_file(src, dst):
+    """ Copy-on-write clone (btrfs, XFS with reflink, ...), data blocks are shared """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copymode(src, dst)
+    return 0
+
+
+def copy_file(src, dst):
+    """ Full copy, kernel-side with copy_file_range where available """
+    size = os.path.getsize(src)
+    if hasattr(os, 'copy_file_range'):
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                copied = 0
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - copied)
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                copied = None
+        if copied == size:
+            shutil.copymode(src, dst)
+            return size
+
+    shutil.copy(src, dst)
+    return size
+
+
+STRATEGIES = {
+    'rename': rename_file,
+    'hardlink': hardlink_file,
+    'reflink': reflink_file,
+    'copy': copy_file,
+}
+
+
+def place_file(src, dst, mode='auto'):
+    """ Place src at dst and return {'source', 'destination', 'mode', 'bytes_written'} """
+    if mode not in PLACEMENT_MODES:
+        raise ValueError(f"Unknown placement mode '{mode}', expected one of {', '.join(PLACEMENT_MODES)}")
+
+    order = AUTO_ORDER if mode == 'auto' else (mode, 'copy')
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    for strategy in order:
+        try:
+            bytes_written = STRATEGIES[strategy](src, dst)
+        except OSError as e:
+            if strategy == 'copy' or e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            continue
+        return {'source': src, 'destination': dst, 'mode': strategy, 'bytes_written': bytes_written}
+
+
+def summarize_placements(placements):
+    """ Files and bytes written per strategy, plus the total bytes written and the duplicates, collapsed or linked """
+    # Collapsed duplicates are reported under their own mode but are not files
+    summary = {'files': sum(1 for placement in placements if placement['mode'] != 'collapsed'), 'bytes_written': 0,
+               'modes': {}, 'duplicates': 0, 'linked': 0, 'bytes_saved': 0}
+    for placement in placements:
+        summary['bytes_written'] += placement['bytes_written']
+        if 'duplicate_of' in placement:
+            summary['duplicates'] += 1
+            # A duplicate kept as its own run is placed, as a link of the first copy
+            if placement['mode'] != 'collapsed':
+                summary['linked'] += 1
+            summary['bytes_saved'] += placement['bytes_saved']
+        summary['modes'][placement['mode']] = summary['modes'].get(placement['mode'], 0) + 1
+
+    return summary
+
+
+def sync_files(paths):
+    """ Flush files and their directory entries to disk, before anything they were made from is deleted """
+    folders = set()
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        folders.add(os.path.dirname(path))
+
+    for folder in sorted(folders):
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -7,18 +7,41 @@ Created on Tue Feb 18 14:03:26 2025
 """
 
 import os
-import mne
 import csv
-import regex as re
-import pandas as pd
+import re
 import glob
 import json
-import pyedflib
-from datetime import datetime
 import shutil 
 import argparse
 import sys
-import logging
+import itertools
+from fractions import Fraction
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from edfheader import read_edf_header
+from channelkinds import channel_kinds, mne_channel_kinds
+from events import write_events, write_events_per_run, EVENTS_SIDECAR
+from deidentify import deidentify_edf_file, subject_anchor, day_anchor, shifted_start, reshift_edf_file, ANCHOR_DATE
+from epsallocator import EpsAllocator, format_eps, read_eps_csv, lookup_assignment
+from pipelineindex import find_subject_files
+from deidlookup import load_deidentified_index, lookup_participant
+from placement import PLACEMENT_MODES, summarize_placements, sync_files
+from dedupe import DUPLICATE_MODES
+from imaging import (place_imaging_volumes, extract_imaging_archives, find_imaging_volumes, find_imaging_archives,
+                     plan_imaging, archive_entries, archive_duplicates, volume_duplicates)
+from journal import SubjectJournal, journal_exists
+from bidsplan import SubjectPlan, final_name
+from metrics import StageMetrics, STAGES
+from checksums import ChecksumCache, HashingWriter, open_hashed, build_manifest, MANIFEST_NAME, CACHE_NAME
+from edfmerge import read_segment, plan_files, write_file, file_bytes, segment_listing
+from channelindex import index_runs
+from scratch import open_budget
+
+CHANNEL_COLUMNS = ["name","type","units","low_cutoff","high_cutoff","description","sampling_frequency","status","status_description"]
+
+# Run -> channel signature index, written to Derivative/<session name><suffix>
+CHANNEL_INDEX_SUFFIX = '_channel_index.json'
 
 def parse_arguments():
     """ Parse command line arguments"""
@@ -29,12 +52,43 @@ def parse_arguments():
     parser.add_argument('folder1', type=str, help="Path to the subject folder folder")
     parser.add_argument('folder2', type=str, help="Path to the pipeline creation folder")
     parser.add_argument('type', type=str, choices=['ieeg', 'scalp'], help="Flag indicating data type: 'ieeg' or 'scalp'")
+    parser.add_argument('--placement', type=str, choices=PLACEMENT_MODES, default='auto',
+                        help="How imaging is placed into the BIDS tree; 'auto' picks hardlink, reflink or copy per file, "
+                             "'rename' moves the volumes out of objects/ (default: auto)")
+    parser.add_argument('--edf-workers', type=int, default=1,
+                        help="Threads used to read, de-identify and move the EDF runs of the subject (default: 1, serial)")
+    parser.add_argument('--stream-imaging', action='store_true',
+                        help="Extract imaging straight from the zip archives in objects/ instead of an unzipped imaging folder")
+    parser.add_argument('--split-events', action='store_true',
+                        help="Write one events.tsv per EDF run, onsets relative to the start of the run")
+    parser.add_argument('--merge-runs', action='store_true',
+                        help="Merge consecutive EDF runs with the same signals into as few files as possible, records are "
+                             "copied as raw bytes and runs with gaps between them become EDF+D")
+    parser.add_argument('--max-run-mb', type=int, default=0,
+                        help="With --merge-runs, cut the merged files (and longer runs) into files of at most this many "
+                             "MiB (default: 0, no limit)")
+    parser.add_argument('--scratch-mb', type=int, default=0,
+                        help="Keep the subject folder under this many MiB: stages wait for room and intermediates (merged "
+                             "runs, imaging archives or unzipped volumes) are deleted as soon as they are used "
+                             "(default: 0, no limit)")
+    parser.add_argument('--imaging-duplicates', type=str, choices=DUPLICATE_MODES, default='collapse',
+                        help="Volumes with the same content as an earlier one: 'collapse' places them once, 'link' keeps "
+                             "their runs as hardlinks of the first, 'off' places every volume (default: collapse)")
+    parser.add_argument('--mne-channels', action='store_true',
+                        help="Classify channels with mne.io.read_raw_edf instead of from the EDF header (imports MNE)")
+    parser.add_argument('--metrics', type=str,
+                        help="Append one JSON line of timing, CPU, peak RSS and I/O per stage to this file, '-' for stderr")
+    parser.add_argument('--profile-stage', type=str, choices=STAGES,
+                        help="Run this stage under cProfile and write <subject>_<stage>.prof to --profile-dir")
+    parser.add_argument('--profile-dir', type=str, default='.', help="Folder for cProfile output (default: current folder)")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Print every planned source -> destination of the subject and exit without writing anything")
 
     # Parse the command line arguments
     args = parser.parse_args()
 
-    # Validate if the provided folders exist
-    if not os.path.isdir(args.folder1):
+    # Validate if the provided folders exist, a subject that was already renamed can still be resumed from its journal
+    if not os.path.isdir(args.folder1) and not journal_exists(args.folder2, args.folder1):
         #print(f"Error: {args.folder1} is not a valid subject directory.")
         return
     if not os.path.isdir(args.folder2):
@@ -43,7 +97,7 @@ def parse_arguments():
         
     return args
 
-def create_folder_structure(subject_folder, subjectid):
+def create_folder_structure(subject_folder, eps_string):
     """ Creates primary and derivative folder structures"""
     os.makedirs(os.path.join(subject_folder, 'Primary'), exist_ok=True)
     os.makedirs(os.path.join(subject_folder, 'Derivative'), exist_ok=True)
@@ -51,14 +105,14 @@ def create_folder_structure(subject_folder, subjectid):
     primary_dir = os.path.join(subject_folder, 'Primary')
     derivative_dir = os.path.join(subject_folder, 'Derivative')
     ## Nested directory is the primary directory than subject folder than session folder 
-    nested_dir = os.path.join(primary_dir, f'sub-{subjectid}', 'ses-01012000')
+    nested_dir = os.path.join(primary_dir, f'sub-{eps_string}', 'ses-01012000')
     
     os.makedirs(nested_dir,exist_ok=True)
     
     return primary_dir, nested_dir, derivative_dir
 
 
-def create_readme_file(subject_folder):
+def create_readme_file(subject_folder, checksums=None):
     """ Makes README.txt file in primary dir"""
     readme_content = '''References ---------- 
     Appelhoff, S., Sanderson, M., Brooks, T., Vliet, M., Quentin, R., Holdgraf, C., Chaumon, M., Mikulan, E., 
@@ -66,28 +120,34 @@ def create_readme_file(subject_folder):
     (2019). MNE-BIDS: Organizing electrophysiological data into the BIDS format and facilitating their analysis. 
     Journal of Open Source Software 4: (1896). https://doi.org/10.21105/joss.01896'''
 
-    with open(os.path.join(subject_folder, 'README.txt'), 'w') as f:
+    with open_hashed(os.path.join(subject_folder, 'README.txt'), checksums, 'w') as f:
         f.write(readme_content)
 
-def create_participants_file(subject_folder, primary_dir, pipeline_folder):
+def load_deidentified_data(pipeline_folder, use_snapshot=False):
+    """ Load deidentified_data.csv from the pipeline folder, keyed by HUP number """
+    return load_deidentified_index(pipeline_folder, use_snapshot)
+
+def create_participants_file(subject_folder, primary_dir, pipeline_folder, deiddata=None):
     """ Creates participants.tsv file """
-    deiddata =  pd.read_csv(os.path.join(pipeline_folder, 'deidentified_data.csv'), encoding='latin1')
-    subject_id = re.sub(r"[^0-9]","", os.path.basename(subject_folder.split("_")[0]))
-    regex = "^0+(?!$)"
-    new_subjid = re.sub(regex, "", subject_id)
-    subj_deid = deiddata[deiddata.iloc[:, 0] == new_subjid]
-    mri_date = (subj_deid['MRI Date:']).to_string(index = False)
-    
-    if not subj_deid.empty:
+    # Batch mode loads the de-identified data once per worker and passes it in
+    if deiddata is None:
+        deiddata = load_deidentified_data(pipeline_folder)
+    subject_id = re.sub(r"[^0-9]","", os.path.basename(subject_folder).split("_")[0])
+    subj_deid, mri_date = lookup_participant(deiddata, subject_id)
+    
+    if subj_deid:
         #print(f"Found '{subject_id}' in de-identified data")
-        subj_deid.to_csv(os.path.join(primary_dir,"partcipants.csv"), index=False)
+        with open(os.path.join(primary_dir,"partcipants.csv"), 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(deiddata['header'])
+            writer.writerows(subj_deid)
    # else:
         #print(f"'{subject_id}' not found in the first column.")
         
     
     return mri_date
         
-def create_dataset_description(primary_dir):
+def create_dataset_description(primary_dir, checksums=None):
     """ Create dataset_description.json"""
     dataset_description = {
                 "Name": "",
@@ -101,11 +161,11 @@ def create_dataset_description(primary_dir):
                 }
     
     # Writing to json
-    with open(os.path.join(primary_dir, "dataset_description.json"), "w") as outfile:
+    with open_hashed(os.path.join(primary_dir, "dataset_description.json"), checksums, "w") as outfile:
         json.dump(dataset_description, outfile, indent =4)
         
 
-def create_participants_json(primary_dir):
+def create_participants_json(primary_dir, checksums=None):
     """ Create participants.json"""
     ## Needs to be improved significantly !!!!
     participantsjson = {
@@ -143,7 +203,7 @@ def create_participants_json(primary_dir):
 
 
     # Writing to json
-    with open(os.path.join(primary_dir,"partcipants.json"), "w") as outfile:
+    with open_hashed(os.path.join(primary_dir,"partcipants.json"), checksums, "w") as outfile:
         json.dump(participantsjson, outfile, indent=4) 
         
 def find_files_by_type(folder_path, file_extension):
@@ -156,26 +216,167 @@ def find_files_by_type(folder_path, file_extension):
     
     
 
-def process_edf_files(subject_folder, primary_dir, nested_dir, modlevelfolder, nested_name, eps_string):
-    """ Creates channels.tsv file for all data """
+def run_sort_key(file):
+    """ Sort EDF files by run number, numerically where the run is a number """
+    run_number = get_run_number_from_file(file) or ''
+    return (0, int(run_number), file) if run_number.isdigit() else (1, 0, file)
+
+
+def map_runs(function, items, workers=1):
+    """ Apply function to every item on a bounded thread pool, results in input order """
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+
+def journaled_anchor(journal):
+    """ De-identification date anchor an earlier invocation fixed, None if there is none yet """
+    if journal is not None and journal.value('edf_shift_days') is not None:
+        return ANCHOR_DATE + timedelta(days=journal.value('edf_shift_days'))
+
+
+def journal_anchor(journal, anchor):
+    """ Fix the date anchor for a resumed run; the journal only keeps it as the days the dates are shifted by """
+    if journal is not None and anchor is not None:
+        journal.set('edf_shift_days', (anchor - ANCHOR_DATE).days)
+
+
+def process_edf_runs(subject_folder, moved, done_runs, eps_string, process_run, workers=1, journal=None):
+    """ De-identify and move every EDF run in the subject folder, return the new runs keyed by run number """
+    # Runs are handled in run number order so serial and parallel output are identical
+    pending = {}
+    for file in find_files_by_type(subject_folder +'/', '.edf') + moved:
+        run_number = get_run_number_from_file(file).replace('run-', '')
+        if run_number not in done_runs:
+            pending.setdefault(run_number, file)
+    found_files = sorted(pending.values(), key=run_sort_key)
+    headers = map_runs(read_edf_header, found_files, workers)
+    
+    # Patch patient, recording and start date/time in every header and verify them, header bytes only.
+    # The date anchor is journaled so a resumed run shifts the remaining runs exactly like the first ones
+    anchor = journaled_anchor(journal)
+    if anchor is None:
+        anchor = subject_anchor(headers, eps_string)
+        journal_anchor(journal, anchor)
     
+    runs = map_runs(lambda item: process_run(item[0], item[1], anchor), list(zip(found_files, headers)), workers)
+    return {run['audit']['run']: run for run in runs}
 
 
-    column_names = ["name","type","units","low_cutoff","high_cutoff","description","sampling_frequency","status","status_description"]
-    data = []
+def stream_edf_runs(moved, edf_source, done_runs, eps_string, process_run, workers=1, journal=None):
+    """ De-identify and move every EDF run as edf_source yields it, return the new runs keyed by run number and the anchor """
+    # The date anchor is fixed by the first run that arrives, reshift_edf_runs corrects it if an earlier one follows
+    anchor = journaled_anchor(journal)
+    seen = set(done_runs)
+    futures = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for file in itertools.chain(moved, edf_source):
+            run_number = get_run_number_from_file(file).replace('run-', '')
+            if run_number in seen:
+                # Converted again after an interruption; the de-identified copy is already in the BIDS tree
+                os.remove(file)
+                continue
+            seen.add(run_number)
+            header = read_edf_header(file)
+            if anchor is None:
+                anchor = subject_anchor([header], eps_string)
+                journal_anchor(journal, anchor)
+            futures.append(executor.submit(process_run, file, header, anchor))
     
-        
+    runs = [future.result() for future in futures]
+    return {run['audit']['run']: run for run in runs}, anchor
+
+
+def reshift_edf_runs(nested_path, nested_name, new_runs, done_runs, anchor, journal=None):
+    """ Shift the start of every streamed run again if a run arriving later started on an earlier day than anchor
+
+    Runs only carry their shifted start: a run from before the anchor day was shifted to before the first session day,
+    and every run moves on by the days in between.
+    """
+    runs = dict(done_runs, **new_runs)
+    starts = {run_number: datetime.fromisoformat(run['start']) for run_number, run in runs.items() if run.get('start')}
+    earliest = day_anchor(starts.values())
+    if earliest is None or earliest >= ANCHOR_DATE:
+        return
+    
+    shift = ANCHOR_DATE - earliest
+    for run_number, start in starts.items():
+        fields, changed, mismatched = reshift_edf_file(os.path.join(nested_path, edf_run_name(nested_name, run_number)),
+                                                       start + shift)
+        if mismatched:
+            raise RuntimeError(f"De-identification could not be verified for run {run_number}")
+        run = runs[run_number]
+        run['audit']['values'].update(fields)
+        run['audit']['changed'] += [name for name in changed if name not in run['audit']['changed']]
+        run['audit']['unchanged'] = [name for name in run['audit']['values'] if name not in run['audit']['changed']]
+        run['start'] = (start + shift).isoformat()
+        new_runs[run_number] = run
+        if journal is not None:
+            journal.record_run(run_number, run)
+    journal_anchor(journal, anchor - shift)
+
+
+def process_edf_files(subject_folder, primary_dir, nested_dir, modlevelfolder, nested_name, eps_string, workers=1, journal=None,
+                      mne_channels=False, edf_source=None, checksums=None):
     """ Process edf files and generate all sidecar files """
-    found_files = find_files_by_type(subject_folder +'/', '.edf')
-    total_duration = 0
+    nested_path = nested_dir + '/' + modlevelfolder +'/'
+    # Runs an interrupted invocation already de-identified and moved
+    done_runs = journal.runs() if journal is not None else {}
+    
+    def process_run(file, header, anchor):
+        """ De-identify one EDF and move it into the BIDS tree """
+        record = deidentify_edf_file(file, header, eps_string, anchor)
+        if not record['verified']:
+            raise RuntimeError(f"De-identification could not be verified for {record['file']}")
+        run_number =get_run_number_from_file(file).replace('run-', '')
+        # Move edf files, unless a crashed run already did
+        if os.path.dirname(os.path.abspath(file)) != os.path.abspath(nested_path):
+            move_edf_file(file, nested_path + '/', nested_name, run_number)
+        # The converter wrote the data, so the run is read once here, right after its header patch; the move kept the inode
+        if checksums is not None:
+            checksums.hash(os.path.join(nested_path, edf_run_name(nested_name, run_number)))
+        # The audit names the run rather than the source file, which carries the subject ID
+        del record['file']
+        record['run'] = run_number
+        run = {'duration': header['duration'], 'audit': record}
+        if header['start'] is not None:
+            # The shifted start (never the original one) lets a streamed subject be shifted again if an earlier run
+            # shows up later
+            run['start'] = shifted_start(header, eps_string, anchor).isoformat()
+        if journal is not None:
+            journal.record_run(run_number, run)
+        return run
     
-    logging.getLogger('pyedflib').setLevel(logging.CRITICAL)
-    mne.set_log_level('CRITICAL')
+    # Runs that were moved but not journaled before a crash are picked up from the BIDS folder
+    moved = [file for file in find_files_by_type(nested_path, '.edf')
+             if get_run_number_from_file(file).replace('run-', '') not in done_runs]
+    if edf_source is None:
+        new_runs = process_edf_runs(subject_folder, moved, done_runs, eps_string, process_run, workers, journal)
+    else:
+        new_runs, anchor = stream_edf_runs(moved, edf_source, done_runs, eps_string, process_run, workers, journal)
+        reshift_edf_runs(nested_path, nested_name, new_runs, done_runs, anchor, journal)
+    
+    # Find duration per edf file from its header and add to overall duration variable, in run order
+    all_runs = sorted(set(new_runs) | set(done_runs), key=lambda run: run_sort_key('_' + run + '.edf'))
+    total_duration = 0
+    audit = []
+    for run_number in all_runs:
+        run = new_runs.get(run_number) or done_runs[run_number]
+        total_duration += run['duration']
+        audit.append(run['audit'])
     
 
-    edf_file = pyedflib.EdfReader(found_files[0])
-    edffile = mne.io.read_raw_edf(found_files[0])
+    # Channel layouts are indexed across every run from their headers, which are in place by now
+    write_channel_sidecars(subject_folder, nested_dir, modlevelfolder, nested_name, total_duration, mne_channels, checksums)
         
+    return audit
+
+
+def channel_sidecars(header, kinds, modlevelfolder, total_duration):
+    """ Rows of channels.tsv and the content of ieeg.json for one channel layout """
+    data = []
+    
     ecognum = 0
     ecgnum = 0
     emgnum = 0
@@ -183,86 +384,43 @@ def process_edf_files(subject_folder, primary_dir, nested_dir, modlevelfolder, n
     eognum = 0
     seegnum = 0 
     
-    for idx, channel in enumerate(edffile.info['chs']):  # Use raw channel data (not just names)
-        channel_name = edffile.info['ch_names'][idx]  # Channel name (string)
+    for idx, (channel_name, kind) in enumerate(kinds):
+        channel_header = header['channels'][idx]
         """ Find the type and description for each channel """
         if modlevelfolder == 'eeg/':
             typestr = "EEG"
             eegnum += 1
             description = "Electroencephalography"
         elif modlevelfolder == 'ieeg/':
-            if "grid" in channel_name.lower() or channel['kind'] == mne.io.constants.FIFF.FIFFV_EOG_CH:
+            if "grid" in channel_name.lower() or kind == 'eog':
                 typestr = "ECOG"
                 ecognum += 1
                 description = "Electrocorticography"
-            elif channel['kind'] == mne.io.constants.FIFF.FIFFV_ECG_CH:
+            elif kind == 'ecg':
                 typestr = "ECG"
                 ecgnum += 1
                 description = "Electrocardiography"
-            elif channel['kind'] == mne.io.constants.FIFF.FIFFV_EMG_CH:
+            elif kind == 'emg':
                 typestr = "EMG"
                 emgnum += 1
                 description = "Electromyography"
-            elif channel['kind'] == mne.io.constants.FIFF.FIFFV_EOG_CH:
+            elif kind == 'eog':
                 typestr = "EOG"
                 eognum += 1
                 description = "Electrooculography"
-            elif channel['kind'] == mne.io.constants.FIFF.FIFFV_EEG_CH:
+            elif kind == 'eeg':
                 typestr = "SEEG"
                 seegnum += 1
                 description = "Stereoelectroencephalography"
         
-        units = edf_file.getPhysicalDimension(1)
-        low_cutoff = edffile.info.get('lowpass')
-        high_cutoff = edffile.info.get('highpass')
-        samplingfreq = edffile.info.get('sfreq')
+        units = channel_header['units']
+        low_cutoff = channel_header['lowpass']
+        high_cutoff = channel_header['highpass']
         ## Add if loop if multiple folders for subject are here 
             ## add stuff here for channel status if it was removed 
-        data.append([channel_name, typestr, units, low_cutoff, high_cutoff, description, samplingfreq, "good", "n/a"])
+        data.append([channel_name, typestr, units, low_cutoff, high_cutoff, description, channel_header['sampling_frequency'], "good", "n/a"])
         
-        file_path = os.path.join(nested_dir, modlevelfolder, nested_name + '_channels.tsv')
-        with open(file_path, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(column_names)
-            writer.writerows(data)
-            
-    edf_file.close()
-    del edf_file
-    edffile.close()
-    del edffile
-            
-    for file in found_files:
-        
-        new_bytes = eps_string.encode('utf-8')
-        size_of_new_bytes = len(new_bytes)
-
-        blankbytes = b' ' * (80 - size_of_new_bytes)
-        final_bytes = new_bytes + blankbytes
-
-        with open(file, 'rb+') as f:
-            f.seek(8)
-            f.write(final_bytes)
-            
-            
-        edf_file = pyedflib.EdfReader(file)
-        edffile = mne.io.read_raw_edf(file)
-        run_number =get_run_number_from_file(file)
-        # Find duration per edf file and add to overall duration variable 
-        total_duration += edffile.times[-1]
-        
-        #edffile.info['patient_id'] = eps_string
-
-        #edffile.save(file, overwrite=True)
-        
-        nested_path = nested_dir + '/' + modlevelfolder +'/'
-        
-        # Move edf files
-        move_edf_file(file, nested_path + '/', nested_name, run_number)
-        
-        edf_file.close()
-        del edf_file
-        edffile.close()
-        del edffile
+    samplingfreq = header['sampling_frequency']
             
         
     # Generate iEEG json 
@@ -285,16 +443,207 @@ def process_edf_files(subject_folder, primary_dir, nested_dir, modlevelfolder, n
         "TriggerChannelCount": 0
         }
     
-   # with open(os.path.join(nested_dir, modlevelfolder, nested_name + '_' + f'{run_number}_ieeg.json'), 'w') as outfile:
-    with open(os.path.join(nested_dir, modlevelfolder, nested_name  + '_ieeg.json'), 'w') as outfile:
+    return data, ieeg_json
+
+
+def write_channel_sidecars(subject_folder, nested_dir, modlevelfolder, nested_name, total_duration, mne_channels=False,
+                           checksums=None):
+    """ channels.tsv and ieeg.json of the session, per run where a run's channel layout differs, and the channel index
+
+    The layout most runs share describes the session; MNE is only imported when the kinds are asked to come from it.
+    Returns the index of run -> signature.
+    """
+    nested_path = os.path.join(nested_dir, modlevelfolder)
+    files = sorted(find_files_by_type(nested_path, '.edf'), key=run_sort_key)
+    index, headers = index_runs(files)
+    
+    sidecars = {}
+    for path in files:
+        signature = index['runs'][os.path.basename(path)]
+        if signature == index['default']:
+            name, duration = nested_name, total_duration
+        else:
+            name, duration = nested_name + '_' + get_run_number_from_file(path), headers[path]['duration']
+        sidecars[name] = (path, duration)
+    
+    # Per-run sidecars of an earlier layout of the runs (before a merge renamed them) would describe the wrong files
+    for suffix in ('_channels.tsv', '_ieeg.json'):
+        for stale in glob.glob(os.path.join(glob.escape(nested_path), nested_name + '_run-*' + suffix)):
+            if os.path.basename(stale)[:-len(suffix)] not in sidecars:
+                os.remove(stale)
+    
+    for name, (path, duration) in sidecars.items():
+        header = headers[path]
+        kinds = mne_channel_kinds(path) if mne_channels else channel_kinds(header)
+        data, ieeg_json = channel_sidecars(header, kinds, modlevelfolder, duration)
+        create_csv(os.path.join(nested_path, name + '_channels.tsv'), CHANNEL_COLUMNS, data, checksums)
+        with open_hashed(os.path.join(nested_path, name + '_ieeg.json'), checksums, 'w') as outfile:
+            json.dump(ieeg_json, outfile, indent=4)
+    
+    with open_hashed(os.path.join(subject_folder, 'Derivative', nested_name + CHANNEL_INDEX_SUFFIX), checksums, 'w') as outfile:
+        json.dump(index, outfile, indent=4)
+    if len(index['signatures']) > 1:
+        sys.stderr.write(f"{len(index['signatures'])} channel layouts across the runs of {os.path.basename(subject_folder)}, "
+                         f"sidecars of their own for {len(sidecars) - 1} runs\n")
+    
+    return index
+
+
+def merge_plan_entry(planned, name):
+    """ Journal form of a planned merged file, its pieces naming the runs they come from """
+    return {'name': name, 'start': planned['start'].isoformat(), 'gaps': planned['gaps'], 'annotated': planned['annotated'],
+            'unchanged': planned['unchanged'],
+            'duration': float(sum(count * segment['record_duration'] for segment, record, count, onset in planned['pieces'])),
+            'pieces': [[os.path.basename(segment['path']), record, count, str(onset)]
+                       for segment, record, count, onset in planned['pieces']]}
+
+
+def planned_merge_file(entry, nested_path, segments):
+    """ Planned file of a journaled entry; the runs it reads are parsed once into segments """
+    pieces = []
+    for run_name, record, count, onset in entry['pieces']:
+        if run_name not in segments:
+            segments[run_name] = read_segment(os.path.join(nested_path, run_name),
+                                              get_run_number_from_file(run_name).replace('run-', ''))
+        pieces.append((segments[run_name], record, count, Fraction(onset)))
+    
+    return {'pieces': pieces, 'start': datetime.fromisoformat(entry['start']), 'gaps': entry['gaps'],
+            'annotated': entry['annotated'], 'unchanged': entry['unchanged']}
+
+
+def merge_edf_runs(nested_path, nested_name, max_bytes=0, journal=None, checksums=None, scratch=None):
+    """ Merge the EDF runs of the BIDS folder into as few files as their records allow, or files of at most max_bytes
+
+    Returns {'inputs', 'files': [{'name', 'start', 'duration', 'gaps', ...}], 'segments': where every run went}. The plan
+    is journaled first, every new file is written next to the runs as <name>.merge and journaled once it is on disk, so
+    an interrupted merge goes on with the files it had not written; the runs are only replaced once all files are there
+    and the switch is journaled. With a scratch budget every file claims its size before it is written, and a run is
+    deleted as soon as every file with records of it is on disk.
+    """
+    merge = journal.value('edf_merge') if journal is not None else None
+    if merge is None:
+        plan = journal.value('edf_merge_plan') if journal is not None else None
+        if plan is None:
+            for leftover in find_files_by_type(nested_path, '.edf.merge'):
+                os.remove(leftover)
+            inputs = sorted(find_files_by_type(nested_path, '.edf'), key=run_sort_key)
+            segments = [read_segment(file, get_run_number_from_file(file).replace('run-', '')) for file in inputs]
+            planned_files = plan_files(segments, max_bytes)
+            names = [edf_run_name(nested_name, f'{idx + 1:05d}') for idx in range(len(planned_files))]
+            plan = {'inputs': [os.path.basename(file) for file in inputs],
+                    'files': [merge_plan_entry(planned, name) for planned, name in zip(planned_files, names)],
+                    'segments': segment_listing(planned_files, names), 'written': []}
+            if journal is not None:
+                journal.set('edf_merge_plan', plan)
+        
+        # Files that take records of each run, a run is an intermediate until all of them are written
+        readers = {}
+        for entry in plan['files']:
+            for run_name, record, count, onset in entry['pieces']:
+                readers.setdefault(run_name, set()).add(entry['name'])
+        
+        segments = {}
+        for entry in plan['files']:
+            if entry['name'] in plan['written']:
+                continue
+            planned = planned_merge_file(entry, nested_path, segments)
+            tmp = os.path.join(nested_path, entry['name'] + '.merge')
+            if entry['unchanged']:
+                # A run that stays whole keeps its bytes (and inode), only its name may change
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+                os.link(planned['pieces'][0][0]['path'], tmp)
+            else:
+                with scratch.claim(file_bytes(planned)) if scratch is not None else nullcontext():
+                    with open(tmp, 'wb') as raw:
+                        out = HashingWriter(raw)
+                        write_file(planned, out)
+                        raw.flush()
+                        os.fsync(raw.fileno())
+                if checksums is not None:
+                    checksums.record(tmp, out.hasher.digests())
+            plan['written'].append(entry['name'])
+            if journal is not None:
+                journal.set('edf_merge_plan', plan)
+            if scratch is not None:
+                for run_name in {piece[0] for piece in entry['pieces']}:
+                    if readers[run_name] <= set(plan['written']):
+                        scratch.remove(os.path.join(nested_path, run_name))
+        
+        merge = {'inputs': plan['inputs'], 'files': plan['files'], 'segments': plan['segments']}
+        if journal is not None:
+            journal.set('edf_merge', merge)
+    
+    # Runs are removed before the new files take their names; a run whose name is already taken by a new file is gone
+    names = {entry['name'] for entry in merge['files']}
+    for name in merge['inputs']:
+        path = os.path.join(nested_path, name)
+        if name in names and not os.path.exists(path + '.merge'):
+            continue
+        if os.path.exists(path):
+            os.remove(path)
+    for entry in merge['files']:
+        tmp = os.path.join(nested_path, entry['name'] + '.merge')
+        if os.path.exists(tmp):
+            os.replace(tmp, os.path.join(nested_path, entry['name']))
+    
+    return merge
+
+
+def write_merge_sidecars(subject_folder, nested_dir, modlevelfolder, nested_name, merge, checksums=None):
+    """ scans.tsv of the merged files, the original segments they hold, and the duration and type in ieeg.json """
+    with open_hashed(os.path.join(nested_dir, nested_name + '_scans.tsv'), checksums, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(['filename', 'acq_time', 'duration'])
+        for entry in merge['files']:
+            writer.writerow([modlevelfolder + entry['name'], entry['start'], entry['duration']])
+    
+    # The segment boundaries are not part of the raw data, they are listed with the derivatives
+    columns = ['filename', 'onset', 'duration', 'segment', 'first_record', 'acq_time']
+    with open_hashed(os.path.join(subject_folder, 'Derivative', nested_name + '_segments.tsv'), checksums, 'w',
+                     newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(columns)
+        for row in merge['segments']:
+            writer.writerow([row[column] for column in columns])
+    
+    # Records only are counted, gaps between them are not recording time
+    ieeg_path = os.path.join(nested_dir, modlevelfolder, nested_name + '_ieeg.json')
+    with open(ieeg_path) as f:
+        ieeg_json = json.load(f)
+    ieeg_json['RecordingDuration'] = sum(entry['duration'] for entry in merge['files'])
+    if any(entry['gaps'] for entry in merge['files']):
+        ieeg_json['RecordingType'] = "discontinuous"
+    with open_hashed(ieeg_path, checksums, 'w') as outfile:
         json.dump(ieeg_json, outfile, indent=4)
+    
+    # A merged file with a channel layout of its own has its own ieeg.json, which says whether it has gaps
+    for entry in merge['files']:
+        run_path = os.path.join(nested_dir, modlevelfolder, entry['name'][:-len('.edf')] + '_ieeg.json')
+        if entry['gaps'] and os.path.exists(run_path):
+            with open(run_path) as f:
+                run_json = json.load(f)
+            run_json['RecordingType'] = "discontinuous"
+            with open_hashed(run_path, checksums, 'w') as outfile:
+                json.dump(run_json, outfile, indent=4)
+
 
+def write_deidentification_audit(subject_folder, audit, checksums=None):
+    """ Write the per-file header de-identification audit next to README.txt """
+    with open_hashed(os.path.join(subject_folder, 'deidentification_audit.json'), checksums, 'w') as outfile:
+        json.dump(audit, outfile, indent=4)
+
+
+
+def edf_run_name(nested_name, run_number):
+    """ BIDS file name of an EDF run """
+    return nested_name + f'_run-{run_number}.edf'
 
 
 def move_edf_file(file, nested_path, nested_name, run_number):
     """ Move edf file to proper location within BIDs"""
     #edf_filename = os.path.basenmae(file)
-    edf_filename = nested_name + f'_run-{run_number}.edf'
+    edf_filename = edf_run_name(nested_name, run_number)
     os.rename(file, os.path.join(nested_path, edf_filename))
     
         
@@ -309,285 +658,111 @@ def get_run_number_from_file(file):
         return str(file[last_underscore_index + 1:dot_index]).zfill(5)
     
 
-def create_csv(channelnames, column_names, data):
+def edf_run_offsets(nested_path):
+    """ (run number, seconds since the start of the first run) of the EDF runs moved into the BIDS folder """
+    runs = []
+    for file in sorted(find_files_by_type(nested_path, '.edf'), key=run_sort_key):
+        header = read_edf_header(file)
+        runs.append((get_run_number_from_file(file).replace('run-', ''), header['start'], header['duration'] or 0))
+    
+    offsets = []
+    elapsed = 0
+    for run_number, start, duration in runs:
+        # De-identified start dates are all shifted by the same amount, so their differences still hold;
+        # runs without a valid start are assumed to follow the previous run directly
+        if start is not None and runs[0][1] is not None:
+            elapsed = (start - runs[0][1]).total_seconds()
+        offsets.append((run_number, elapsed))
+        elapsed += duration
+    
+    return offsets
 
-    with open(channelnames, 'w', newline='') as csvfile:
+
+def create_csv(channelnames, column_names, data, checksums=None):
+
+    with open_hashed(channelnames, checksums, 'w', newline='') as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(column_names)
         writer.writerows(data)
     
 
-def other_data(pipeline_folder, subject_folder, subjectid, nesteddirectory, modlevelfolder, nested_name, mri_date):
+def other_data(pipeline_folder, subject_folder, subjectid, eps_string, nesteddirectory, modlevelfolder, nested_name, mri_date,
+               placement='auto', stream_imaging=False, split_events=False, checksums=None, duplicate_mode='collapse',
+               scratch=None):
     """ Find montages if exist and place in derivative folder """
-    for filename in os.listdir(pipeline_folder + '/montages'):
-        folder_path = os.path.join(pipeline_folder + '/montages/', filename)
-        if subjectid in filename:
-            shutil.copy(pipeline_folder + '/montages/' + filename, subject_folder + '/Derivative/' + subjectid + 'montage.json')
+    # Subject files are looked up in the pipeline folder index instead of scanning every filename
+    for filename in find_subject_files(pipeline_folder, subjectid, 'montages'):
+        # Hashed while it is copied, like every other output
+        with open(pipeline_folder + '/montages/' + filename, 'rb') as source, \
+                open_hashed(subject_folder + '/Derivative/' + eps_string + 'montage.json', checksums, 'wb') as outfile:
+            shutil.copyfileobj(source, outfile)
     
     """ Find annotation files and place into events.tsv"""
-    for filename in os.listdir(pipeline_folder + '/annotations'):
-        folder_path = os.path.join(pipeline_folder + '/annotations/', filename)
-        if subjectid in filename:
-            if os.path.getsize(folder_path) > 1:
-               # subjannot = filename
-                annotations =  pd.read_csv(pipeline_folder + '/annotations/' + filename, sep = '\t')
-                annotations = annotations.iloc[:, :-4]
-                annotations = annotations.rename(columns={'description': 'trial_type', 'parent': 'channel'})
-                annotations.to_csv(subject_folder + '/Primary/' + nesteddirectory + modlevelfolder +  '/' + nested_name + '_events.tsv', sep='\t', index=False)
-                annotations_json = {
-                    "trial_type": {
-                        "LongName": "Event",
-                        "Description": "Any annotated event by neurologist",
-                    },
-                    "channel": {
-                        "Description": "Channel(s) associated with the event",
-                        "Delimiter": ""
-                    }
-                }
-                
-                with open(subject_folder + '/Primary/' + nesteddirectory + modlevelfolder + '/' + nested_name + '_events.json', "w") as outfile:
-                    json.dump(annotations_json, outfile, indent=4)
+    # Every annotation file of the subject is merged into the events, streamed row by row
+    annotations = [os.path.join(pipeline_folder, 'annotations', filename)
+                   for filename in find_subject_files(pipeline_folder, subjectid, 'annotations')]
+    annotations = [path for path in annotations if os.path.isfile(path) and os.path.getsize(path) > 1]
+    if annotations:
+        events_dir = subject_folder + '/Primary/' + nesteddirectory + modlevelfolder
+        runs = edf_run_offsets(events_dir) if split_events else []
+        if runs:
+            # One events.tsv per EDF run, onsets relative to the start of the run
+            write_events_per_run(annotations, runs,
+                                 lambda run_number: os.path.join(events_dir, f'{nested_name}_run-{run_number}_events.tsv'),
+                                 checksums)
+        else:
+            write_events(annotations, os.path.join(events_dir, nested_name + '_events.tsv'), checksums)
+        
+        with open_hashed(os.path.join(events_dir, nested_name + '_events.json'), checksums, "w") as outfile:
+            json.dump(EVENTS_SIDECAR, outfile, indent=4)
 
 
         
      ####################################################################### 
      #               Finds if imaging exists and properly moves it
+    primary_dir = subject_folder + '/Primary'
+    subject_label = nesteddirectory.split('/')[0]
+    ct_session = nesteddirectory.split('/')[1]
+    placements = []
     imaging_directory_found = False
-    run_number_ct = 1
     # Check if objects folder exists here 
     object_dir = subject_folder + '/objects'
     if os.path.isdir(object_dir):
-        for filename in os.listdir(object_dir):
-            folder_path = os.path.join(object_dir, filename)
-            # change the name when unzipped so annoying
-            if "imag" in filename and os.path.isdir(folder_path):
-                #print(filename)
-                imaging_directory_found = True
-                imaging_type = ".nii"
-                imaging_files = find_files_by_type(object_dir + '/' + filename, imaging_type)
-                for imaging in imaging_files:
-                    if "ct" in imaging.lower():
-                        os.chdir(subject_folder + '/Primary/' + nesteddirectory)
-                        if run_number_ct == 1:
-                            os.makedirs('ct', exist_ok=True)
-                        ct_path = subject_folder + '/Primary/' + nesteddirectory + 'ct/' + nested_name + f'_run-{run_number_ct:02d}_ct.nii'
-                        shutil.copy(imaging, ct_path)
-                        ct_json = {
-                        "Modality": "CT",  
-                        "ImagingFrequency": 0,
-                        "Manufacturer": "",
-                        "ManufacturersModelName": "",  
-                        "InstitutionName": "", 
-                        "InstitutionAddress": "", 
-                        "DeviceSerialNumber": "",  
-                        "StationName": "",  
-                        "BodyPartExamined": "",
-                        "PatientPosition": "",  
-                        "SoftwareVersions": "",  
-                        "SeriesDescription": "",  
-                        "ProtocolName": "", 
-                        "ImageType": "",  
-                        "SeriesNumber": "",  
-                        "AcquisitionTime": "",  
-                        "AcquisitionNumber": "",  
-                        "ImageComments": "",  
-                        "ConvolutionKernel": "",  
-                        "ExposureTime": "", 
-                        "XRayTubeCurrent": "",  
-                        "XRayExposure": "", 
-                        "ImageOrientationPatientDICOM": "",  
-                        "ConversionSoftware": "",  
-                        "ConversionSoftwareVersion": ""
-                    }
-                        json_ct = json.dumps(ct_json, indent=4)
-                        # Writing to json
-                        with open(subject_folder + '/Primary/' + nesteddirectory + '/ct/' + nested_name + f'_run-{run_number_ct:02d}_ct.json', "w") as outfile:
-                            outfile.write(json_ct)
-                        run_number_ct += 1
-                        
-                    if any(x in imaging.lower() for x in ["t1", "t2", "flair","mprage"]):
-                        #print("Made it inside imaging loop")
-                        run_number_t2 = 1 
-                        run_number_t1 = 1  
-                        date_pattern = r'(\d{8})'
-                        
-                        match = re.search(date_pattern, imaging)
-                        #If date is in string do this
-                        if match:
-                            date_str = match.group(1)
-                            date_obj = datetime.strptime(date_str, "%Y%m%d")
-                            formatted_date = date_obj.strftime("%m%d%Y")
-                            
-                            folder_path = os.path.join(subject_folder, 'Primary', f'sub-{subjectid}', f'ses-{formatted_date}', 'anat')
-
-                            # Check if the folder exists
-                            if not os.path.exists(folder_path):
-                                os.makedirs(folder_path, exist_ok=True)
-                            
-                            rootmri = subject_folder  + '/Primary/sub-' + subjectid + '/ses-' + formatted_date + '/anat/sub-' + subjectid + '_ses-' + formatted_date
-                    
-                            
-                        # If no date in string search the participants tsv to find date
-                        else:                    
-                            if run_number_t2 == 1 and run_number_t2 == 1:
-                        
-                                datemriobj = datetime.strptime(mri_date, "%m/%d/%y")
-                                formatted_date = datemriobj.strftime("%m%d%Y")
-                            
-                                os.makedirs(subject_folder + '/Primary/sub-' + subjectid + '/ses-' + formatted_date + '/anat', exist_ok=True)
-                                rootmri = subject_folder  + '/Primary/sub-' + subjectid + '/ses-' + formatted_date + '/anat/sub-' + subjectid + '_ses-' + formatted_date
-                        
-                        if "t2" in imaging.lower():
-                            mri_path = rootmri + f'_run-{run_number_t2:02d}_T2.nii'
-                            shutil.copy(imaging, mri_path)
-                            jsonpath = rootmri + f'_run-{run_number_t2:02d}_T2.json'
-                            run_number_t2 += 1  
-                        else: 
-                            mri_path = rootmri + f'_run-{run_number_t1:02d}_T1w.nii'
-                            shutil.copy(imaging, mri_path)
-                            jsonpath = rootmri + f'_run-{run_number_t1:02d}_T1w.json'
-                            run_number_t1 += 1
-                        mri_json = {
-                        "Modality": "MR",
-                        "MagneticFieldStrength": "",
-                        "ImagingFrequency": "",
-                        "Manufacturer": "",
-                        "ManufacturersModelName": "",
-                        "InstitutionName": "",
-                        "InstitutionalDepartmentName": "",
-                        "InstitutionAddress": "",
-                        "DeviceSerialNumber": "",
-                        "StationName": "",
-                        "BodyPartExamined": "",
-                        "PatientPosition": "",
-                        "ProcedureStepDescription": "",
-                        "SoftwareVersions": "",
-                        "MRAcquisitionType": "",
-                        "SeriesDescription": "",
-                        "ProtocolName": "",
-                        "ScanningSequence": "",
-                        "SequenceVariant": "",
-                        "ScanOptions": "",
-                        "SequenceName": "",
-                        "ImageType": [""
-                        ],
-                        "NonlinearGradientCorrection": "",
-                        "SeriesNumber": "",
-                        "AcquisitionTime": "",
-                        "AcquisitionNumber": "",
-                        "SliceThickness": "",
-                        "SAR": "",
-                        "EchoTime": "",
-                        "RepetitionTime": "",
-                        "InversionTime": "",
-                        "FlipAngle": "",
-                        "PartialFourier": "",
-                        "BaseResolution": "",
-                        "ShimSetting": [""
-                        ],
-                        "TxRefAmp": "",
-                        "PhaseResolution": "",
-                        "ReceiveCoilName": "",
-                        "CoilString": "",
-                        "PulseSequenceDetails": "",
-                        "CoilCombinationMethod": "",
-                        "MatrixCoilMode": "",
-                        "PercentPhaseFOV": "",
-                        "PercentSampling": "",
-                        "PhaseEncodingSteps": "",
-                        "AcquisitionMatrixPE": "",
-                        "ReconMatrixPE": "",
-                        "PixelBandwidth": "",
-                        "DwellTime": "",
-                        "ImageOrientationPatientDICOM": [""
-                        ],
-                        "ImageOrientationText": "",
-                        "InPlanePhaseEncodingDirectionDICOM": "",
-                        "ConversionSoftware": "",
-                        "ConversionSoftwareVersion": ""
-                    }
-                        
-                        json_mri = json.dumps(mri_json, indent=4)
-                        # Writing to json, UPDATE THE SESSION LEVEL FOLDER !!!!
-                        with open(jsonpath, "w") as outfile:
-                            outfile.write(json_mri)
+        if stream_imaging:
+            # Volumes go straight from the zip archives to their BIDS paths
+            placements = extract_imaging_archives(object_dir, primary_dir, subject_label, ct_session, mri_date, checksums,
+                                                  duplicate_mode, scratch)
+            imaging_directory_found = bool(placements)
+        else:
+            imaging_files = find_imaging_volumes(object_dir)
+            imaging_directory_found = bool(imaging_files)
+            placements = place_imaging_volumes(imaging_files, primary_dir, subject_label, ct_session, mri_date, placement,
+                                               checksums, duplicate_mode, scratch)
 
    # if not imaging_directory_found: 
         #print("No imaging directory found")
-
-def generate_eps_string(pipeline_folder):
-    # Path to the CSV file
-    epscsv = pipeline_folder + "/epsnumber.csv"
     
-    # Read the CSV file and get the number from the first column
-    with open(epscsv, newline='', encoding='utf-8-sig') as csvfile:
-        csvreader = csv.reader(csvfile)
-        row = next(csvreader)  
-        number = int(row[0])  
-        
-    # Increment the number by 1
-    number += 1
+    return placements
 
-    # Create the string with the required formatting
-    eps_string = f"EPS{str(number).zfill(7)}"  # zfill will add leading zeros to make the string 7 digits
+def generate_eps_string(pipeline_folder, subject=None, allocator=None):
+    """ Allocate the EPS identifier for a subject from the pipeline folder's allocator """
+    # Batch workers pass their own allocator so they can lease blocks of numbers
+    if allocator is not None:
+        return allocator.allocate(subject)
     
-    new_num = str(number)
+    allocator = EpsAllocator(pipeline_folder)
+    try:
+        return allocator.allocate(subject)
+    finally:
+        allocator.close()
 
-    # Write the updated number back to the CSV file
-    with open(epscsv, mode='w', newline='') as csvfile:
-        csvwriter = csv.writer(csvfile)
-        csvwriter.writerows(new_num)
-        
-        
-    return eps_string
-
-
-def replace_in_directory(subject_folder, eps_string, subject_id):
-    # Walk through the directory structure
-    for root, dirs, files in os.walk(subject_folder, topdown=False):  
-        all_items = dirs + files
-
-        for item in all_items:
-            old_item_path = os.path.join(root, item)
-
-            # Check if "sub-" is in the filename and replace the part after sub- and before the first "_"
-            new_name = item
-            if "sub-" in item:
-                # Find the part after "sub-" and before the first "_"
-                before_underscore = item.split("-")[1].split("_")[0]
-                new_name = item.replace(f"sub-{before_underscore}", f"sub-{eps_string}")  
-                
-            # Replace 'subjectid' with the EPS number
-            elif subject_id in item:
-                modified_item = item.replace(subject_id, "")
-                if len(re.findall(r'\d', modified_item)) <= 1:
-                    before_subject_id = item.split(subject_id)[0] 
-                    new_name = item.replace(before_subject_id + subject_id, eps_string)  
-                else:
-                    pass
-
-            # Replace 'RID' and the next 3 characters after it with the EPS number
-            elif "RID" in item:
-                rid_index = item.find("RID")
-                new_name = item[:rid_index] + eps_string + item[rid_index + 6:]
-
-            # If the name has changed, rename the item (file or directory)
-            if new_name != item:
-                new_item_path = os.path.join(root, new_name)
-
-                # If it's a directory, rename the directory
-                if item in dirs:
-                    os.rename(old_item_path, new_item_path)
-                    #print(f"Renamed directory {item} to {new_name}")
-                # If it's a file, rename the file
-                elif item in files:
-                    os.rename(old_item_path, new_item_path)
-                    #print(f"Renamed file {item} to {new_name}")
-
-def update_participants_tsv(primary_dir, eps_string):
+
+def update_participants_tsv(primary_dir, eps_string, checksums=None):
     # Path to the participants.tsv file
     participants_file_path = primary_dir + '/partcipants.csv'
     
+    # pandas is only imported by the stages that need it, it costs a good part of a second at startup
+    import pandas as pd
     df = pd.read_csv(participants_file_path)
 
     # Replace the header "HUP Number" with "EPS Number"
@@ -598,68 +773,389 @@ def update_participants_tsv(primary_dir, eps_string):
 
     # Save the DataFrame to a TSV file (tab-separated values)
     tsv_file_path = participants_file_path.replace('.csv', '.tsv')
-    df.to_csv(tsv_file_path, sep='\t', index=False)
+    with open_hashed(tsv_file_path, checksums, 'w', newline='') as f:
+        df.to_csv(f, sep='\t', index=False)
 
     # Delete the original CSV file
     os.remove(participants_file_path)
     
      
-def main():
-    # Define arguments 
-    args = parse_arguments()
-    subject_folder = args.folder1
-    pipeline_folder = args.folder2
+def format_imaging_report(imaging):
+    """ One line summary of the imaging placements of a subject """
+    line = f"Imaging placed: {imaging['files']} files, {imaging['bytes_written']} bytes written {imaging['modes']}"
+    if imaging.get('duplicates'):
+        linked = imaging.get('linked', 0)
+        collapsed = imaging['duplicates'] - linked
+        if collapsed:
+            line += f", {collapsed} duplicate volumes not placed"
+        if linked:
+            line += f", {linked} duplicate volumes linked to their first copy"
+        line += f" ({imaging['bytes_saved']} bytes not written)"
+    return line
+
+
+def format_scratch_report(scratch):
+    """ One line summary of the scratch budget of a subject """
+    line = (f"Scratch peak: {scratch['peak_bytes']} of {scratch['limit_bytes']} bytes, "
+            f"{scratch['freed_bytes']} bytes of intermediates deleted")
+    if scratch['waits']:
+        line += f", waited {scratch['waits']} times ({scratch['wait_seconds']} s)"
+    if scratch['overruns']:
+        line += f", over the budget {scratch['overruns']} times"
+    return line
+
+
+def subject_names(subject_folder):
+    """ (digits of the HUP number, HUP number) from the subject folder name, ex. ('199', 'HUP199') """
+    subjectid = os.path.basename(subject_folder).split("_")[0]
+    subject_id = re.sub(r"[^0-9]","", subjectid)
+    return subject_id, subjectid
+
+
+def modality_folder(data_type):
+    """ BIDS modality folder of a data type """
+    if data_type == "ieeg":
+        return 'ieeg/'
+    elif data_type == "scalp":
+        return 'eeg/'
+
+
+def plan_subject(subject_folder, pipeline_folder, eps_string, data_type, mri_date, placement='auto', stream_imaging=False,
+                 split_events=False, duplicate_mode='collapse', checksums=None, merge_runs=False, persist_index=True):
+    """ Plan every file of a subject under its final EPS-based name before anything is written
+
+    Duplicate volumes are found the way the sidecars stage finds them, hashed through checksums if given; a dry run
+    passes persist_index False so the pipeline index file is not rewritten.
+    """
+    subject_id, subjectid = subject_names(subject_folder)
+    plan = SubjectPlan(subject_folder, eps_string)
+    subject_label = 'sub-' + eps_string
+    session = 'ses-01012000'
+    nested_name = subject_label + '_' + session
+    primary_dir = os.path.join(subject_folder, 'Primary')
+    nested_path = os.path.join(primary_dir, subject_label, session, modality_folder(data_type))
+    
+    for name in ('README.txt', 'deidentification_audit.json', MANIFEST_NAME, CACHE_NAME):
+        plan.add('write', None, os.path.join(subject_folder, name))
+    for name in ('partcipants.tsv', 'dataset_description.json', 'partcipants.json'):
+        plan.add('write', None, os.path.join(primary_dir, name))
+    
+    # EDF runs are moved straight to their final names
+    edf_files = sorted(find_files_by_type(subject_folder +'/', '.edf'), key=run_sort_key)
+    for file in edf_files:
+        plan.add('move', file, os.path.join(nested_path, edf_run_name(nested_name, get_run_number_from_file(file))))
+    for suffix in ('_channels.tsv', '_ieeg.json'):
+        plan.add('write', None, os.path.join(nested_path, nested_name + suffix))
+    # Runs whose channel layout differs from most others also get these per run, which ones is only known from the headers
+    plan.add('write', None, os.path.join(subject_folder, 'Derivative', nested_name + CHANNEL_INDEX_SUFFIX))
+    if merge_runs:
+        # The merged files take the run names from run-00001 on, which files depends on the records
+        plan.add('write', ', '.join(os.path.basename(file) for file in edf_files),
+                 os.path.join(primary_dir, subject_label, session, nested_name + '_scans.tsv'))
+        plan.add('write', None, os.path.join(subject_folder, 'Derivative', nested_name + '_segments.tsv'))
+    
+    # Every montage of the subject goes to the same name, the last one wins; annotation files are merged
+    montages = find_subject_files(pipeline_folder, subjectid, 'montages', persist_index)
+    if montages:
+        plan.add('copy', os.path.join(pipeline_folder, 'montages', montages[-1]),
+                 os.path.join(subject_folder, 'Derivative', eps_string + 'montage.json'))
+    annotations = [os.path.join(pipeline_folder, 'annotations', filename)
+                   for filename in find_subject_files(pipeline_folder, subjectid, 'annotations', persist_index)]
+    annotations = [path for path in annotations if os.path.isfile(path) and os.path.getsize(path) > 1]
+    if annotations and split_events:
+        for file in edf_files:
+            run_number = get_run_number_from_file(file)
+            plan.add('write', ', '.join(annotations), os.path.join(nested_path, f'{nested_name}_run-{run_number}_events.tsv'))
+    elif annotations:
+        plan.add('write', ', '.join(annotations), os.path.join(nested_path, nested_name + '_events.tsv'))
+    if annotations:
+        plan.add('write', None, os.path.join(nested_path, nested_name + '_events.json'))
+    
+    # Imaging
+    object_dir = os.path.join(subject_folder, 'objects')
+    placed = set()
+    if os.path.isdir(object_dir):
+        duplicates = {}
+        if stream_imaging:
+            entries, archive_of = archive_entries(object_dir)
+            volumes = list(entries)
+            if duplicate_mode != 'off':
+                duplicates = archive_duplicates(entries, archive_of)
+        else:
+            volumes = find_imaging_volumes(object_dir)
+            if duplicate_mode != 'off':
+                duplicates = volume_duplicates(volumes, checksums)
+        for item in plan_imaging(volumes, primary_dir, subject_label, session, mri_date, duplicates, duplicate_mode):
+            # Collapsed duplicates stay where they are
+            if 'collapsed' in item:
+                continue
+            plan.add('place', item['source'], item['stem'] + '.nii')
+            plan.add('write', None, item['stem'] + '.json')
+            if item['content'] == item['source']:
+                placed.add(item['source'])
+    
+    # Everything else already in the subject folder keeps its place under an EPS-based name
+    consumed = set(edf_files)
+    if placement == 'rename' and not stream_imaging:
+        consumed.update(placed)
+    for root, dirs, files in os.walk(subject_folder):
+        if root == subject_folder:
+            dirs[:] = [name for name in dirs if name not in ('Primary', 'Derivative')]
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if path in consumed:
+                continue
+            relative = os.path.relpath(path, subject_folder)
+            final = os.path.join(*[final_name(part, eps_string, subject_id) for part in relative.split(os.sep)])
+            if final != relative:
+                plan.add('rename', path, os.path.join(subject_folder, final))
+    
+    plan.add('root', subject_folder, plan.final_folder)
     
+    return plan
+
+
+def preview_eps_string(pipeline_folder, subject):
+    """ EPS identifier a subject has, or the one it would most likely get next; nothing is allocated or written """
+    eps_string = lookup_assignment(pipeline_folder, subject)
+    if eps_string:
+        return eps_string
+    
+    return format_eps(read_eps_csv(pipeline_folder) + 1)
+
+
+def dry_run_subject(subject_folder, pipeline_folder, data_type, deiddata=None, placement='auto', stream_imaging=False,
+                    split_events=False, duplicate_mode='collapse', merge_runs=False):
+    """ Plan of a subject folder; nothing is written, in the subject folder or in the pipeline folder """
+    subject_folder = subject_folder.rstrip('/')
+    pipeline_folder = pipeline_folder.rstrip('/')
+    subject_id, subjectid = subject_names(subject_folder)
+    if deiddata is None:
+        deiddata = load_deidentified_data(pipeline_folder)
+    subj_deid, mri_date = lookup_participant(deiddata, subject_id)
+    eps_string = preview_eps_string(pipeline_folder, os.path.basename(subject_folder))
+    
+    plan = plan_subject(subject_folder, pipeline_folder, eps_string, data_type, mri_date, placement, stream_imaging,
+                        split_events, duplicate_mode, merge_runs=merge_runs, persist_index=False)
+    plan.check()
+    return plan
+
+
+def run_subject(subject_folder, pipeline_folder, data_type, deiddata=None, allocator=None, placement='auto',
+                stream_imaging=False, edf_workers=1, report=None, metrics=None, mne_channels=False, split_events=False,
+                edf_source=None, duplicate_mode='collapse', merge_runs=False, max_run_bytes=0, scratch=None):
+    """ Run every BIDS stage for one subject folder and return the renamed EPS path
+
+    edf_source yields the EDFs of the subject folder as a converter finishes them, instead of the EDFs already there;
+    merge_runs merges the runs into fewer files (of at most max_run_bytes, if not 0) once they are de-identified;
+    scratch (a ScratchBudget of the subject folder) bounds its footprint, intermediates are deleted as soon as they are used
+    """
+    # Stages add what they did (placements, ...) to report when the caller asks for it
+    if report is None:
+        report = {}
+
     if subject_folder.endswith('/'):
         subject_folder=subject_folder[:-1]
         
     if pipeline_folder.endswith('/'):
         pipeline_folder=pipeline_folder[:-1]
     
-    subject_id = re.sub(r"[^0-9]","", os.path.basename(subject_folder.split("_")[0]))
-    subjectid = os.path.basename(subject_folder).split("_")[0]
-    nested_name = "sub-" + subjectid + '_ses-01012000'
+    subject_id, subjectid = subject_names(subject_folder)
+    # Every stage that runs is measured, metrics only go to a file or stderr if the caller asks for it
+    if metrics is None:
+        metrics = StageMetrics(os.path.basename(subject_folder))
+    modlevelfolder = modality_folder(data_type)
+    parent_dir = os.path.dirname(subject_folder) 
     
-    subjectlevelfolder = 'sub-' + subjectid
-    sessionlevelfolder = 'ses-01012000'
+    # Every completed stage is journaled in the pipeline folder, a re-invocation after a crash skips it
+    journal = SubjectJournal(pipeline_folder, subject_folder)
+    if journal.done('final_rename') and os.path.isdir(subject_folder):
+        # A finished subject that was downloaded again is processed from scratch
+        journal.reset()
     
-    if args.type == "ieeg":
-        modlevelfolder = 'ieeg/'
-    elif args.type == "scalp":
-        modlevelfolder = 'eeg/'
-        
-
+    # Keyed by folder name so a re-run of the same subject gets the same EPS identifier
+    if not journal.done('eps'):
+        with metrics.stage('eps'):
+            journal.complete('eps', eps_string=generate_eps_string(pipeline_folder, os.path.basename(subject_folder), allocator))
+    eps_string = journal.get('eps', 'eps_string')
+    new_path = os.path.join(parent_dir, eps_string)
+    
+    # Interrupted between the final rename and its journal entry
+    if not os.path.isdir(subject_folder) and os.path.isdir(new_path):
+        journal.complete('final_rename', new_path=new_path)
+    if journal.done('final_rename'):
+        # Journals of subjects finished before they were reduced on completion
+        journal.strip()
+        report['imaging'] = journal.get('sidecars', 'imaging')
+        return journal.get('final_rename', 'new_path')
+    
+    # Everything is written under its final sub-<EPS> name, only files that were already there get renamed
+    subjectlevelfolder = 'sub-' + eps_string
+    sessionlevelfolder = 'ses-01012000'
+    nested_name = subjectlevelfolder + '_' + sessionlevelfolder
     nesteddirectory = subjectlevelfolder + '/' + sessionlevelfolder + '/'
     
+    # Files are hashed as they are written, or once when they are final, and never read again for the manifest
+    checksums = ChecksumCache(subject_folder)
+    
+    # Batch mode loads the de-identified data once per worker and passes it in
+    # The whole layout is planned and checked for collisions before anything is written
+    with metrics.stage('plan') as stage:
+        if deiddata is None:
+            deiddata = load_deidentified_data(pipeline_folder)
+        subj_deid, mri_date = lookup_participant(deiddata, subject_id)
+        plan = plan_subject(subject_folder, pipeline_folder, eps_string, data_type, mri_date, placement, stream_imaging,
+                            split_events, duplicate_mode, checksums, merge_runs)
+        plan.check()
+        stage['files'] = len(plan.entries)
+    
     # Create folder structure and BIDs files
-    primary_dir, nested_dir, derivative_dir = create_folder_structure(subject_folder, subjectid)
-    create_readme_file(subject_folder)
-    mri_date = create_participants_file(subject_folder, primary_dir, pipeline_folder)
-    create_dataset_description(primary_dir)
-    create_participants_json(primary_dir)
-    os.makedirs(os.path.join(subject_folder + '/Primary/' + nesteddirectory + modlevelfolder), exist_ok=True)
+    primary_dir = os.path.join(subject_folder, 'Primary')
+    nested_dir = os.path.join(primary_dir, subjectlevelfolder, sessionlevelfolder)
+    if not journal.done('structure'):
+        with metrics.stage('structure') as stage:
+            primary_dir, nested_dir, derivative_dir = create_folder_structure(subject_folder, eps_string)
+            create_readme_file(subject_folder, checksums)
+            create_participants_file(subject_folder, primary_dir, pipeline_folder, deiddata)
+            create_dataset_description(primary_dir, checksums)
+            create_participants_json(primary_dir, checksums)
+            checksums.save()
+            os.makedirs(os.path.join(subject_folder + '/Primary/' + nesteddirectory + modlevelfolder), exist_ok=True)
+            # README, participants csv and json, dataset_description
+            stage['files'] = 4
+            journal.complete('structure')
     
-    eps_string = generate_eps_string(pipeline_folder)
+    # Process .edf files, runs already moved by an interrupted invocation are kept
+    def edf_stage():
+        if journal.done('edf'):
+            return
+        with metrics.stage('edf') as stage:
+            audit = process_edf_files(subject_folder, primary_dir, nested_dir, modlevelfolder, nested_name, eps_string, edf_workers,
+                                      journal, mne_channels, edf_source, checksums)
+            write_deidentification_audit(subject_folder, audit, checksums)
+            checksums.save()
+            stage['files'] = len(audit)
+            journal.complete('edf', runs=len(audit))
     
-    # Process .edf files
-    process_edf_files(subject_folder, primary_dir, nested_dir, modlevelfolder, nested_name, eps_string)
+    # Runs are merged once all of them are de-identified, before split events are cut along them
+    def merge_stage():
+        if not merge_runs or journal.done('merge'):
+            return
+        with metrics.stage('merge') as stage:
+            merge = merge_edf_runs(os.path.join(nested_dir, modlevelfolder), nested_name, max_run_bytes, journal, checksums,
+                                   scratch)
+            # The merged files have new run names, the sidecars of runs with a layout of their own follow them
+            write_channel_sidecars(subject_folder, nested_dir, modlevelfolder, nested_name,
+                                   sum(entry['duration'] for entry in merge['files']), mne_channels, checksums)
+            write_merge_sidecars(subject_folder, nested_dir, modlevelfolder, nested_name, merge, checksums)
+            checksums.save()
+            stage['files'] = len(merge['files'])
+            stage['segments'] = len(merge['inputs'])
+            journal.complete('merge', files=len(merge['files']), segments=len(merge['inputs']))
     
     """ Deal with sidecar files (imaging, montages, annotations)"""
-    other_data(pipeline_folder, subject_folder, subjectid, nesteddirectory, modlevelfolder, nested_name, mri_date)
+    def sidecars_stage():
+        if journal.done('sidecars'):
+            return
+        with metrics.stage('sidecars') as stage:
+            placements = other_data(pipeline_folder, subject_folder, subjectid, eps_string, nesteddirectory, modlevelfolder,
+                                    nested_name, mri_date, placement, stream_imaging, split_events, checksums,
+                                    duplicate_mode, scratch)
+            if scratch is not None:
+                # The sources are deleted below, the volumes and sidecars made from them have to be on disk first
+                placed = [placement['destination'] for placement in placements if placement['mode'] != 'collapsed']
+                sync_files(placed + [path[:-len('.nii')] + '.json' for path in placed])
+            checksums.save()
+            imaging = summarize_placements(placements)
+            stage['files'] = imaging['files']
+            stage['imaging_bytes_written'] = imaging['bytes_written']
+            journal.complete('sidecars', imaging=imaging)
+            if scratch is not None:
+                object_dir = os.path.join(subject_folder, 'objects')
+                if os.path.isdir(object_dir):
+                    sources = find_imaging_archives(object_dir) if stream_imaging else find_imaging_volumes(object_dir)
+                    for source in sources:
+                        scratch.remove(source)
     
+    # While a converter is still writing the EDFs the sidecars are done alongside them; split events need every run
+    if edf_source is not None and not split_events:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            sidecars = executor.submit(sidecars_stage)
+            edf_stage()
+            merge_stage()
+            sidecars.result()
+    else:
+        edf_stage()
+        merge_stage()
+        sidecars_stage()
+    report['imaging'] = journal.get('sidecars', 'imaging')
     
     
-    replace_in_directory(subject_folder, eps_string, subject_id)
     
-    update_participants_tsv(primary_dir, eps_string)
+    if not journal.done('rename'):
+        with metrics.stage('rename') as stage:
+            stage['files'] = plan.apply_renames()
+            journal.complete('rename', renamed=stage['files'])
+    
+    if not journal.done('participants_tsv'):
+        with metrics.stage('participants_tsv') as stage:
+            update_participants_tsv(primary_dir, eps_string, checksums)
+            checksums.save()
+            stage['files'] = 1
+            journal.complete('participants_tsv')
+    
+    if not journal.done('manifest'):
+        with metrics.stage('manifest') as stage:
+            files, read = build_manifest(subject_folder, checksums, edf_workers)
+            stage['files'] = files
+            stage['hashed_after'] = read
+            journal.complete('manifest', files=files)
+    
+    if scratch is not None:
+        report['scratch'] = scratch.report()
     
-    parent_dir = os.path.dirname(subject_folder) 
     #old_directory_name = os.path.basename(subject_folder)  
-    new_directory_name = eps_string  
 
-    # Create the full new path
-    new_path = os.path.join(parent_dir, new_directory_name)
-    os.rename(subject_folder, new_path)
+    # Rename to the full new path
+    with metrics.stage('final_rename') as stage:
+        os.rename(subject_folder, new_path)
+        stage['files'] = 1
+        journal.complete('final_rename', new_path=new_path)
+    # The runs and the date shift were only needed to resume, a finished subject keeps its stage flags
+    journal.strip()
+    
+    return new_path
+    
+     
+def main():
+    # Define arguments 
+    args = parse_arguments()
+    
+    if args.dry_run:
+        # The plan goes to stdout instead of the new path, nothing is written
+        plan = dry_run_subject(args.folder1, args.folder2, args.type, placement=args.placement,
+                               stream_imaging=args.stream_imaging, split_events=args.split_events,
+                               duplicate_mode=args.imaging_duplicates, merge_runs=args.merge_runs)
+        sys.stdout.write('\n'.join(plan.format()) + '\n')
+        return
+    
+    report = {}
+    metrics = StageMetrics(os.path.basename(args.folder1.rstrip('/')), args.metrics, args.profile_stage, args.profile_dir)
+    scratch = open_budget(args.folder1.rstrip('/'), args.scratch_mb * 1024 * 1024)
+    try:
+        new_path = run_subject(args.folder1, args.folder2, args.type, placement=args.placement,
+                               stream_imaging=args.stream_imaging, edf_workers=args.edf_workers, report=report,
+                               metrics=metrics, mne_channels=args.mne_channels, split_events=args.split_events,
+                               duplicate_mode=args.imaging_duplicates, merge_runs=args.merge_runs,
+                               max_run_bytes=args.max_run_mb * 1024 * 1024, scratch=scratch)
+    finally:
+        if scratch is not None:
+            scratch.close()
+    
+    # stdout only carries the new path, which edfandbid_creation.sh captures
+    sys.stderr.write(format_imaging_report(report['imaging']) + '\n')
+    if 'scratch' in report:
+        sys.stderr.write(format_scratch_report(report['scratch']) + '\n')
     
     #print(new_path)
     sys.stdout.write(new_path) 
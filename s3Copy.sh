@@ -16,8 +16,9 @@ LAST_DIR=$(basename "$S3_SUBPATH")
 S3_SOURCE="s3://org-ieeg-data/$S3_SUBPATH"
 
 # Build the local destination path
-LOCAL_DEST="~/data/$LAST_DIR"
+LOCAL_DEST="$HOME/data/$LAST_DIR"
 
-# Run the AWS S3 copy command
-echo "Running: aws s3 cp \"$S3_SOURCE\" \"$LOCAL_DEST\" --recursive"
-aws s3 cp "$S3_SOURCE" "$LOCAL_DEST" --recursive
+# Download with concurrent ranged GETs, an interrupted copy resumes where it stopped;
+# ingest.py prints every file as soon as it is complete
+echo "Running: ingest.py \"$S3_SOURCE\" into \"$LOCAL_DEST\""
+python3 "$(dirname "$0")/ingest.py" "$S3_SUBPATH" --dest "$HOME/data"
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Scratch budget of a subject folder
+
+Bounds the disk a subject takes at once, so more subjects fit on one volume.
+A stage that is about to write an intermediate or an output claims the bytes
+first and blocks while they would take the subject folder over the budget
+and another stage can still make room: a running converter (whose MEF inputs
+are deleted when it is done) or another claim. Intermediates are deleted
+through the budget as soon as what was made from them is on disk, which
+wakes the blocked stages. The footprint is the allocated size of the subject
+folder, every inode counted once; only a background thread walks the folder,
+claims go by its last sample plus what finished claims and deletions changed
+since, and the peak is reported.
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# Seconds between footprint samples, and between looks while a claim is blocked
+SAMPLE_SECONDS = 0.5
+
+
+def folder_bytes(folder):
+    """ Bytes allocated on disk to the files of a folder, hardlinked files counted once """
+    seen = set()
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                stat = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                # Renamed or deleted while the folder was walked
+                continue
+            if (stat.st_dev, stat.st_ino) in seen:
+                continue
+            seen.add((stat.st_dev, stat.st_ino))
+            total += stat.st_blocks * 512
+
+    return total
+
+
+class ScratchBudget:
+    """ Disk budget of one subject folder, shared by the stages that run side by side """
+
+    def __init__(self, folder, limit, sample_seconds=SAMPLE_SECONDS):
+        self.folder = folder
+        self.limit = limit
+        self.sample_seconds = sample_seconds
+        self.condition = threading.Condition()
+        # Footprint of the last sample, and (walks started before, bytes) of the claims and deletions it may have missed
+        self.used = 0
+        self.changes = []
+        self.walks = 0
+        self.claimed = 0
+        self.holders = 0
+        self.peak = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.overruns = 0
+        self.freed = 0
+        self.sampled = threading.Event()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def sample(self):
+        # The folder is only walked here, claims never wait on a walk; it catches what grows without a claim, such as
+        # the EDFs a converter writes
+        while True:
+            with self.condition:
+                self.walks += 1
+                walk = self.walks
+            used = folder_bytes(self.folder)
+            with self.condition:
+                self.used = used
+                self.peak = max(self.peak, used)
+                # A walk that started after a change has it
+                self.changes = [(walks, nbytes) for walks, nbytes in self.changes if walks >= walk]
+                self.condition.notify_all()
+            self.sampled.set()
+            if self.stopped.wait(self.sample_seconds):
+                break
+
+    def footprint(self):
+        """ Last sampled footprint with the changes it has not seen yet, called holding the condition """
+        return self.used + sum(nbytes for walks, nbytes in self.changes)
+
+    @contextmanager
+    def claim(self, nbytes):
+        """ Reserve nbytes for the block, waiting while they do not fit and another stage can still make room
+
+        A claim that cannot fit even then goes ahead and is counted as an overrun, rather than waiting forever.
+        """
+        self.sampled.wait()
+        start = None
+        with self.condition:
+            while self.footprint() + self.claimed + nbytes > self.limit and (self.claimed or self.holders):
+                if start is None:
+                    start = time.perf_counter()
+                    self.waits += 1
+                self.condition.wait(self.sample_seconds)
+            if start is not None:
+                self.wait_seconds += time.perf_counter() - start
+            if self.footprint() + self.claimed + nbytes > self.limit:
+                self.overruns += 1
+            self.claimed += nbytes
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.claimed -= nbytes
+                # What the claim wrote is on disk now, counted until a sample has it
+                self.changes.append((self.walks, nbytes))
+                self.condition.notify_all()
+
+    @contextmanager
+    def holding(self):
+        """ A stage that will make room when it is done (ex. the converter, whose inputs are deleted after it) """
+        with self.condition:
+            self.holders += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.holders -= 1
+                self.condition.notify_all()
+
+    def remove(self, path):
+        """ Delete an intermediate whose outputs are on disk and wake the stages waiting for room """
+        try:
+            stat = os.lstat(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.condition:
+            # A file still linked elsewhere (ex. a run placed by hardlink) gives no room back
+            if stat.st_nlink == 1:
+                self.freed += stat.st_blocks * 512
+                self.changes.append((self.walks, -stat.st_blocks * 512))
+            self.condition.notify_all()
+
+    def report(self):
+        """ {'limit_bytes', 'peak_bytes', 'bytes', 'freed_bytes', 'waits', 'wait_seconds', 'overruns'}, as last sampled """
+        with self.condition:
+            return {'limit_bytes': self.limit, 'peak_bytes': self.peak, 'bytes': self.used, 'freed_bytes': self.freed,
+                    'waits': self.waits, 'wait_seconds': round(self.wait_seconds, 3), 'overruns': self.overruns}
+
+    def close(self):
+        """ Stop sampling """
+        self.stopped.set()
+        self.sampler.join()
+
+
+def open_budget(folder, limit):
+    """ Scratch budget of a subject folder, None when there is no limit """
+    return ScratchBudget(folder, limit) if limit else None
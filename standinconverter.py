@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stand-in for mefstreamer.jar
+
+Writes synthetic EDF runs into a subject folder the way the MEF -> EDF
+converter does: <subject folder name>_<run>.edf, one run after the other, one
+data record at a time with the record count left at -1 until the file is
+closed. Lets convertbids.py be run and timed offline, ex.
+--converter "python3 standinconverter.py {input} --runs 4 --record-delay 0.01"
+"""
+
+import os
+import sys
+import argparse
+from datetime import datetime, timedelta
+
+from synthetic import channel_layout, write_edf
+
+
+def convert(subject_folder, runs=3, channels=64, sfreq=512, duration=60, record_delay=0, reverse=False,
+            start=datetime(2019, 5, 1, 10, 0, 0)):
+    """ Write the EDF runs of a subject folder one after the other and return their paths """
+    subject_folder = subject_folder.rstrip('/')
+    layout = channel_layout(channels)
+    order = range(runs, 0, -1) if reverse else range(1, runs + 1)
+    paths = []
+    for run in order:
+        path = os.path.join(subject_folder, f"{os.path.basename(subject_folder)}_{run}.edf")
+        write_edf(path, layout, sfreq, duration, start + timedelta(seconds=(run - 1) * duration), seed=run, streaming=True,
+                  record_delay=record_delay)
+        paths.append(path)
+
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic EDF runs into a subject folder like mefstreamer.jar does.")
+    parser.add_argument('folder', type=str, help="Subject folder the EDF runs are written to")
+    parser.add_argument('--runs', type=int, default=3, help="EDF runs (default: 3)")
+    parser.add_argument('--channels', type=int, default=64, help="Channels per EDF (default: 64)")
+    parser.add_argument('--sfreq', type=int, default=512, help="Sampling rate in Hz (default: 512)")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds per run (default: 60)")
+    parser.add_argument('--record-delay', type=float, default=0,
+                        help="Seconds to sleep after every one second data record, to mimic a slow conversion (default: 0)")
+    parser.add_argument('--reverse', action='store_true', help="Write the last run first")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        parser.error(f"{args.folder} is not a directory")
+    for path in convert(args.folder, args.runs, args.channels, args.sfreq, args.duration, args.record_delay, args.reverse):
+        sys.stdout.write(f"Converted {path}\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Synthetic subject generator
+
+Builds subject folders the way mefstreamer leaves them (HUP<n>_phaseII with
+HUP<n>_phaseII_<run>.edf files and objects/imaging NIfTIs, optionally zipped)
+and a matching pipeline folder (deidentified_data.csv, epsnumber.csv,
+montages, annotations), so postbids.py can be run and benchmarked offline
+without pulling a real subject from S3. The EDFs are plain EDF with the
+channel count, sampling rate, duration and run count asked for, filled with
+deterministic noise.
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import struct
+import zipfile
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from edfheader import HEADER_FIELDS, SIGNAL_FIELDS, HEADER_SPANS
+
+DIGITAL_MIN = -32768
+DIGITAL_MAX = 32767
+
+# NIfTI-1 datatype code and bits per voxel of int16 volumes
+NIFTI_INT16 = (4, 16)
+
+
+def ascii_field(value, width):
+    """ Space padded ASCII header field, cut to the field width """
+    return str(value).encode('ascii')[:width].ljust(width, b' ')
+
+
+def number_field(value, width):
+    """ Header number, with as many decimals as fit in the field """
+    text = repr(value) if isinstance(value, float) else str(value)
+    if len(text) > width:
+        text = f"{value:.{max(width - len(str(int(value))) - 1, 0)}f}"[:width]
+    return ascii_field(text, width)
+
+
+def channel_layout(n_channels):
+    """ (label, units) of n channels: depth contacts, one grid contact per 16, and ECG/EKG at the end """
+    channels = []
+    for idx in range(max(n_channels - 2, 0)):
+        if idx % 16 == 15:
+            channels.append((f"GRID{idx // 16 + 1}", 'uV'))
+        else:
+            channels.append((f"L{chr(ord('A') + (idx // 16) % 26)}{idx % 16 + 1}", 'uV'))
+    channels += [('ECG1', 'mV'), ('EKG', 'mV')][:n_channels - len(channels)]
+
+    return channels
+
+
+def write_edf(path, channels, sfreq, duration, start, record_duration=1, seed=0, streaming=False, record_delay=0):
+    """ Write a plain EDF of int16 noise, one data record at a time so memory stays bounded
+
+    streaming writes the record count as -1 until the last record is written, the way a recorder or converter does,
+    and record_delay sleeps that many seconds after every record.
+    """
+    samples = int(round(sfreq * record_duration))
+    n_records = int(np.ceil(duration / record_duration))
+    n_signals = len(channels)
+    header = {
+        'version': '0',
+        'patient_id': 'MRN0000000 M 01-JAN-1970 Synthetic_Patient',
+        'recording_id': f"Startdate {start.strftime('%d-%b-%Y').upper()} X synthetic X",
+        'startdate': start.strftime('%d.%m.%y'),
+        'starttime': start.strftime('%H.%M.%S'),
+        'header_bytes': 256 * (n_signals + 1),
+        'reserved': '',
+        'n_records': -1 if streaming else n_records,
+        'record_duration': record_duration,
+        'n_signals': n_signals,
+    }
+    signal = {
+        'label': [label for label, units in channels],
+        'transducer': ['AgAgCl electrode'] * n_signals,
+        'units': [units for label, units in channels],
+        'physical_min': [-1000] * n_signals,
+        'physical_max': [1000] * n_signals,
+        'digital_min': [DIGITAL_MIN] * n_signals,
+        'digital_max': [DIGITAL_MAX] * n_signals,
+        'prefilter': [f"HP:0.1Hz LP:{sfreq / 4:g}Hz"] * n_signals,
+        'samples_per_record': [samples] * n_signals,
+        'signal_reserved': [''] * n_signals,
+    }
+
+    rng = np.random.default_rng(seed)
+    with open(path, 'wb') as f:
+        for name, width in HEADER_FIELDS:
+            f.write(number_field(header[name], width) if isinstance(header[name], (int, float)) else ascii_field(header[name], width))
+        for name, width in SIGNAL_FIELDS:
+            for value in signal[name]:
+                f.write(number_field(value, width) if isinstance(value, (int, float)) else ascii_field(value, width))
+        for _ in range(n_records):
+            block = rng.normal(0, 3000, (n_signals, samples)).clip(DIGITAL_MIN, DIGITAL_MAX)
+            f.write(block.astype('<i2').tobytes())
+            if record_delay:
+                f.flush()
+                time.sleep(record_delay)
+        if streaming:
+            f.seek(HEADER_SPANS['n_records'][0])
+            f.write(number_field(n_records, HEADER_SPANS['n_records'][1]))
+
+
+def write_nifti(path, shape=(64, 64, 32), seed=0):
+    """ Write a NIfTI-1 int16 volume with 1 mm voxels, .nii.gz if the path says so """
+    header = bytearray(352)
+    struct.pack_into('<i', header, 0, 348)
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    struct.pack_into('<8h', header, 40, *dims)
+    struct.pack_into('<hh', header, 70, *NIFTI_INT16)
+    struct.pack_into('<8f', header, 76, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0, 1.0)
+    struct.pack_into('<f', header, 108, 352.0)
+    struct.pack_into('<f', header, 112, 1.0)
+    header[344:348] = b'n+1\x00'
+    data = np.random.default_rng(seed).integers(0, 2000, shape, dtype='<i2').tobytes(order='F')
+
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(bytes(header))
+        f.write(data)
+
+
+def make_subject(root, hup_number, runs=3, channels=64, sfreq=512, duration=60, imaging=True, zip_imaging=False,
+                 volume_shape=(64, 64, 32), start=datetime(2019, 5, 1, 10, 0, 0)):
+    """ Build <root>/HUP<n>_phaseII and return its path """
+    subject_folder = os.path.join(root, f"HUP{hup_number}_phaseII")
+    os.makedirs(subject_folder, exist_ok=True)
+    layout = channel_layout(channels)
+    for run in range(1, runs + 1):
+        run_start = start + timedelta(seconds=(run - 1) * duration)
+        write_edf(os.path.join(subject_folder, f"HUP{hup_number}_phaseII_{run}.edf"), layout, sfreq, duration, run_start,
+                  seed=hup_number * 1000 + run)
+
+    if imaging:
+        names = [f"HUP{hup_number}_CT.nii", f"HUP{hup_number}_T1_20200101.nii", f"HUP{hup_number}_T2_20200101.nii"]
+        object_dir = os.path.join(subject_folder, 'objects')
+        if zip_imaging:
+            os.makedirs(object_dir, exist_ok=True)
+            scratch = os.path.join(object_dir, 'synthetic.nii.gz')
+            with zipfile.ZipFile(os.path.join(object_dir, f"HUP{hup_number}_imaging.zip"), 'w') as zf:
+                for seed, name in enumerate(names):
+                    write_nifti(scratch, volume_shape, seed)
+                    zf.write(scratch, f"imaging/{name}.gz")
+            os.remove(scratch)
+        else:
+            os.makedirs(os.path.join(object_dir, 'imaging'), exist_ok=True)
+            for seed, name in enumerate(names):
+                write_nifti(os.path.join(object_dir, 'imaging', name), volume_shape, seed)
+
+    return subject_folder
+
+
+def make_pipeline(pipeline_folder, hup_numbers, last_eps=0, annotations=20):
+    """ Build a pipeline folder with rows, montages and annotations for every HUP number """
+    os.makedirs(os.path.join(pipeline_folder, 'montages'), exist_ok=True)
+    os.makedirs(os.path.join(pipeline_folder, 'annotations'), exist_ok=True)
+
+    with open(os.path.join(pipeline_folder, 'deidentified_data.csv'), 'w', encoding='latin1') as f:
+        f.write('HUP Number,Age,Sex,MRI Date:\n')
+        for hup_number in hup_numbers:
+            f.write(f"{hup_number},{20 + hup_number % 50},{'FM'[hup_number % 2]},03/04/19\n")
+    with open(os.path.join(pipeline_folder, 'epsnumber.csv'), 'w') as f:
+        f.write(f"{last_eps}\n")
+
+    for hup_number in hup_numbers:
+        with open(os.path.join(pipeline_folder, 'montages', f"HUP{hup_number}_montage.json"), 'w') as f:
+            json.dump({'montage': [f"LA{idx}-LA{idx + 1}" for idx in range(1, 8)]}, f, indent=4)
+        with open(os.path.join(pipeline_folder, 'annotations', f"HUP{hup_number}_annotations.tsv"), 'w') as f:
+            f.write('onset\tduration\tdescription\tparent\tlayer\tcreator\tid\tversion\n')
+            for idx in range(annotations):
+                f.write(f"{idx * 7.5}\t0.5\tspike\tLA{idx % 8 + 1}\tdefault\treviewer\t{idx}\t1\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build synthetic subject folders and their pipeline folder.")
+    parser.add_argument('root', type=str, help="Folder the subjects and the pipeline folder are created in")
+    parser.add_argument('--subjects', type=int, default=1, help="Number of subjects (default: 1)")
+    parser.add_argument('--first-hup', type=int, default=100, help="HUP number of the first subject (default: 100)")
+    parser.add_argument('--runs', type=int, default=3, help="EDF runs per subject (default: 3)")
+    parser.add_argument('--channels', type=int, default=64, help="Channels per EDF (default: 64)")
+    parser.add_argument('--sfreq', type=int, default=512, help="Sampling rate in Hz (default: 512)")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds per run (default: 60)")
+    parser.add_argument('--no-imaging', action='store_true', help="Leave out objects/imaging")
+    parser.add_argument('--zip-imaging', action='store_true', help="Put the imaging in a zip archive, for --stream-imaging")
+    args = parser.parse_args()
+
+    hup_numbers = list(range(args.first_hup, args.first_hup + args.subjects))
+    pipeline_folder = os.path.join(args.root, 'pipeline')
+    make_pipeline(pipeline_folder, hup_numbers)
+    for hup_number in hup_numbers:
+        folder = make_subject(args.root, hup_number, args.runs, args.channels, args.sfreq, args.duration,
+                              not args.no_imaging, args.zip_imaging)
+        sys.stdout.write(folder + '\n')
+
+
+if __name__ == '__main__':
+    main()
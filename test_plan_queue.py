@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the final EPS names of a subject folder and of the work queue leases
+
+final_name is checked against the rename walk postbids used to run on the
+finished subject folder (kept here as it was), on a folder built by
+synthetic.py. The work queue tests use a lease of a second and no backoff.
+
+Run with: python -m pytest -q test_plan_queue.py
+"""
+
+import os
+import re
+import time
+
+import pytest
+
+import synthetic
+from bidsplan import final_name
+from workqueue import WorkQueue
+
+EPS_STRING = 'EPS0000042'
+
+# Names next to the synthetic runs that take each branch of the rename rules
+EXTRA_NAMES = ['sub-HUP199_ses-implant01_scans.tsv', 'HUP199_T1_20200101.nii', 'RID042_notes.txt', 'notes_RID042.txt',
+               'HUP199.json', 'HUP199_1_2.edf', 'README.txt']
+
+
+def replace_in_directory(subject_folder, eps_string, subject_id):
+    """ The rename walk postbids ran on the finished subject folder before the plan, the reference for final_name """
+    for root, dirs, files in os.walk(subject_folder, topdown=False):
+        for item in dirs + files:
+            new_name = item
+            if "sub-" in item:
+                before_underscore = item.split("-")[1].split("_")[0]
+                new_name = item.replace(f"sub-{before_underscore}", f"sub-{eps_string}")
+            elif subject_id in item:
+                modified_item = item.replace(subject_id, "")
+                if len(re.findall(r'\d', modified_item)) <= 1:
+                    before_subject_id = item.split(subject_id)[0]
+                    new_name = item.replace(before_subject_id + subject_id, eps_string)
+            elif "RID" in item:
+                rid_index = item.find("RID")
+                new_name = item[:rid_index] + eps_string + item[rid_index + 6:]
+
+            if new_name != item:
+                os.rename(os.path.join(root, item), os.path.join(root, new_name))
+
+
+def tree(folder):
+    """ Relative paths of every file and directory under folder """
+    return sorted(os.path.relpath(os.path.join(root, name), folder)
+                  for root, dirs, files in os.walk(folder) for name in dirs + files)
+
+
+def test_final_name_matches_rename_walk(tmp_path):
+    subject_folder = synthetic.make_subject(str(tmp_path), 199, runs=2, channels=4, sfreq=16, duration=2,
+                                            volume_shape=(4, 4, 2))
+    for name in EXTRA_NAMES:
+        open(os.path.join(subject_folder, name), 'w').close()
+    os.makedirs(os.path.join(subject_folder, 'sub-HUP199', 'ses-implant01'))
+    open(os.path.join(subject_folder, 'sub-HUP199', 'ses-implant01', 'sub-HUP199_ses-implant01_run-01_ieeg.edf'), 'w').close()
+
+    subject_id = re.sub(r"[^0-9]", "", os.path.basename(subject_folder).split("_")[0])
+    planned = sorted(os.path.join(*[final_name(part, EPS_STRING, subject_id) for part in path.split(os.sep)])
+                     for path in tree(subject_folder))
+    replace_in_directory(subject_folder, EPS_STRING, subject_id)
+
+    assert planned == tree(subject_folder)
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('sub-HUP199_ses-implant01_scans.tsv', 'sub-EPS0000042_ses-implant01_scans.tsv'),
+    ('HUP199_phaseII_1.edf', 'EPS0000042_phaseII_1.edf'),
+    ('HUP199.json', 'EPS0000042.json'),
+    ('HUP199_T1_20200101.nii', 'HUP199_T1_20200101.nii'),
+    ('RID042_notes.txt', 'EPS0000042_notes.txt'),
+    ('README.txt', 'README.txt'),
+])
+def test_final_name(name, expected):
+    assert final_name(name, EPS_STRING, '199') == expected
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    queue_path = str(tmp_path / 'queue.sqlite')
+    queue = WorkQueue(queue_path, owner='first')
+    queue.enqueue(['HUP199_phaseII'], 'ieeg', max_attempts=2)
+    queue.close()
+    return queue_path
+
+
+def test_lease_expires_and_is_retried(queue_path):
+    first = WorkQueue(queue_path, owner='first')
+    second = WorkQueue(queue_path, owner='second')
+
+    task = first.claim(lease_seconds=1, backoff_seconds=0)
+    assert task['attempt'] == 1
+    assert second.claim(lease_seconds=1, backoff_seconds=0) is None
+
+    time.sleep(1.2)
+    retry = second.claim(lease_seconds=60, backoff_seconds=0)
+    assert retry['prefix'] == 'HUP199_phaseII'
+    assert retry['attempt'] == 2
+    assert not first.holds('HUP199_phaseII')
+    assert not first.heartbeat('HUP199_phaseII')
+    first.close()
+    second.close()
+
+
+def test_lost_lease_cannot_finish_the_subject(queue_path):
+    first = WorkQueue(queue_path, owner='first')
+    second = WorkQueue(queue_path, owner='second')
+    task = first.claim(lease_seconds=1, backoff_seconds=0)
+    time.sleep(1.2)
+    retry = second.claim(lease_seconds=60, backoff_seconds=0)
+
+    # The worker that lost the lease neither records its output nor finishes or fails the subject
+    first.record_output('HUP199_phaseII', '/first/EPS0000042')
+    assert not first.complete('HUP199_phaseII', task['attempt'], '/first/EPS0000042')
+    first.fail('HUP199_phaseII', task['attempt'], 'late failure', backoff_seconds=0)
+    state, owner, new_path = second.db.execute('SELECT state, owner, new_path FROM subjects').fetchone()
+    assert (state, owner, new_path) == ('running', 'second', None)
+
+    second.record_output('HUP199_phaseII', '/second/EPS0000042')
+    assert second.complete('HUP199_phaseII', retry['attempt'], '/second/EPS0000042')
+    state, new_path = second.db.execute('SELECT state, new_path FROM subjects').fetchone()
+    assert (state, new_path) == ('done', '/second/EPS0000042')
+    statuses = second.db.execute('SELECT attempt, status FROM attempts ORDER BY attempt').fetchall()
+    assert statuses == [(1, 'expired'), (2, 'done')]
+    first.close()
+    second.close()
+
+
+def test_expired_leases_use_up_the_attempts(queue_path):
+    queue = WorkQueue(queue_path, owner='first')
+    for attempt in (1, 2):
+        assert queue.claim(lease_seconds=1, backoff_seconds=0)['attempt'] == attempt
+        time.sleep(1.2)
+    assert queue.claim(lease_seconds=1, backoff_seconds=0) is None
+    state, error = queue.db.execute('SELECT state, error FROM subjects').fetchone()
+    assert state == 'failed'
+    assert 'expired' in error
+    queue.close()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parallel, checksummed upload of a finished EPS folder
+
+Uploads the Primary and Derivative trees of a subject folder renamed to its
+EPS name into an object store (objectstore.py) under <prefix>/<EPS>/...,
+files on a bounded thread pool and large files (the EDF runs) as multipart
+uploads whose parts go through the same pool. Every object carries the
+SHA-256 of its file as metadata, and objects whose remote size and SHA-256
+already match are skipped, so an interrupted or repeated upload only sends
+what is missing. Checksums come from checksums.json in the subject folder
+when it has them for the file as it is now (same size and modification
+time), as postbids.py leaves it; the ones that have to be computed are added to it.
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from objectstore import LocalStore, S3Store
+from checksums import hash_file, read_manifest, write_manifest, manifest_entry
+
+UPLOAD_FOLDERS = ('Primary', 'Derivative')
+
+# Files from this size on are uploaded in parts of PART_BYTES
+MULTIPART_BYTES = 64 * 1024 * 1024
+PART_BYTES = 16 * 1024 * 1024
+# S3 takes at most this many parts per upload
+MAX_PARTS = 10000
+
+
+def cached_checksum(manifest, subject_folder, relative):
+    """ SHA-256 of a file from the manifest, None if it has none or the file changed since """
+    entry = manifest.get(relative)
+    if not entry:
+        return None
+    stat = os.stat(os.path.join(subject_folder, relative))
+    if entry.get('size') != stat.st_size or entry.get('mtime_ns') != stat.st_mtime_ns:
+        return None
+
+    return entry.get('sha256')
+
+
+def upload_files(subject_folder):
+    """ Paths, relative to the subject folder, of every file of its Primary and Derivative trees """
+    files = []
+    for name in UPLOAD_FOLDERS:
+        for folder, dirs, names in os.walk(os.path.join(subject_folder, name)):
+            dirs.sort()
+            for filename in sorted(names):
+                files.append(os.path.relpath(os.path.join(folder, filename), subject_folder))
+
+    return files
+
+
+def object_key(prefix, subject_folder, relative):
+    """ Key of a file: <prefix>/<EPS folder name>/<relative path> """
+    parts = [prefix.strip('/')] if prefix.strip('/') else []
+    parts.append(os.path.basename(subject_folder))
+    parts += relative.split(os.sep)
+
+    return '/'.join(parts)
+
+
+def part_size(size, part_bytes=PART_BYTES):
+    """ Part size for a multipart upload of size bytes, grown if it would take more than MAX_PARTS parts """
+    return max(part_bytes, -(-size // MAX_PARTS))
+
+
+class Multipart:
+    """ One file uploaded in parts; the part that finishes last completes the upload """
+
+    def __init__(self, store, key, path, size, metadata, part_bytes):
+        self.store = store
+        self.key = key
+        self.path = path
+        self.parts = [(start, min(start + part_bytes, size)) for start in range(0, size, part_bytes)]
+        self.tags = [None] * len(self.parts)
+        self.lock = threading.Lock()
+        self.upload_id = store.start_multipart(key, metadata)
+
+    def put(self, idx):
+        """ Read and upload one part, return True if it completed the upload """
+        start, end = self.parts[idx]
+        with open(self.path, 'rb') as f:
+            data = os.pread(f.fileno(), end - start, start)
+        tag = self.store.put_part(self.key, self.upload_id, idx + 1, data)
+        with self.lock:
+            self.tags[idx] = tag
+            if any(tag is None for tag in self.tags):
+                return False
+        self.store.complete_multipart(self.key, self.upload_id, self.tags)
+        return True
+
+    def abort(self):
+        """ Drop the uploaded parts """
+        self.store.abort_multipart(self.key, self.upload_id)
+
+
+def upload_subject(store, subject_folder, prefix='', workers=8, part_bytes=PART_BYTES, multipart_bytes=MULTIPART_BYTES):
+    """ Upload the Primary and Derivative trees of a subject folder, return counts of what was sent and skipped """
+    subject_folder = subject_folder.rstrip('/')
+    files = upload_files(subject_folder)
+    manifest = read_manifest(subject_folder)
+    stats = {'files': len(files), 'uploaded': 0, 'skipped': 0, 'bytes': 0, 'hashed': 0}
+
+    def checksum(relative):
+        """ SHA-256 of a file, computed only if the manifest does not have it """
+        sha256 = cached_checksum(manifest, subject_folder, relative)
+        if sha256 is None:
+            path = os.path.join(subject_folder, relative)
+            return relative, manifest_entry(path, hash_file(path))
+        return relative, None
+
+    multiparts = []
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        # Checksums first, computed ones are kept in the manifest for the next upload
+        computed = [entry for entry in executor.map(checksum, files) if entry[1] is not None]
+        for relative, entry in computed:
+            manifest[relative] = entry
+        if computed:
+            write_manifest(subject_folder, manifest)
+        stats['hashed'] = len(computed)
+
+        def send(relative):
+            """ Upload one file unless the store already has it, multipart files return their Multipart """
+            path = os.path.join(subject_folder, relative)
+            key = object_key(prefix, subject_folder, relative)
+            size = os.path.getsize(path)
+            metadata = {'sha256': manifest[relative]['sha256']}
+            remote = store.stat(key)
+            if remote is not None and remote['size'] == size and remote['metadata'].get('sha256') == metadata['sha256']:
+                return 'skipped', size, None
+            if size < multipart_bytes:
+                store.put_file(key, path, metadata)
+                return 'uploaded', size, None
+            return 'multipart', size, Multipart(store, key, path, size, metadata, part_size(size, part_bytes))
+
+        futures = {}
+        try:
+            for future in as_completed([executor.submit(send, relative) for relative in files]):
+                status, size, multipart = future.result()
+                if status == 'skipped':
+                    stats['skipped'] += 1
+                elif status == 'uploaded':
+                    stats['uploaded'] += 1
+                    stats['bytes'] += size
+                else:
+                    multiparts.append(multipart)
+                    for idx in range(len(multipart.parts)):
+                        futures[executor.submit(multipart.put, idx)] = (multipart, idx)
+
+            for future in as_completed(futures):
+                multipart, idx = futures[future]
+                completed = future.result()
+                stats['bytes'] += multipart.parts[idx][1] - multipart.parts[idx][0]
+                if completed:
+                    stats['uploaded'] += 1
+        except BaseException:
+            # Parts of unfinished multipart uploads would otherwise be kept (and billed) by the store
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for multipart in multiparts:
+                if any(tag is None for tag in multipart.tags):
+                    multipart.abort()
+            raise
+
+    return stats
+
+
+def open_store(bucket=None, local_root=None, workers=8, endpoint_url=None):
+    """ Backend to upload to: a local folder standing in for the bucket, or S3 """
+    if local_root is not None:
+        return LocalStore(local_root)
+
+    return S3Store(bucket, max_connections=workers, endpoint_url=endpoint_url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upload the Primary and Derivative trees of an EPS folder to an object store.")
+    parser.add_argument('folder', type=str, help="Subject folder after the final rename (ex. ~/data/EPS0000042)")
+    parser.add_argument('--bucket', type=str, help="Bucket to upload to")
+    parser.add_argument('--prefix', type=str, default='', help="Key prefix the EPS folder is put under (default: none)")
+    parser.add_argument('--endpoint-url', type=str, help="S3 compatible endpoint, ex. a MinIO server")
+    parser.add_argument('--local-root', type=str, help="Upload into this folder as if it were the bucket, no S3")
+    parser.add_argument('--workers', type=int, default=16, help="Concurrent uploads and parts (default: 16)")
+    parser.add_argument('--part-size', type=int, default=PART_BYTES // (1024 * 1024), help="MiB per multipart part (default: 16)")
+    parser.add_argument('--multipart-threshold', type=int, default=MULTIPART_BYTES // (1024 * 1024),
+                        help="Files of at least this many MiB are uploaded in parts (default: 64)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        parser.error(f"{args.folder} is not a directory")
+    if args.bucket is None and args.local_root is None:
+        parser.error("one of --bucket or --local-root is required")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.part_size < 5 and args.local_root is None:
+        parser.error("S3 takes parts of at least 5 MiB")
+
+    store = open_store(args.bucket, args.local_root, args.workers, args.endpoint_url)
+    start = time.perf_counter()
+    stats = upload_subject(store, args.folder, args.prefix, args.workers, args.part_size * 1024 * 1024,
+                           args.multipart_threshold * 1024 * 1024)
+    seconds = time.perf_counter() - start
+    sys.stderr.write(f"Uploaded {stats['uploaded']} of {stats['files']} files ({stats['skipped']} already there, "
+                     f"{stats['hashed']} checksummed), {stats['bytes']} bytes in {seconds:.1f}s\n")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared work queue of subjects for a fleet of workers
+
+A manifest of S3 subject prefixes is enqueued once into a SQLite file on
+shared disk; any number of worker processes, on any node that mounts it,
+claim subjects one at a time with a time-limited lease and run what
+s3Copy.sh and edfandbid_creation.sh did by hand: ingest.py download,
+mefstreamer.jar and the BIDS stages (convertbids.py), the optional upload
+(upload.py) and the cleanup. A thread heartbeats the lease while a subject
+is processed; a subject whose worker stops heartbeating is claimed again once
+the lease has run out, and a failed subject is retried after an exponential
+backoff until it has used up its attempts. Every claim runs in an immediate
+(write locked) transaction like epsallocator.py, and the default rollback
+journal is kept since WAL does not work on network filesystems.
+
+    python3 workqueue.py enqueue queue.sqlite --manifest subjects.txt --type ieeg
+    python3 workqueue.py work queue.sqlite --pipeline ~/migrationtools --processes 4 --stream-imaging
+    python3 workqueue.py status queue.sqlite
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import argparse
+import threading
+import traceback
+import multiprocessing
+from contextlib import contextmanager
+
+import batchbids
+import convertbids
+from ingest import ingest, open_store
+from upload import upload_subject, open_store as open_upload_store
+from objectstore import BUCKET
+from metrics import StageMetrics
+from placement import PLACEMENT_MODES
+from dedupe import DUPLICATE_MODES
+from scratch import open_budget
+
+STATES = ('pending', 'running', 'done', 'failed')
+
+# A worker that has not heartbeated for this long is taken to be gone and its subject is claimed again
+LEASE_SECONDS = 10 * 60
+HEARTBEATS_PER_LEASE = 4
+
+MAX_ATTEMPTS = 3
+# Seconds before the first retry, doubled for every further one up to MAX_BACKOFF_SECONDS
+BACKOFF_SECONDS = 5 * 60
+MAX_BACKOFF_SECONDS = 4 * 60 * 60
+
+# Seconds an idle worker waits before it looks for due subjects again
+POLL_SECONDS = 10
+
+# Archives edfandbid_creation.sh deletes from objects/ before the conversion
+RECON_ARCHIVES = '*[rR][eE][cC][oO][nN]*.[zZ][iI][pP]'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subjects (
+    prefix TEXT PRIMARY KEY,
+    data_type TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    enqueued REAL NOT NULL,
+    finished REAL,
+    new_path TEXT,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS attempts (
+    prefix TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    owner TEXT NOT NULL,
+    started REAL NOT NULL,
+    finished REAL,
+    status TEXT NOT NULL,
+    bytes INTEGER,
+    error TEXT,
+    PRIMARY KEY (prefix, attempt)
+);
+CREATE INDEX IF NOT EXISTS subjects_due ON subjects (state, not_before);
+'''
+
+
+def backoff(attempt, base=BACKOFF_SECONDS, cap=MAX_BACKOFF_SECONDS):
+    """ Seconds to wait before retrying a subject whose attempt failed """
+    return min(cap, base * 2 ** (attempt - 1))
+
+
+def read_manifest(path):
+    """ Subject prefixes of a manifest file, one per line, blank lines and # comments skipped """
+    with open(path) as f:
+        return [line.strip().strip('/') for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+class WorkQueue:
+    """ Subjects to process, their leases and attempts, in a SQLite file shared by every worker """
+
+    def __init__(self, path, owner=None):
+        self.path = path
+        self.owner = owner or f"{socket.gethostname()}:{os.getpid()}"
+        self.db = sqlite3.connect(path, timeout=120, isolation_level=None)
+        self.db.executescript(SCHEMA)
+
+    @contextmanager
+    def transaction(self):
+        """ Immediate transaction: takes the write lock up front so concurrent workers queue up """
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self.db
+        except BaseException:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def enqueue(self, prefixes, data_type, max_attempts=MAX_ATTEMPTS):
+        """ Add subject prefixes that are not in the queue yet, return how many were added """
+        now = time.time()
+        added = 0
+        with self.transaction():
+            for prefix in prefixes:
+                cursor = self.db.execute('INSERT OR IGNORE INTO subjects (prefix, data_type, max_attempts, enqueued) '
+                                         'VALUES (?, ?, ?, ?)', (prefix.strip('/'), data_type, max_attempts, now))
+                added += cursor.rowcount
+
+        return added
+
+    def claim(self, lease_seconds=LEASE_SECONDS, backoff_seconds=BACKOFF_SECONDS):
+        """ Lease the subject that has been due the longest, as {'prefix', 'data_type', 'attempt', 'new_path'}, or None """
+        now = time.time()
+        with self.transaction():
+            self._expire_leases(now, backoff_seconds)
+            row = self.db.execute("SELECT prefix, data_type, attempts, new_path FROM subjects "
+                                  "WHERE state = 'pending' AND not_before <= ? ORDER BY not_before, enqueued, prefix LIMIT 1",
+                                  (now,)).fetchone()
+            if row is None:
+                return None
+            prefix, data_type, attempts, new_path = row
+            self.db.execute("UPDATE subjects SET state = 'running', owner = ?, lease_expires = ?, attempts = ? "
+                            "WHERE prefix = ?", (self.owner, now + lease_seconds, attempts + 1, prefix))
+            self.db.execute("INSERT INTO attempts (prefix, attempt, owner, started, status) VALUES (?, ?, ?, ?, 'running')",
+                            (prefix, attempts + 1, self.owner, now))
+
+        return {'prefix': prefix, 'data_type': data_type, 'attempt': attempts + 1, 'new_path': new_path}
+
+    def _expire_leases(self, now, backoff_seconds):
+        """ Count the running subjects whose lease ran out as failed attempts, called in a transaction """
+        expired = self.db.execute("SELECT prefix, attempts, owner FROM subjects WHERE state = 'running' AND lease_expires < ?",
+                                  (now,)).fetchall()
+        for prefix, attempts, owner in expired:
+            self._retry_or_fail(prefix, attempts, f"Lease of {owner} expired", now, backoff_seconds, 'expired')
+
+    def _retry_or_fail(self, prefix, attempt, error, now, backoff_seconds, status='failed'):
+        """ Put a subject back with a backoff, or fail it for good once it has used up its attempts """
+        self.db.execute('UPDATE attempts SET finished = ?, status = ?, error = ? WHERE prefix = ? AND attempt = ?',
+                        (now, status, error, prefix, attempt))
+        max_attempts = self.db.execute('SELECT max_attempts FROM subjects WHERE prefix = ?', (prefix,)).fetchone()[0]
+        if attempt >= max_attempts:
+            self.db.execute("UPDATE subjects SET state = 'failed', owner = NULL, lease_expires = NULL, finished = ?, "
+                            "error = ? WHERE prefix = ?", (now, error, prefix))
+        else:
+            self.db.execute("UPDATE subjects SET state = 'pending', owner = NULL, lease_expires = NULL, not_before = ?, "
+                            "error = ? WHERE prefix = ?", (now + backoff(attempt, backoff_seconds), error, prefix))
+
+    def heartbeat(self, prefix, lease_seconds=LEASE_SECONDS):
+        """ Extend the lease on a subject, False if this worker no longer holds it """
+        with self.transaction():
+            cursor = self.db.execute("UPDATE subjects SET lease_expires = ? WHERE prefix = ? AND owner = ? AND state = 'running'",
+                                     (time.time() + lease_seconds, prefix, self.owner))
+
+        return cursor.rowcount == 1
+
+    def holds(self, prefix):
+        """ True while this worker holds the lease on a subject, called in a transaction """
+        return self.db.execute("SELECT 1 FROM subjects WHERE prefix = ? AND owner = ? AND state = 'running'",
+                               (prefix, self.owner)).fetchone() is not None
+
+    def record_output(self, prefix, new_path):
+        """ Remember the EPS folder of a converted subject, so a retry on this node only has to upload it """
+        with self.transaction():
+            self.db.execute("UPDATE subjects SET new_path = ? WHERE prefix = ? AND owner = ? AND state = 'running'",
+                            (new_path, prefix, self.owner))
+
+    def complete(self, prefix, attempt, new_path, ingested_bytes=0):
+        """ Mark a subject done, False if this worker had lost the lease on it """
+        now = time.time()
+        with self.transaction():
+            if not self.holds(prefix):
+                # Another worker took the subject over after this one's lease ran out and may still be processing it,
+                # only this attempt is closed (it was already counted as expired)
+                self.db.execute('UPDATE attempts SET finished = ?, bytes = ? WHERE prefix = ? AND attempt = ?',
+                                (now, ingested_bytes, prefix, attempt))
+                return False
+            self.db.execute("UPDATE attempts SET finished = ?, status = 'done', bytes = ? WHERE prefix = ? AND attempt = ?",
+                            (now, ingested_bytes, prefix, attempt))
+            self.db.execute("UPDATE subjects SET state = 'done', owner = NULL, lease_expires = NULL, finished = ?, "
+                            "new_path = ?, error = NULL WHERE prefix = ?", (now, new_path, prefix))
+
+        return True
+
+    def fail(self, prefix, attempt, error, ingested_bytes=0, backoff_seconds=BACKOFF_SECONDS):
+        """ Record a failed attempt; the subject is retried later unless it has used up its attempts """
+        now = time.time()
+        with self.transaction():
+            self.db.execute('UPDATE attempts SET bytes = ? WHERE prefix = ? AND attempt = ?', (ingested_bytes, prefix, attempt))
+            if self.holds(prefix):
+                self._retry_or_fail(prefix, attempt, error, now, backoff_seconds)
+            else:
+                # Another worker took the subject over after this one's lease ran out, it decides what happens to it;
+                # this attempt keeps its expired status and gets the error that ended it
+                self.db.execute('UPDATE attempts SET finished = ?, error = ? WHERE prefix = ? AND attempt = ?',
+                                (now, error, prefix, attempt))
+
+    def requeue(self, prefixes=None):
+        """ Give failed subjects (or the given ones, whatever their state) a fresh set of attempts, return how many """
+        with self.transaction():
+            if prefixes:
+                rows = [(prefix.strip('/'),) for prefix in prefixes]
+                cursor = self.db.executemany("UPDATE subjects SET state = 'pending', attempts = 0, not_before = 0, owner = NULL, "
+                                             "lease_expires = NULL, error = NULL WHERE prefix = ? AND state != 'running'", rows)
+            else:
+                cursor = self.db.execute("UPDATE subjects SET state = 'pending', attempts = 0, not_before = 0, error = NULL "
+                                         "WHERE state = 'failed'")
+
+        return cursor.rowcount
+
+    def unfinished(self):
+        """ Subjects that are pending or running """
+        return self.db.execute("SELECT COUNT(*) FROM subjects WHERE state IN ('pending', 'running')").fetchone()[0]
+
+    def status(self, window=60 * 60):
+        """ Subjects per state, throughput, and the running, retrying and failed subjects """
+        now = time.time()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(self.db.execute('SELECT state, COUNT(*) FROM subjects GROUP BY state').fetchall())
+
+        done = self.db.execute("SELECT MIN(started), MAX(finished), COUNT(*), SUM(finished - started), SUM(bytes) "
+                               "FROM attempts WHERE status = 'done'").fetchone()
+        first, last, n_done, busy, ingested = done
+        span = (last - first) if n_done else 0
+        recent = self.db.execute("SELECT COUNT(*) FROM attempts WHERE status = 'done' AND finished >= ?",
+                                 (now - window,)).fetchone()[0]
+        throughput = {
+            'done': n_done,
+            'span_seconds': round(span, 1),
+            'subjects_per_hour': round(n_done * 3600 / span, 2) if span else None,
+            'recent': recent,
+            'window_seconds': window,
+            'seconds_per_subject': round(busy / n_done, 1) if n_done else None,
+            'bytes_ingested': ingested or 0,
+        }
+
+        running = [{'prefix': prefix, 'owner': owner, 'attempt': attempt, 'seconds': round(now - started, 1),
+                    'lease_left': round(expires - now, 1)}
+                   for prefix, owner, attempt, started, expires in self.db.execute(
+                       "SELECT s.prefix, s.owner, s.attempts, a.started, s.lease_expires FROM subjects s "
+                       "JOIN attempts a ON a.prefix = s.prefix AND a.attempt = s.attempts "
+                       "WHERE s.state = 'running' ORDER BY a.started")]
+        retrying = [{'prefix': prefix, 'attempts': attempts, 'retry_in': round(max(0, not_before - now), 1), 'error': error}
+                    for prefix, attempts, not_before, error in self.db.execute(
+                        "SELECT prefix, attempts, not_before, error FROM subjects "
+                        "WHERE state = 'pending' AND attempts > 0 ORDER BY not_before")]
+        failed = [{'prefix': prefix, 'attempts': attempts, 'error': error}
+                  for prefix, attempts, error in self.db.execute(
+                      "SELECT prefix, attempts, error FROM subjects WHERE state = 'failed' ORDER BY finished")]
+
+        return {'subjects': sum(counts.values()), 'states': counts, 'throughput': throughput,
+                'running': running, 'retrying': retrying, 'failed': failed}
+
+    def close(self):
+        """ Close the queue file """
+        self.db.close()
+
+
+class Heartbeat:
+    """ Keeps extending the lease on a subject from a thread while the subject is processed """
+
+    def __init__(self, queue_path, owner, prefix, lease_seconds=LEASE_SECONDS):
+        self.queue_path = queue_path
+        self.owner = owner
+        self.prefix = prefix
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        # SQLite connections stay in the thread that opened them
+        queue = WorkQueue(self.queue_path, self.owner)
+        try:
+            while not self.stopped.wait(self.lease_seconds / HEARTBEATS_PER_LEASE):
+                try:
+                    held = queue.heartbeat(self.prefix, self.lease_seconds)
+                except sqlite3.OperationalError as e:
+                    # A busy or briefly unreachable queue file, the lease has slack for the next heartbeat
+                    sys.stderr.write(f"Heartbeat for {self.prefix} failed: {e}\n")
+                    continue
+                if not held:
+                    self.lost = True
+                    sys.stderr.write(f"Lost the lease on {self.prefix}, another worker may be processing it\n")
+                    break
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def remove_recon_archives(subject_folder):
+    """ Delete the reconstruction zips from objects/, as edfandbid_creation.sh does """
+    for path in glob.glob(os.path.join(subject_folder, 'objects', '**', RECON_ARCHIVES), recursive=True):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+class LeaseLost(Exception):
+    """ The lease on a subject ran out while it was processed, another worker may have taken it over """
+
+
+def check_lease(heartbeat, prefix, step):
+    """ Stop processing a subject whose lease was lost before the next step """
+    if heartbeat is not None and heartbeat.lost:
+        raise LeaseLost(f"Lost the lease on {prefix}, stopped before {step}")
+
+
+def process_task(task, settings, heartbeat=None):
+    """ Download, convert, upload and clean up one claimed subject, return the result instead of raising
+
+    Once heartbeat has lost the lease, the subject is left to the worker that took it over: nothing else is downloaded,
+    converted, uploaded or deleted.
+    """
+    start = time.time()
+    prefix = task['prefix']
+    result = {'subject': prefix, 'attempt': task['attempt'], 'owner': settings['owner']}
+    stats = {}
+    report = {}
+    metrics = StageMetrics(os.path.basename(prefix), settings['metrics'])
+    try:
+        new_path = task['new_path']
+        # A retry on the node that converted the subject only has what came after the conversion left to do
+        if not (new_path and os.path.isdir(new_path)):
+            subject_folder = os.path.join(settings['data_folder'], os.path.basename(prefix))
+            store = open_store(settings['bucket'], settings['local_root'], settings['ingest_workers'], settings['endpoint_url'])
+            for _ in ingest(store, prefix, subject_folder, settings['ingest_workers'], stats=stats):
+                check_lease(heartbeat, prefix, 'the rest of the download')
+            remove_recon_archives(subject_folder)
+
+            check_lease(heartbeat, prefix, 'the conversion')
+            scratch = open_budget(subject_folder, settings['scratch_bytes'])
+            try:
+                new_path = convertbids.convert_subject(subject_folder, settings['pipeline_folder'], task['data_type'],
+                                                       settings['converter'], deiddata=batchbids.worker_state.get('deiddata'),
+                                                       allocator=batchbids.worker_state.get('allocator'), report=report,
+                                                       metrics=metrics, scratch=scratch, **settings['postbids_options'])
+            finally:
+                if scratch is not None:
+                    scratch.close()
+            check_lease(heartbeat, prefix, 'recording the converted folder')
+            settings['queue'].record_output(prefix, new_path)
+        check_lease(heartbeat, prefix, 'the cleanup')
+        shutil.rmtree(os.path.join(new_path, 'objects'), ignore_errors=True)
+
+        if settings['upload_bucket'] or settings['upload_local_root']:
+            check_lease(heartbeat, prefix, 'the upload')
+            upload_store = open_upload_store(settings['upload_bucket'], settings['upload_local_root'], settings['ingest_workers'],
+                                             settings['endpoint_url'])
+            result['upload'] = upload_subject(upload_store, new_path, settings['upload_prefix'], settings['ingest_workers'])
+            if settings['remove_uploaded']:
+                check_lease(heartbeat, prefix, 'removing the uploaded folder')
+                shutil.rmtree(new_path)
+
+        result['new_path'] = new_path
+        result['status'] = 'ok'
+        result.update(report)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+        result['traceback'] = traceback.format_exc()
+    result['ingest'] = stats
+    result['stages'] = metrics.summary()
+    result['seconds'] = round(time.time() - start, 3)
+
+    return result
+
+
+def write_result(result):
+    """ One JSON line per processed subject on stdout, tracebacks only go to stderr """
+    if result['status'] == 'failed':
+        sys.stderr.write(result['traceback'])
+    line = {k: v for k, v in result.items() if k != 'traceback'}
+    sys.stdout.write(json.dumps(line) + '\n')
+    sys.stdout.flush()
+
+
+def work(queue_path, settings, eps_block=8, poll=POLL_SECONDS, max_subjects=None):
+    """ Claim and process subjects until nothing is pending or running anymore, return how many were processed """
+    batchbids.init_worker(settings['pipeline_folder'], eps_block)
+    queue = WorkQueue(queue_path)
+    settings = dict(settings, queue=queue, owner=queue.owner)
+    processed = 0
+    try:
+        while max_subjects is None or processed < max_subjects:
+            task = queue.claim(settings['lease_seconds'], settings['backoff_seconds'])
+            if task is None:
+                # Subjects that are running elsewhere may still fail and come back, waiting on a backoff is waiting too
+                if not queue.unfinished():
+                    break
+                time.sleep(poll)
+                continue
+
+            with Heartbeat(queue_path, queue.owner, task['prefix'], settings['lease_seconds']) as heartbeat:
+                result = process_task(task, settings, heartbeat)
+            result['lease_lost'] = heartbeat.lost
+            if result['status'] == 'ok':
+                if not queue.complete(task['prefix'], task['attempt'], result['new_path'], result['ingest'].get('bytes', 0)):
+                    result['lease_lost'] = True
+            else:
+                queue.fail(task['prefix'], task['attempt'], result['error'], result['ingest'].get('bytes', 0),
+                           settings['backoff_seconds'])
+            write_result(result)
+            processed += 1
+    finally:
+        queue.close()
+
+    return processed
+
+
+def format_status(status):
+    """ Human readable status report """
+    states = status['states']
+    lines = [f"{status['subjects']} subjects: {states['done']} done, {states['running']} running, "
+             f"{states['pending']} pending ({len(status['retrying'])} retrying), {states['failed']} failed"]
+
+    throughput = status['throughput']
+    if throughput['done']:
+        rate = f", {throughput['subjects_per_hour']} per hour" if throughput['subjects_per_hour'] else ''
+        lines.append(f"{throughput['done']} subjects done in {throughput['span_seconds'] / 3600:.2f}h{rate}, "
+                     f"{throughput['recent']} in the last {throughput['window_seconds'] // 60:.0f} min, "
+                     f"{throughput['seconds_per_subject']}s per subject, {throughput['bytes_ingested']} bytes ingested")
+
+    for item in status['running']:
+        lines.append(f"running  {item['prefix']} on {item['owner']}, attempt {item['attempt']}, {item['seconds']}s, "
+                     f"lease {item['lease_left']}s left")
+    for item in status['retrying']:
+        lines.append(f"retrying {item['prefix']} in {item['retry_in']}s after {item['attempts']} attempts: {item['error']}")
+    for item in status['failed']:
+        lines.append(f"failed   {item['prefix']} after {item['attempts']} attempts: {item['error']}")
+
+    return '\n'.join(lines)
+
+
+def parse_arguments():
+    """ Parse command line arguments"""
+    parser = argparse.ArgumentParser(description="Shared queue of subjects for any number of workers on any number of nodes.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    enqueue = commands.add_parser('enqueue', help="Add S3 subject prefixes to the queue")
+    enqueue.add_argument('queue', type=str, help="Queue file on disk shared by every worker (created if missing)")
+    enqueue.add_argument('prefixes', type=str, nargs='*', help="Subject prefixes in the bucket (ex. Penn/HUP199_phaseII)")
+    enqueue.add_argument('--manifest', type=str, help="Text file with one subject prefix per line")
+    enqueue.add_argument('--type', type=str, choices=['ieeg', 'scalp'], required=True, help="Flag indicating data type: 'ieeg' or 'scalp'")
+    enqueue.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS,
+                         help=f"Attempts before a subject is failed for good (default: {MAX_ATTEMPTS})")
+
+    worker = commands.add_parser('work', help="Claim and process subjects until the queue is drained")
+    worker.add_argument('queue', type=str, help="Queue file on disk shared by every worker")
+    worker.add_argument('--pipeline', type=str, required=True, help="Path to the pipeline creation (module) folder")
+    worker.add_argument('--processes', type=int, default=1, help="Worker processes on this node (default: 1)")
+    worker.add_argument('--max-subjects', type=int, help="Subjects each worker process takes at most (default: no limit)")
+    worker.add_argument('--data', type=str, default='~/data', help="Folder the subject folders are downloaded to (default: ~/data)")
+    worker.add_argument('--bucket', type=str, default=BUCKET, help=f"Bucket to download from (default: {BUCKET})")
+    worker.add_argument('--endpoint-url', type=str, help="S3 compatible endpoint, ex. a MinIO server")
+    worker.add_argument('--local-root', type=str, help="Download from this folder as if it were the bucket, no S3")
+    worker.add_argument('--ingest-workers', type=int, default=16, help="Concurrent ranged GETs and uploads per subject (default: 16)")
+    worker.add_argument('--upload-bucket', type=str, help="Upload the finished EPS folders to this bucket")
+    worker.add_argument('--upload-prefix', type=str, default='', help="Key prefix of the uploaded EPS folders (default: none)")
+    worker.add_argument('--upload-local-root', type=str, help="Upload into this folder as if it were the bucket, no S3")
+    worker.add_argument('--remove-uploaded', action='store_true', help="Delete the EPS folder once it is uploaded")
+    worker.add_argument('--converter', type=str, default=convertbids.CONVERTER,
+                        help=f"Converter command, {{input}} and {{module}} are filled in (default: '{convertbids.CONVERTER}')")
+    worker.add_argument('--lease', type=int, default=LEASE_SECONDS, help=f"Seconds a lease lasts without heartbeats (default: {LEASE_SECONDS})")
+    worker.add_argument('--backoff', type=int, default=BACKOFF_SECONDS,
+                        help=f"Seconds before the first retry of a failed subject, doubled for every further one (default: {BACKOFF_SECONDS})")
+    worker.add_argument('--poll', type=float, default=POLL_SECONDS,
+                        help=f"Seconds an idle worker waits before looking again (default: {POLL_SECONDS})")
+    worker.add_argument('--eps-block', type=int, default=8, help="EPS numbers each worker leases at a time (default: 8)")
+    worker.add_argument('--placement', type=str, choices=PLACEMENT_MODES, default='auto', help="How imaging is placed into the BIDS tree (default: auto)")
+    worker.add_argument('--stream-imaging', action='store_true', help="Extract imaging straight from the zip archives in objects/")
+    worker.add_argument('--edf-workers', type=int, default=1, help="Threads per subject for its EDF runs (default: 1)")
+    worker.add_argument('--split-events', action='store_true', help="Write one events.tsv per EDF run")
+    worker.add_argument('--merge-runs', action='store_true', help="Merge consecutive EDF runs into as few files as possible")
+    worker.add_argument('--max-run-mb', type=int, default=0, help="With --merge-runs, MiB per merged file (default: 0, no limit)")
+    worker.add_argument('--scratch-mb', type=int, default=0,
+                        help="Keep every subject folder under this many MiB while it is converted (default: 0, no limit)")
+    worker.add_argument('--imaging-duplicates', type=str, choices=DUPLICATE_MODES, default='collapse',
+                        help="Imaging volumes with the same content as an earlier one (default: collapse)")
+    worker.add_argument('--mne-channels', action='store_true', help="Classify channels with MNE instead of from the EDF header")
+    worker.add_argument('--metrics', type=str, help="Append one JSON line per subject stage to this file, '-' for stderr")
+
+    status = commands.add_parser('status', help="Subjects per state, throughput, running, retrying and failed subjects")
+    status.add_argument('queue', type=str, help="Queue file on disk shared by every worker")
+    status.add_argument('--json', action='store_true', help="Print the report as JSON")
+
+    requeue = commands.add_parser('requeue', help="Give failed subjects, or the given ones, a fresh set of attempts")
+    requeue.add_argument('queue', type=str, help="Queue file on disk shared by every worker")
+    requeue.add_argument('prefixes', type=str, nargs='*', help="Subject prefixes to requeue (default: every failed one)")
+
+    args = parser.parse_args()
+
+    if args.command == 'enqueue' and not args.prefixes and not args.manifest:
+        parser.error("give subject prefixes or --manifest")
+    if args.command == 'work':
+        if not os.path.isdir(args.pipeline):
+            parser.error(f"{args.pipeline} is not a valid pipeline directory.")
+        if args.processes < 1 or args.ingest_workers < 1:
+            parser.error("--processes and --ingest-workers must be at least 1")
+        if args.lease < HEARTBEATS_PER_LEASE:
+            parser.error(f"--lease must be at least {HEARTBEATS_PER_LEASE} seconds")
+    if args.command != 'enqueue' and not os.path.isfile(args.queue):
+        parser.error(f"{args.queue} is not a queue file")
+
+    return args
+
+
+def main():
+    args = parse_arguments()
+    # Worker processes get the paths in settings, relative --data/--pipeline/queue paths would depend on where they run
+    queue_path = os.path.abspath(args.queue)
+
+    if args.command == 'enqueue':
+        prefixes = list(args.prefixes)
+        if args.manifest:
+            prefixes += read_manifest(args.manifest)
+        queue = WorkQueue(queue_path)
+        added = queue.enqueue(prefixes, args.type, args.max_attempts)
+        sys.stderr.write(f"Enqueued {added} of {len(prefixes)} subjects, {len(prefixes) - added} were already queued\n")
+        queue.close()
+
+    elif args.command == 'status':
+        queue = WorkQueue(queue_path)
+        status = queue.status()
+        queue.close()
+        sys.stdout.write((json.dumps(status, indent=2) if args.json else format_status(status)) + '\n')
+
+    elif args.command == 'requeue':
+        queue = WorkQueue(queue_path)
+        sys.stderr.write(f"Requeued {queue.requeue(args.prefixes)} subjects\n")
+        queue.close()
+
+    else:
+        settings = {
+            'pipeline_folder': os.path.abspath(args.pipeline.rstrip('/')),
+            'data_folder': os.path.abspath(os.path.expanduser(args.data)),
+            'bucket': args.bucket,
+            'endpoint_url': args.endpoint_url,
+            'local_root': os.path.abspath(args.local_root) if args.local_root else None,
+            'ingest_workers': args.ingest_workers,
+            'upload_bucket': args.upload_bucket,
+            'upload_prefix': args.upload_prefix,
+            'upload_local_root': os.path.abspath(args.upload_local_root) if args.upload_local_root else None,
+            'remove_uploaded': args.remove_uploaded,
+            'converter': args.converter,
+            'lease_seconds': args.lease,
+            'backoff_seconds': args.backoff,
+            'metrics': os.path.abspath(args.metrics) if args.metrics and args.metrics != '-' else args.metrics,
+            'scratch_bytes': args.scratch_mb * 1024 * 1024,
+            'postbids_options': {
+                'placement': args.placement, 'stream_imaging': args.stream_imaging, 'edf_workers': args.edf_workers,
+                'mne_channels': args.mne_channels, 'split_events': args.split_events,
+                'duplicate_mode': args.imaging_duplicates, 'merge_runs': args.merge_runs,
+                'max_run_bytes': args.max_run_mb * 1024 * 1024,
+            },
+        }
+        workers = [multiprocessing.Process(target=work, args=(queue_path, settings, args.eps_block, args.poll, args.max_subjects))
+                   for _ in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        queue = WorkQueue(queue_path)
+        sys.stderr.write(format_status(queue.status()) + '\n')
+        queue.close()
+        if any(worker.exitcode for worker in workers):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()